@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#
+
+# Syntax tree node classes
+#
+# There is one class per node type. Every class uses __slots__, so nodes have
+# no per-instance __dict__, and lists its child attributes in child_fields, in
+# the order they are visited and printed. Attributes beginning with "child_"
+# hold one child node and attributes beginning with "children_" a list of child
+# nodes (see tree_print.get_childvars). Optional attributes, e.g. the attribute
+# access of a var node, are simply left unset, so hasattr() can be used to test
+# for them.
+
+
+class ASTnode:
+    '''Base class of all syntax tree nodes'''
+    # valtype: type of the value of an expression (see typecheck.py)
+    __slots__ = ('value', 'lineno', 'symdata', 'valtype')
+    nodetype = None
+    child_fields = ()
+    # Pairs (attribute name, is it a list of children) for each child field,
+    # computed from child_fields when a subclass is created
+    child_schema = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.child_schema = tuple((name, name.startswith("children_"))
+                                 for name in cls.child_fields)
+
+
+class Program(ASTnode):
+    __slots__ = ('children_definitions', 'children_statements')
+    nodetype = 'program'
+    child_fields = __slots__
+
+
+class VariableDef(ASTnode):
+    __slots__ = ('child_expression',)
+    nodetype = 'variable_def'
+    child_fields = __slots__
+
+
+class FunctionDef(ASTnode):
+    __slots__ = ('children_formals', 'children_variable_defs', 'child_body',
+                 'type', 'frame_size', 'pure')
+    nodetype = 'function_def'
+    child_fields = ('children_formals', 'children_variable_defs', 'child_body')
+
+
+class ProcedureDef(ASTnode):
+    __slots__ = ('children_formals', 'children_var_defs', 'children_statements',
+                 'type', 'frame_size')
+    nodetype = 'procedure_def'
+    child_fields = ('children_formals', 'children_var_defs', 'children_statements')
+
+
+class FormalArg(ASTnode):
+    __slots__ = ('type',)
+    nodetype = 'formal_arg'
+
+
+class ProcCall(ASTnode):
+    __slots__ = ('children_args',)
+    nodetype = 'proc_call'
+    child_fields = __slots__
+
+
+class FuncCall(ASTnode):
+    __slots__ = ('children_args',)
+    nodetype = 'func_call'
+    child_fields = __slots__
+
+
+class Assign(ASTnode):
+    __slots__ = ('child_lvalue', 'child_rvalue')
+    nodetype = 'assign'
+    child_fields = __slots__
+
+
+class Var(ASTnode):
+    __slots__ = ('child_read_attr', 'child_write_attr')
+    nodetype = 'var'
+    child_fields = __slots__
+
+
+class ReadAttribute(ASTnode):
+    __slots__ = ()
+    nodetype = 'read_attribute'
+
+
+class WriteAttribute(ASTnode):
+    __slots__ = ()
+    nodetype = 'write_attribute'
+
+
+class PrintStatement(ASTnode):
+    __slots__ = ('children_print_items',)
+    nodetype = 'print_statement'
+    child_fields = __slots__
+
+
+class StringLiteral(ASTnode):
+    __slots__ = ()
+    nodetype = 'string_literal'
+
+
+class IntLiteral(ASTnode):
+    __slots__ = ()
+    nodetype = 'int_literal'
+
+
+class DateLiteral(ASTnode):
+    __slots__ = ()
+    nodetype = 'date_literal'
+
+
+class ReturnStatement(ASTnode):
+    __slots__ = ('child_expr',)
+    nodetype = 'return_statement'
+    child_fields = __slots__
+
+
+class WhileLoop(ASTnode):
+    # invariants: symbol data of the temporaries of the loop invariants
+    # hoisted out of the loop (see optimize.py), reset when the loop starts
+    __slots__ = ('child_condition', 'children_body', 'invariants')
+    nodetype = 'while_loop'
+    child_fields = ('child_condition', 'children_body')
+
+
+class LoopInvariant(ASTnode):
+    # An expression whose value doesn't change in a WHILE loop. It is
+    # evaluated when first needed, and its value is kept in a temporary
+    # (symdata) until the loop starts again.
+    __slots__ = ('child_expr',)
+    nodetype = 'loop_invariant'
+    child_fields = __slots__
+
+
+class IfStatement(ASTnode):
+    __slots__ = ('child_condition', 'children_if_branch', 'children_else_branch')
+    nodetype = 'if_statement'
+    child_fields = __slots__
+
+
+class IfExpression(ASTnode):
+    __slots__ = ('child_condition', 'child_if_body', 'child_else_body')
+    nodetype = 'if_expression'
+    child_fields = __slots__
+
+
+class Comparison(ASTnode):
+    __slots__ = ('child_left_expr', 'child_right_expr')
+    nodetype = 'comparison'
+    child_fields = __slots__
+
+
+class Operation(ASTnode):
+    # operate: function computing the operation for the types of the
+    # operands, None if they are not known (see typecheck.py)
+    __slots__ = ('child_left_expr', 'child_right_expr', 'operate')
+    nodetype = 'operation'
+    child_fields = ('child_left_expr', 'child_right_expr')
+
+
+# Node classes by node type
+NODE_CLASSES = {cls.nodetype: cls for cls in ASTnode.__subclasses__()}
+
+
+def make_node(nodetype):
+    '''Create an empty node of the given type'''
+    return NODE_CLASSES[nodetype]()
+
+
+def node_line(node):
+    '''Return the line number of a node, or of its first child with one
+       (e.g. a WHILE loop has the line of its condition), 0 if there is none'''
+    while not hasattr(node, 'lineno'):
+        for name, is_list in type(node).child_schema:
+            child = getattr(node, name, None)
+            if is_list:
+                child = child[0] if child else None
+            if child is not None:
+                node = child
+                break
+        else:
+            return 0
+    return node.lineno
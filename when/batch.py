@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+#
+
+# Batch runner: parse, check and run many programs in a pool of processes
+#
+#     python3 batch.py [-j JOBS] [--timeout SECONDS] FILE_OR_DIRECTORY...
+#
+# Each worker process makes its lexer and parser once (see init_worker) and
+# then handles programs one after another, so a program costs only its own
+# parsing, checking and running. A program that runs longer than the timeout
+# is stopped with SIGALRM in its worker. Runs can also be limited by steps and
+# memory (see budget.py).
+#
+# One JSON object is written per program, on its own line and in the order the
+# programs were given:
+#
+#     file     the source file
+#     status   "ok", "read_error" (the file can't be read as UTF-8),
+#              "parse_error", "check_error", "run_error", "limit_exceeded"
+#              (a limit of the budget), "timeout" or "crash" (an exception of
+#              the interpreter itself)
+#     output   lines printed by the program, run-time error included
+#     error    the error message, null if the status is "ok"
+#     times    seconds spent in "parse", "check" (optimizations included)
+#              and "run"
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import signal
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from budget import Budget, LimitExceeded
+from output import ListSink
+from semantics_run import DEFAULT_MAX_DEPTH, ENGINES, RunError
+
+DEFAULT_TIMEOUT = 10.0
+CHUNK_SIZE = 16
+
+# State of a worker process, set by init_worker
+_worker = None
+
+
+class ProgramTimeout(Exception):
+    pass
+
+
+class Worker:
+    '''The lexer and parser of a worker process, the options used for every
+       program, and up to max_programs checked programs kept by key'''
+
+    def __init__(self, engine, memo_size, max_depth, optimize, timeout, max_programs=0, budget=None):
+        import lexer
+        import main
+        self.lexer = lexer.make_lexer()
+        self.parser = main.make_parser()
+        self.engine = engine
+        self.memo_size = memo_size
+        self.max_depth = max_depth
+        self.optimize = optimize
+        self.timeout = timeout
+        self.max_programs = max_programs
+        self.budget = budget
+        self.programs = OrderedDict()  # key -> (tree, semdata), least recently used first
+        self.timing = False  # Is the timer of a program running
+
+    def parse(self, data):
+        self.lexer.lineno = 1
+        return self.parser.parse(data, lexer=self.lexer)
+
+    def check(self, tree):
+        from semantics_common import SemData
+        from symtbl_semantics_check import semantic_checks
+        semdata = SemData()
+        semantic_checks(tree, semdata)
+        if self.optimize:
+            from optimize import optimize
+            optimize(tree, semdata)
+        return semdata
+
+    def run(self, filename):
+        '''Parse, check and run a program file, and return its result'''
+        try:
+            with open(filename, encoding='utf-8') as infile:
+                data = infile.read()
+        except (OSError, UnicodeDecodeError) as error:
+            return {'file': filename, 'status': 'read_error', 'output': [],
+                    'error': "{}: {}".format(type(error).__name__, error), 'times': {}}
+        return self.run_source(data, {'file': filename})
+
+    def run_source(self, data, result, key=None, engine=None, timeout=None, max_steps=None):
+        '''Parse, check and run the source of a program, and fill in and
+           return the dict result
+
+           A program already checked with the same key is run again without
+           parsing and checking it. engine and timeout override the options
+           of the worker, and max_steps lowers the step limit of its budget.'''
+        from semantics_run import run_program
+        engine = engine or self.engine
+        timeout = self.timeout if timeout is None else timeout
+        budget = self.budget
+        if max_steps is not None:
+            budget = (budget or Budget()).limited(max_steps)
+        result.update(status='ok', output=[], error=None, times={})
+        times = result['times']
+        output = ListSink()
+        messages = io.StringIO()  # Syntax and semantic errors are printed
+        phase = 'parse'
+        start = time.perf_counter()
+        try:
+            try:
+                if timeout:
+                    self.timing = True
+                    signal.setitimer(signal.ITIMER_REAL, timeout)
+                program = self.programs.get(key) if key is not None else None
+                if program is not None:
+                    self.programs.move_to_end(key)
+                    tree, semdata = program
+                else:
+                    with contextlib.redirect_stdout(messages):
+                        tree = self.parse(data)
+                        times['parse'] = time.perf_counter() - start
+                        phase = 'check'
+                        start = time.perf_counter()
+                        semdata = self.check(tree)
+                        times['check'] = time.perf_counter() - start
+                    if key is not None and self.max_programs:
+                        self.programs[key] = (tree, semdata)
+                        if len(self.programs) > self.max_programs:
+                            self.programs.popitem(last=False)
+                phase = 'run'
+                start = time.perf_counter()
+                run_program(tree, semdata, engine, self.memo_size, self.max_depth, output, budget=budget)
+            finally:
+                # Stop the timer before anything else, an alarm coming
+                # after this is ignored (see raise_timeout)
+                if timeout:
+                    self.timing = False
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except ProgramTimeout:
+            result['status'] = 'timeout'
+            result['error'] = "timed out after {} s".format(timeout)
+        except LimitExceeded as error:
+            result['status'] = 'limit_exceeded'
+            result['error'] = error.message
+        except RunError as error:
+            result['status'] = 'run_error'
+            result['error'] = error.message
+        except SystemExit:
+            result['status'] = phase + '_error'
+            result['error'] = messages.getvalue().strip()
+        except Exception as error:
+            # The lexer raises an Exception for illegal input
+            if phase == 'parse' and type(error) is Exception:
+                result['status'] = 'parse_error'
+                result['error'] = str(error)
+            else:
+                result['status'] = 'crash'
+                result['error'] = "{}: {}".format(type(error).__name__, error)
+        times[phase] = time.perf_counter() - start
+        output.flush()
+        result['output'] = output.lines
+        if output.tail:
+            result['output'].append(output.tail)
+        return result
+
+
+def raise_timeout(signum, frame):
+    # The handler may run a little after the timer was stopped
+    if _worker is not None and _worker.timing:
+        raise ProgramTimeout()
+
+
+def init_worker(*options):
+    '''Initialize a worker process: make its lexer and parser'''
+    global _worker
+    _worker = Worker(*options)
+    signal.signal(signal.SIGALRM, raise_timeout)
+    # A worker forked by server.py inherits the signal handling of its event
+    # loop, which would take the worker's own signals as the server's
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def make_budget(max_steps=None, max_memory=None):
+    '''Return the budget of the --max-steps and --max-memory (megabytes)
+       options, None if neither is given'''
+    if max_steps is None and max_memory is None:
+        return None
+    return Budget(max_steps, max_memory=None if max_memory is None else int(max_memory * 2**20))
+
+
+def run_file(filename):
+    return _worker.run(filename)
+
+
+def find_sources(paths):
+    '''Return the files given, with the .when files under the directories
+       given, in order'''
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for directory, subdirectories, filenames in os.walk(path):
+                found.extend(os.path.join(directory, name)
+                             for name in filenames if name.endswith('.when'))
+            sources.extend(sorted(found))
+        else:
+            sources.append(path)
+    return sources
+
+
+def run_batch(sources, jobs=None, options=(), chunk_size=CHUNK_SIZE):
+    '''Generate the results of running a list of source files, in order
+
+       options are the arguments of Worker after the files. With one job the
+       programs are run in this process.'''
+    if jobs == 1:
+        init_worker(*options)
+        yield from map(run_file, sources)
+        return
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=options) as pool:
+        yield from pool.map(run_file, sources, chunksize=chunk_size)
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(
+        description='run many When programs in parallel, writing one JSON line of results per program')
+    argParser.add_argument('sources', nargs='*', help='source files and directories of .when files')
+    argParser.add_argument('--list', metavar='FILE',
+                           help="file listing more sources, one per line ('-' for stdin)")
+    argParser.add_argument('-j', '--jobs', type=int, default=None,
+                           help='worker processes (default one per CPU, 1 runs in this process)')
+    argParser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                           help='seconds allowed per program (default 10, 0 for no limit)')
+    argParser.add_argument('-e', '--engine', choices=ENGINES, default='closure', help='execution engine')
+    argParser.add_argument('--memo-size', type=int, default=4096,
+                           help='results memoized per pure function (0 disables memoization)')
+    argParser.add_argument('--max-depth', type=int, default=DEFAULT_MAX_DEPTH,
+                           help='maximum depth of function/procedure calls in the vm engine')
+    argParser.add_argument('--max-steps', type=int, default=None,
+                           help='loop rounds and function/procedure calls allowed per program')
+    argParser.add_argument('--max-memory', type=float, default=None,
+                           help='megabytes a worker may grow by while running a program')
+    argParser.add_argument('--no-optimize', action='store_true', help='run the programs as written')
+    argParser.add_argument('--results', metavar='FILE', help='write the results to a file instead of stdout')
+    ns = argParser.parse_args()
+
+    paths = list(ns.sources)
+    if ns.list:
+        with (contextlib.nullcontext(sys.stdin) if ns.list == '-' else open(ns.list)) as listfile:
+            paths.extend(line.strip() for line in listfile if line.strip())
+    if not paths:
+        argParser.error('no sources given')
+
+    options = (ns.engine, ns.memo_size, ns.max_depth, not ns.no_optimize, ns.timeout, 0,
+               make_budget(ns.max_steps, ns.max_memory))
+    counts = dict()
+    start = time.perf_counter()
+    with (open(ns.results, 'w', encoding='utf-8') if ns.results
+          else contextlib.nullcontext(sys.stdout)) as outfile:
+        for result in run_batch(find_sources(paths), ns.jobs, options):
+            outfile.write(json.dumps(result) + '\n')
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print("{} programs in {:.3f} s ({:.0f}/s): {}".format(
+        total, elapsed, total / elapsed if elapsed else 0,
+        ", ".join("{} {}".format(count, status) for status, count in sorted(counts.items()))),
+        file=sys.stderr)
@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+#
+
+# Benchmarks for the When interpreter
+#
+# Programs are generated with the given sizes, parsed and checked once, and then
+# run with each execution engine. Output of the programs is discarded, except
+# in the output benchmark.
+#
+# The suite benchmark times each phase (lexing, parsing, semantic checks,
+# optimizations and running with each engine) separately, for the test
+# programs and for synthetic ones, and can save the results as JSON and
+# compare them to a saved baseline:
+#
+#     python3 benchmark.py suite --json baseline.json
+#     python3 benchmark.py suite --baseline baseline.json
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import lexer
+from main import parser
+from output import DEFAULT_BUFFER_SIZE, FileSink, ListSink, NullSink
+from semantics_common import SemData
+from symtbl_semantics_check import semantic_checks, semantic_checks_multipass
+from semantics_run import run_program, ENGINES
+
+
+def deep_recursion_source(depth, repeat):
+    '''Linear recursion `depth` calls deep, done `repeat` times'''
+    return '''
+VAR round IS 0
+VAR total IS 0
+
+FUNCTION Sum{ nn[int] } RETURN int IS
+  IF nn < 1 THEN
+    0
+  ELSE
+    nn + Sum( nn - 1 )
+  ENDIF
+END FUNCTION
+
+WHILE round < %d DO
+  total := total + Sum( %d );
+  round := round + 1;
+ENDWHILE;
+PRINT total;
+''' % (repeat, depth)
+
+
+def wide_recursion_source(n):
+    '''Tree recursion (naive Fibonacci), about 1.6**n calls'''
+    return '''
+FUNCTION Fibo{ number[int] } RETURN int IS
+  IF number < 2 THEN
+    number
+  ELSE
+    Fibo( number - 1 ) + Fibo( number - 2 )
+  ENDIF
+END FUNCTION
+
+PRINT Fibo( %d );
+''' % n
+
+
+def wide_definitions_source(n):
+    '''A large straight program: n variables, FUNCTIONs, PROCEDUREs and statements'''
+    parts = []
+    for i in range(n):
+        parts.append("VAR var_%d IS %d * 2 + 1\n" % (i, i))
+    for i in range(n):
+        parts.append('''
+FUNCTION Func_%d{ aa[int], bb[date] } RETURN int
+VAR cc IS aa + 1
+IS
+  IF aa < cc THEN bb'year + cc ELSE bb'month - aa ENDIF
+END FUNCTION
+
+PROCEDURE PROC%s{ aa[int] } RETURN int
+VAR dd IS 0
+IS
+  dd := Func_%d( aa, 2024-05-01 ) + var_%d;
+  RETURN dd;
+END PROCEDURE
+''' % (i, _proc_suffix(i), i, i))
+    for i in range(n):
+        parts.append('''
+WHILE var_%d < 10 DO
+  var_%d := var_%d + Func_%d( var_%d, 2024-05-01 );
+  IF var_%d = 3 THEN
+    PRINT "three", PROC%s( var_%d );
+  ENDIF;
+ENDWHILE;
+''' % ((i,) * 6 + (_proc_suffix(i), i)))
+    return "".join(parts)
+
+
+def _proc_suffix(i):
+    '''PROCEDURE names are all upper case, so numbers are written with letters'''
+    return "".join(chr(ord('A') + int(digit)) for digit in str(i))
+
+
+def parse_and_check(data):
+    lexer.lexer.lineno = 1
+    tree = parser.parse(data, lexer=lexer.lexer)
+    semdata = SemData()
+    semantic_checks(tree, semdata)
+    return tree, semdata
+
+
+def time_run(tree, semdata, engine, repeat, memo_size=0, make_output=NullSink):
+    '''Best wall time of `repeat` runs of a checked program'''
+    best = None
+    for i in range(repeat):
+        output = make_output()
+        start = time.perf_counter()
+        run_program(tree, semdata, engine, memo_size, output=output)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_recursion(ns):
+    benchmarks = [
+        ("deep recursion (depth %d x %d)" % (ns.depth, ns.rounds),
+         deep_recursion_source(ns.depth, ns.rounds)),
+        ("wide recursion (Fibo(%d))" % ns.fibo, wide_recursion_source(ns.fibo)),
+    ]
+    # The tree walker and the closure engine recurse in Python, a few
+    # Python frames per When-level call
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), ns.depth * 10 + 1000))
+    for name, data in benchmarks:
+        tree, semdata = parse_and_check(data)
+        for engine in ns.engines:
+            elapsed = time_run(tree, semdata, engine, ns.repeat, ns.memo_size)
+            print("{:<40} {:<8} {:8.3f} s".format(name, engine, elapsed))
+
+
+def time_checks(tree, check_func, repeat):
+    '''Best wall time of `repeat` runs of semantic checks on a parsed program'''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        check_func(tree, SemData())
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_checks(ns):
+    lexer.lexer.lineno = 1
+    tree = parser.parse(wide_definitions_source(ns.definitions), lexer=lexer.lexer)
+    name = "semantic checks (%d definitions)" % ns.definitions
+    for variant, check_func in [('fused', semantic_checks), ('multipass', semantic_checks_multipass)]:
+        elapsed = time_checks(tree, check_func, ns.repeat)
+        print("{:<40} {:<10} {:8.3f} s".format(name, variant, elapsed))
+
+
+def time_tokenize(make_lexer, data, repeat):
+    '''Best wall time of `repeat` tokenizations of data'''
+    best = None
+    for i in range(repeat):
+        lex = make_lexer()
+        lex.lineno = 1
+        start = time.perf_counter()
+        lex.input(data)
+        token = lex.token
+        while token() is not None:
+            pass
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_scanner(ns):
+    from scanner import Scanner, open_source
+    source = wide_definitions_source(ns.definitions)
+    size = len(source.encode('utf-8'))
+    name = "tokenize (%.1f MB)" % (size / 1e6)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'wide.when')
+        with open(filename, 'w') as outfile:
+            outfile.write(source)
+        with open_source(filename) as data:
+            variants = [
+                ('ply', lambda: lexer.lexer, source),
+                ('scanner', Scanner, source),
+                ('scanner mmap', Scanner, data),
+            ]
+            for variant, make_lexer, input_data in variants:
+                elapsed = time_tokenize(make_lexer, input_data, ns.repeat)
+                print("{:<40} {:<13} {:8.3f} s {:8.1f} MB/s".format(
+                    name, variant, elapsed, size / elapsed / 1e6))
+
+
+def print_lines_source(n):
+    '''A loop printing n lines'''
+    return '''
+VAR ii IS 0
+VAR day IS 2024-05-01
+WHILE ii < %d DO
+  PRINT "line", ii, day;
+  ii := ii + 1;
+ENDWHILE;
+''' % n
+
+
+def benchmark_output(ns):
+    tree, semdata = parse_and_check(print_lines_source(ns.lines))
+    name = "print %d lines" % ns.lines
+    with open(os.devnull, 'w') as devnull:
+        variants = [
+            ('discard', NullSink),
+            ('list', ListSink),
+            ('file, flush per line', lambda: FileSink(devnull, 'line')),
+            ('file, buffered', lambda: FileSink(devnull, DEFAULT_BUFFER_SIZE)),
+        ]
+        for engine in ns.engines:
+            for variant, make_output in variants:
+                elapsed = time_run(tree, semdata, engine, ns.repeat, make_output=make_output)
+                print("{:<40} {:<8} {:<22} {:8.3f} s".format(name, engine, variant, elapsed))
+
+
+TINY_SOURCE = '''
+VAR wappu IS 2024-05-01
+PRINT "wappu is on day", wappu'day;
+'''
+
+
+def time_command(command, repeat, cwd=None):
+    '''Best wall time of `repeat` runs of a command in a new process'''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True, cwd=cwd)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_startup(ns):
+    here = os.path.dirname(os.path.abspath(__file__))
+    main_py = os.path.join(here, 'main.py')
+    with tempfile.TemporaryDirectory() as tmpdir, tempfile.TemporaryDirectory() as cachedir:
+        tiny = os.path.join(tmpdir, 'tiny.when')
+        with open(tiny, 'w') as outfile:
+            outfile.write(TINY_SOURCE)
+        wide = os.path.join(tmpdir, 'wide.when')
+        with open(wide, 'w') as outfile:
+            outfile.write(wide_definitions_source(ns.definitions // 10))
+        # Run from another directory, so that nothing is picked up from
+        # or written to the working directory. The first run with a cache
+        # fills it, the best time is of a cache hit.
+        commands = [
+            ("python startup (reference)", [sys.executable, '-c', 'pass']),
+            ("main.py -f tiny.when", [sys.executable, main_py, '-f', tiny]),
+            ("main.py -f tiny.when (cached)", [sys.executable, main_py, '-f', tiny, '--cache-dir', cachedir]),
+            ("main.py -f wide.when", [sys.executable, main_py, '-f', wide]),
+            ("main.py -f wide.when (cached)",
+             [sys.executable, main_py, '-f', wide, '--cache-dir', cachedir]),
+        ]
+        for name, command in commands:
+            elapsed = time_command(command, ns.startup_repeat, tmpdir)
+            print("{:<40} {:8.3f} s".format(name, elapsed))
+        stray = [name for name in os.listdir(tmpdir) if name not in ('tiny.when', 'wide.when')]
+        if stray:
+            print("files written to the working directory:", ", ".join(stray))
+
+
+def benchmark_batch(ns):
+    from batch import find_sources, run_batch
+    here = os.path.dirname(os.path.abspath(__file__))
+    corpus = find_sources([os.path.join(here, 'test', 'running')])
+    main_py = os.path.join(here, 'main.py')
+    # One process per program, for the corpus once
+    start = time.perf_counter()
+    for filename in corpus:
+        subprocess.run([sys.executable, main_py, '-f', filename], stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+    print("{:<40} {:<16} {:8.3f} s {:8.0f} programs/s".format(
+        "main.py per program (%d programs)" % len(corpus), "", elapsed, len(corpus) / elapsed))
+    sources = corpus * ns.batch_copies
+    options = ('closure', 4096, None, True, 0)
+    for jobs in sorted({1, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        for result in run_batch(sources, jobs, options):
+            pass
+        elapsed = time.perf_counter() - start
+        print("{:<40} {:<16} {:8.3f} s {:8.0f} programs/s".format(
+            "batch.py (%d programs)" % len(sources), "%d job(s)" % jobs, elapsed, len(sources) / elapsed))
+
+
+def benchmark_server(ns):
+    from server import send
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'server.sock')
+        server = subprocess.Popen([sys.executable, os.path.join(here, 'server.py'),
+                                   '--socket', path, '-j', '1'])
+        try:
+            while not os.path.exists(path):
+                time.sleep(0.01)
+            # The first request parses and checks the program, the others
+            # find it in the worker
+            latencies = []
+            start = time.perf_counter()
+            for response in send([TINY_SOURCE] * (ns.startup_repeat + 1), path):
+                now = time.perf_counter()
+                latencies.append(now - start)
+                start = now
+        finally:
+            server.terminate()
+            server.wait()
+    print("{:<40} {:8.4f} s".format("server, first request", latencies[0]))
+    print("{:<40} {:8.4f} s".format("server, best repeated request", min(latencies[1:])))
+
+
+def long_loop_source(n):
+    '''A counting loop of n rounds'''
+    return '''
+VAR ii IS 0
+VAR total IS 0
+WHILE ii < %d DO
+  total := total + ii * 2;
+  ii := ii + 1;
+ENDWHILE;
+PRINT total;
+''' % n
+
+
+def date_arithmetic_source(n):
+    '''A loop of n rounds of date arithmetics and attributes'''
+    return '''
+VAR ii IS 0
+VAR day IS 2000-01-01
+VAR days IS 0
+WHILE ii < %d DO
+  day := day + 1;
+  days := days + ( day - 2000-01-01 ) + day'month - day'weekday;
+  ii := ii + 1;
+ENDWHILE;
+PRINT day, days;
+''' % n
+
+
+def straight_line_source(n):
+    '''n groups of statements without loops or calls'''
+    parts = ["VAR aa IS 1\nVAR bb IS 2024-05-01\n"]
+    for i in range(n):
+        parts.append("aa := ( aa * 3 + %d ) / 2 - aa;\nbb := bb + %d;\nPRINT aa, bb'day;\n"
+                     % (i % 100, i % 7))
+    return "".join(parts)
+
+
+# Sizes of the synthetic programs of the suite, multiplied by --scale
+SUITE_SIZES = {
+    'loop': 200000,
+    'dates': 50000,
+    'depth': 500,
+    'fibo': 18,
+    'statements': 20000,
+    'definitions': 1000,
+}
+# Differences smaller than this (in seconds) are never regressions
+MIN_DIFFERENCE = 0.001
+
+
+def suite_workloads(scale):
+    '''Return (name, list of sources) of the workloads of the suite'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    sizes = {name: max(1, int(size * scale)) for name, size in SUITE_SIZES.items()}
+    # The calls of Fibo grow 1.6 times with each step
+    sizes['fibo'] = max(1, SUITE_SIZES['fibo'] + round(math.log(scale, 1.618)))
+    workloads = []
+    for corpus in ('running', 'semantics'):
+        directory = os.path.join(here, 'test', corpus)
+        sources = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.when'):
+                with open(os.path.join(directory, name), encoding='utf-8') as infile:
+                    sources.append(infile.read())
+        workloads.append(("test/" + corpus, sources))
+    workloads += [
+        ("deep recursion (%d x 10)" % sizes['depth'], [deep_recursion_source(sizes['depth'], 10)]),
+        ("wide recursion (Fibo(%d))" % sizes['fibo'], [wide_recursion_source(sizes['fibo'])]),
+        ("long loop (%d)" % sizes['loop'], [long_loop_source(sizes['loop'])]),
+        ("date arithmetics (%d)" % sizes['dates'], [date_arithmetic_source(sizes['dates'])]),
+        ("straight line (%d)" % sizes['statements'], [straight_line_source(sizes['statements'])]),
+        ("wide definitions (%d)" % sizes['definitions'],
+         [wide_definitions_source(sizes['definitions'])]),
+    ]
+    return workloads
+
+
+def timed(function, *args):
+    '''Return the wall time of a call, with garbage collection off, and
+       its result'''
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        return time.perf_counter() - start, result
+    finally:
+        gc.enable()
+
+
+def tokenize(data):
+    lex = lexer.lexer
+    lex.lineno = 1
+    lex.input(data)
+    token = lex.token
+    while token() is not None:
+        pass
+
+
+def parse(data):
+    lexer.lexer.lineno = 1
+    return parser.parse(data, lexer=lexer.lexer)
+
+
+def check(tree):
+    '''Return the semantic data of a tree, None if it has errors'''
+    semdata = SemData()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            semantic_checks(tree, semdata)
+    except SystemExit:
+        return None
+    return semdata
+
+
+def run_discarded(tree, semdata, engine):
+    try:
+        run_program(tree, semdata, engine, output=NullSink())
+    except SystemExit:
+        pass
+
+
+def time_workload(sources, engines):
+    '''Return the times of each phase for all sources together
+
+       Parsing includes lexing (the parser pulls the tokens). Programs with
+       semantic errors are not optimized or run.'''
+    from optimize import optimize
+    times = dict.fromkeys(('lex', 'parse', 'check'), 0.0)
+    for data in sources:
+        times['lex'] += timed(tokenize, data)[0]
+        elapsed, tree = timed(parse, data)
+        times['parse'] += elapsed
+        elapsed, semdata = timed(check, tree)
+        times['check'] += elapsed
+        if semdata is None:
+            continue
+        times['optimize'] = times.get('optimize', 0.0) + timed(optimize, tree, semdata)[0]
+        for engine in engines:
+            phase = 'run ' + engine
+            times[phase] = times.get(phase, 0.0) + timed(run_discarded, tree, semdata, engine)[0]
+    return times
+
+
+def compare_results(results, baseline, threshold):
+    '''Print the suite results against a baseline, return the number of
+       regressions: phases with a best time over (1 + threshold) times the
+       baseline'''
+    regressions = 0
+    for workload, phases in results.items():
+        for phase, stats in phases.items():
+            base = baseline.get(workload, {}).get(phase)
+            if base is None:
+                continue
+            ratio = stats['min'] / base['min'] if base['min'] else float('inf')
+            regression = (ratio > 1 + threshold and stats['min'] - base['min'] > MIN_DIFFERENCE)
+            regressions += regression
+            print("{:<36} {:<12} {:8.4f} s {:8.4f} s {:6.2f}x {}".format(
+                workload, phase, base['min'], stats['min'], ratio,
+                "REGRESSION" if regression else ""))
+    return regressions
+
+
+def benchmark_suite(ns):
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), int(SUITE_SIZES['depth'] * ns.scale) * 10 + 1000))
+    results = dict()
+    for name, sources in suite_workloads(ns.scale):
+        # One round to warm up, then the timed ones
+        time_workload(sources, ns.engines)
+        rounds = [time_workload(sources, ns.engines) for i in range(ns.repeat)]
+        results[name] = phases = dict()
+        for phase in rounds[0]:
+            samples = [times[phase] for times in rounds]
+            phases[phase] = {'min': min(samples), 'median': statistics.median(samples),
+                             'samples': samples}
+            if ns.baseline is None:
+                print("{:<36} {:<12} {:8.4f} s  (median {:8.4f} s)".format(
+                    name, phase, phases[phase]['min'], phases[phase]['median']))
+    if ns.json:
+        with open(ns.json, 'w') as outfile:
+            json.dump({'python': sys.version, 'platform': platform.platform(),
+                       'scale': ns.scale, 'repeat': ns.repeat, 'results': results}, outfile, indent=1)
+    if ns.baseline is not None:
+        with open(ns.baseline) as infile:
+            baseline = json.load(infile)
+        if baseline.get('scale') != ns.scale:
+            print("warning: the baseline was run with --scale", baseline.get('scale'))
+        print("{:<36} {:<12} {:>10} {:>10} {:>7}".format("", "", "baseline", "now", "ratio"))
+        regressions = compare_results(results, baseline['results'], ns.threshold)
+        print("{} regression(s) over {:.0%}".format(regressions, ns.threshold))
+        if regressions:
+            sys.exit(1)
+
+
+BENCHMARKS = {
+    'recursion': benchmark_recursion,
+    'checks': benchmark_checks,
+    'startup': benchmark_startup,
+    'scanner': benchmark_scanner,
+    'output': benchmark_output,
+    'batch': benchmark_batch,
+    'server': benchmark_server,
+    'suite': benchmark_suite,
+}
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('benchmarks', nargs='*',
+                           help='benchmarks to run: ' + ', '.join(BENCHMARKS) + ' (default all)')
+    argParser.add_argument('--engines', nargs='+', choices=ENGINES, default=ENGINES,
+                           help='execution engines to benchmark')
+    argParser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, best is reported')
+    argParser.add_argument('--depth', type=int, default=1000, help='depth of the deep recursion')
+    argParser.add_argument('--rounds', type=int, default=20, help='how many times the deep recursion is done')
+    argParser.add_argument('--memo-size', type=int, default=0,
+                           help='results memoized per pure function (default 0, no memoization)')
+    argParser.add_argument('--fibo', type=int, default=20, help='argument of the wide recursion')
+    argParser.add_argument('--definitions', type=int, default=2000,
+                           help='number of each kind of definition in the checks and scanner benchmarks')
+    argParser.add_argument('--lines', type=int, default=200000, help='lines printed in the output benchmark')
+    argParser.add_argument('--batch-copies', type=int, default=100,
+                           help='copies of the test/running programs in the batch benchmark')
+    argParser.add_argument('--scale', type=float, default=1.0,
+                           help='size of the synthetic programs of the suite benchmark, relative to the default')
+    argParser.add_argument('--json', metavar='FILE', help='write the results of the suite benchmark to a JSON file')
+    argParser.add_argument('--baseline', metavar='FILE',
+                           help='compare the suite benchmark to the results in a JSON file written with --json, '
+                                'exiting with status 1 on regressions')
+    argParser.add_argument('--threshold', type=float, default=0.1,
+                           help='slowdown over the baseline counted as a regression (default 0.1, i.e. 10%%)')
+    argParser.add_argument('--startup-repeat', type=int, default=20,
+                           help='runs of the interpreter in the startup benchmark, best is reported')
+    ns = argParser.parse_args()
+    for benchmark in ns.benchmarks:
+        if benchmark not in BENCHMARKS:
+            argParser.error("unknown benchmark '" + benchmark + "'")
+    for benchmark in ns.benchmarks or BENCHMARKS:
+        BENCHMARKS[benchmark](ns)
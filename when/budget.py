@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+
+# Execution budgets
+#
+# A Budget given to run_program limits what a program may use:
+#
+#     max_steps   steps, i.e. rounds of WHILE loops and FUNCTION/PROCEDURE calls
+#     max_time    seconds of wall time
+#     max_depth   depth of FUNCTION/PROCEDURE calls
+#     max_memory  bytes the memory of the process may grow by while running
+#
+# A program without loops and calls runs a bounded number of statements, so
+# counting steps is enough to stop a runaway program. The engines count a step
+# at each loop round and call, and only when a budget is given: without one
+# they run the same code as before. The clock and the memory size are read
+# by the step after a watchdog thread has asked for a check, which it does
+# every CHECK_PERIOD seconds while a run with a time or memory limit is going
+# on, however slow the steps are (e.g. arithmetics on huge numbers). A single
+# step is never interrupted.
+# Memory is the resident size of the process, which is approximate: it
+# includes everything else in the process, and freed memory is not always
+# returned to the system.
+#
+# A limit exceeded is reported like any other run-time error, after the
+# output printed before it.
+
+import os
+import sys
+import threading
+import time
+
+from semantics_run import RunError
+
+# Seconds between checks of the clock and the memory size
+CHECK_PERIOD = 0.01
+
+INFINITY = float('inf')
+
+try:
+    import resource
+except ImportError:  # Not on Unix
+    resource = None
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def resident_memory():
+    '''Return the resident memory size of this process in bytes: the current
+       size if /proc tells it, else the peak size, 0 if neither is known'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return 0
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class LimitExceeded(RunError):
+    '''A run-time error raised when a limit of a Budget is exceeded'''
+
+
+class Budget:
+    '''Limits of a run, None for no limit, and what has been used of them
+
+       The same Budget can be used for many runs, run_program starts it
+       again for each.'''
+
+    def __init__(self, max_steps=None, max_time=None, max_depth=None, max_memory=None):
+        self.max_steps = max_steps
+        self.max_time = max_time
+        self.max_depth = max_depth
+        self.max_memory = max_memory
+        self.stopped = None
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.depth = 0
+        self.deadline = time.monotonic() + self.max_time if self.max_time else None
+        self.memory_base = resident_memory() if self.max_memory else 0
+        self.depth_limit = INFINITY if self.max_depth is None else self.max_depth
+        self.schedule_check()
+
+    def start(self):
+        '''Start counting from zero, and checking the time and memory if they
+           are limited, until stop is called'''
+        self.stop()
+        self.reset()
+        if self.deadline is not None or self.max_memory:
+            self.stopped = threading.Event()
+            threading.Thread(target=self.watch, args=(self.stopped,), daemon=True).start()
+
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+            self.stopped = None
+
+    def watch(self, stopped):
+        '''Make the next step check the limits every CHECK_PERIOD seconds'''
+        while not stopped.wait(CHECK_PERIOD):
+            self.next_check = 0
+
+    def schedule_check(self):
+        # Without a step limit only the watchdog asks for checks
+        self.next_check = INFINITY if self.max_steps is None else self.max_steps + 1
+
+    def exceeded(self, message, lineno):
+        raise LimitExceeded("Line " + str(lineno) + ": Error: " + message)
+
+    def step(self, lineno=0):
+        '''Count a step, and check the limits when it is time to'''
+        self.steps += 1
+        if self.steps >= self.next_check:
+            self.check(lineno)
+
+    def check(self, lineno=0):
+        self.schedule_check()
+        if self.max_steps is not None and self.steps > self.max_steps:
+            self.exceeded("step limit of " + str(self.max_steps) + " exceeded", lineno)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.exceeded("time limit of " + str(self.max_time) + " s exceeded", lineno)
+        if self.max_memory and resident_memory() - self.memory_base > self.max_memory:
+            self.exceeded("memory limit of " + str(self.max_memory) + " bytes exceeded", lineno)
+
+    def enter(self, name, lineno=0):
+        '''Count a call of a FUNCTION or PROCEDURE going deeper'''
+        self.depth += 1
+        if self.depth > self.depth_limit:
+            self.exceeded("maximum recursion depth " + str(self.max_depth) + " exceeded in '"
+                          + name + "'", lineno)
+
+    def leave(self):
+        self.depth -= 1
+
+    def limited(self, max_steps):
+        '''Return a copy of the budget with at most max_steps steps'''
+        if self.max_steps is not None:
+            max_steps = min(max_steps, self.max_steps)
+        return Budget(max_steps, self.max_time, self.max_depth, self.max_memory)
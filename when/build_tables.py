@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+#
+
+# Generate the lexer and parser tables
+#
+# Run this once after installing and again after changing the token rules in
+# lexer.py or the grammar in main.py. It writes lextab.py and parsetab.pickle
+# next to this file; the interpreter only reads them.
+
+import os
+
+from ply import lex, yacc
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_tables():
+    # Remove the old tables first, lex and yacc would just read them back
+    lextab_file = os.path.join(here, 'lextab.py')
+    if os.path.exists(lextab_file):
+        os.remove(lextab_file)
+    import main
+    if os.path.exists(main.PARSER_TABLES):
+        os.remove(main.PARSER_TABLES)
+
+    lex.lex(module=main.lexer, optimize=True, lextab='lextab', outputdir=here)
+    # lexer.make_lexer uses the tables only if the rules haven't changed since
+    with open(lextab_file, 'a') as lextab:
+        lextab.write('_rules_signature = ' + repr(main.lexer.rules_signature()) + '\n')
+    yacc.yacc(module=main, debug=False, write_tables=False, picklefile=main.PARSER_TABLES)
+    print("Wrote", lextab_file, "and", main.PARSER_TABLES)
+
+
+if __name__ == '__main__':
+    build_tables()
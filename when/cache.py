@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+
+# On-disk cache of checked programs
+#
+# Parsing and checking a program gives a syntax tree with the symbol data
+# linked into it. The tree and the semantic data are stored together, pickled
+# and compressed, in a cache directory, in a file named by a hash of the
+# source, of the interpreter (the .py files of this directory and the Python
+# version) and of the options used, so a change to any of them gives a new key.
+# A later run with the same source loads the file instead of parsing and
+# checking again.
+#
+# Entries are written to a temporary file and renamed, so concurrent runs see
+# either a whole entry or none. A hit updates the modification time of the
+# entry, and when the directory grows over its size limit the entries used
+# least recently are removed. A damaged or unreadable entry is a miss.
+
+import gc
+import hashlib
+import os
+import pickle
+import sys
+import zlib
+from contextlib import contextmanager
+
+DEFAULT_MAX_SIZE = 64 * 2**20
+SUFFIX = '.whenc'
+COMPRESSION_LEVEL = 6
+
+_interpreter_hash = None
+
+
+def interpreter_hash():
+    '''Hash of the interpreter sources and the Python version'''
+    global _interpreter_hash
+    if _interpreter_hash is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha256(sys.version.encode('utf-8'))
+        for name in sorted(os.listdir(here)):
+            if name.endswith('.py'):
+                with open(os.path.join(here, name), 'rb') as infile:
+                    digest.update(name.encode('utf-8'))
+                    digest.update(infile.read())
+        _interpreter_hash = digest.digest()
+    return _interpreter_hash
+
+
+def source_key(source, options=''):
+    '''Return the cache key of a source, given as bytes, checked with
+       options that change the stored program (a string)'''
+    digest = hashlib.sha256(interpreter_hash())
+    digest.update(options.encode('utf-8') + b'\0')
+    digest.update(source)
+    return digest.hexdigest()
+
+
+@contextmanager
+def gc_paused():
+    '''Disable the garbage collector for a block
+
+       A tree is a lot of objects, none of them garbage, and collecting while
+       they are created or pickled makes it several times slower.'''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class ProgramCache:
+    '''Checked programs (syntax tree and semantic data) in a directory,
+       at most max_size bytes'''
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, key):
+        '''Return (tree, semdata) stored with key, None if there is none'''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as infile:
+                data = infile.read()
+        except OSError:
+            return None
+        try:
+            with gc_paused():
+                program = pickle.loads(zlib.decompress(data))
+        except Exception:
+            self.remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return program
+
+    def store(self, key, tree, semdata):
+        '''Store a checked program, before it is run
+
+           Returns False if it could not be stored, e.g. because the tree is
+           too deep to pickle.'''
+        try:
+            with gc_paused():
+                data = pickle.dumps((tree, semdata), pickle.HIGHEST_PROTOCOL)
+            data = zlib.compress(data, COMPRESSION_LEVEL)
+        except (RecursionError, pickle.PicklingError):
+            return False
+        path = self.path(key)
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, 'wb') as outfile:
+                outfile.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            self.remove(temp_path)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache fits in
+           max_size'''
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if entry.name.endswith(SUFFIX):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                        total += stat.st_size
+        except OSError:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+#
+
+# Columnar evaluation: one program run over many rows of input values
+#
+#     python3 columnar.py -f FILE --input ROWS.csv [--output RESULTS.csv]
+#
+# The header of the input names top-level VARs of the program. For each row
+# the program is run with those VARs bound to the values of the row (ints or
+# dates, e.g. 2101-01-05) instead of their initializers, and a VAR is checked
+# with the type of its initializer (see typecheck.py), so its values must have
+# that type. The result has one
+# column per item of each PRINT statement, holding what the item printed on
+# each row, and an error column holding the run-time error of each row.
+#
+# A program whose statements are only assignments and PRINTs of int and date
+# expressions (literals, variables, attributes, arithmetics, comparisons and
+# IF expressions, e.g. ok-area.when or ok-year-parts.when) is evaluated with
+# NumPy: each expression once for all rows, ints as int64 and dates as
+# datetime64[D] arrays. Rows where an operation fails or could overflow int64
+# (a division by zero, a date out of range, numbers of 2**62 or more) are then
+# run again one at a time with the tree engine, which gives their exact values
+# and errors. Other programs are run one row at a time, and so is every
+# program if NumPy is not installed.
+#
+# PRINT statements can't be in WHILE loops or PROCEDUREs, so that each prints
+# at most once per row. An item of a PRINT not run on a row (in an IF branch
+# not taken, or after an error) is missing from the row.
+
+import argparse
+import contextlib
+import csv
+import sys
+import time
+from datetime import date
+
+from datevalue import MAX_ORDINAL, MIN_ORDINAL, DateValue
+from memo import ARG_TYPES, DEFAULT_MEMO_SIZE, make_memo_tables
+from output import NullSink
+from semantics_run import RunError, eval_node, store_var
+from typecheck import TYPE_NAMES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Ordinal of 1970-01-01, day 0 of datetime64[D]
+EPOCH = date(1970, 1, 1).toordinal()
+# Int operands this large could overflow int64 and are left to the tree engine
+INT_LIMIT = 2**62
+
+
+class NotVectorizable(Exception):
+    '''A construct that can't be evaluated for all rows at once'''
+
+
+class Column:
+    '''The values of one PRINT item on every row
+
+       values is a NumPy array (int64, datetime64[D] or object) if NumPy is
+       installed, else a list. present[row] is false if the item was not
+       printed on the row, and values[row] is then meaningless.'''
+
+    def __init__(self, name, lineno, values, present):
+        self.name = name
+        self.lineno = lineno
+        self.values = values
+        self.present = present
+
+
+class ColumnResult:
+    '''The columns of a run, the error message of each row (None if the row
+       ran without errors) and the number of rows evaluated with NumPy'''
+
+    def __init__(self, columns, errors, vectorized):
+        self.columns = columns
+        self.errors = errors
+        self.vectorized = vectorized
+
+
+def parse_value(text):
+    '''Return the int or date written in an input cell'''
+    text = text.strip()
+    try:
+        return int(text)
+    except ValueError:
+        return DateValue.fromisoformat(text)
+
+
+def parse_column(texts):
+    '''Return the values of a column of input cells'''
+    # A column usually has values of one kind, which are parsed all at once
+    for parse in (int, DateValue.fromisoformat):
+        try:
+            return list(map(parse, texts))
+        except ValueError:
+            pass
+    values = []
+    for lineno, text in enumerate(texts, 2):
+        try:
+            values.append(parse_value(text))
+        except ValueError:
+            raise ValueError("line {}: '{}' is not an int or a date".format(lineno, text.strip()))
+    return values
+
+
+def read_inputs(infile):
+    '''Read CSV input with a header of VAR names, and return the names and a
+       list of values of each column'''
+    reader = csv.reader(infile)
+    names = [name.strip() for name in next(reader, [])]
+    rows = []
+    for lineno, row in enumerate(reader, 2):
+        if not row:
+            continue
+        if len(row) != len(names):
+            raise ValueError("line {}: {} values for {} columns".format(lineno, len(row), len(names)))
+        rows.append(row)
+    if not rows:
+        return names, [[] for name in names]
+    return names, [parse_column([text.strip() for text in texts]) for texts in zip(*rows)]
+
+
+def find_prints(tree):
+    '''Return the PRINT statements of a program in order
+
+       Raises ValueError if a PRINT is in a WHILE loop or a PROCEDURE.'''
+    for definition in tree.children_definitions:
+        if definition.nodetype == 'procedure_def' and contains_print(definition.children_statements):
+            raise ValueError("PROCEDURE " + definition.value + " has a PRINT statement")
+    prints = []
+    stack = list(reversed(tree.children_statements))
+    while stack:
+        statement = stack.pop()
+        nodetype = statement.nodetype
+        if nodetype == 'print_statement':
+            prints.append(statement)
+        elif nodetype == 'if_statement':
+            stack.extend(reversed(statement.children_if_branch + statement.children_else_branch))
+        elif nodetype == 'while_loop' and contains_print(statement.children_body):
+            raise ValueError("a WHILE loop has a PRINT statement")
+    return prints
+
+
+def contains_print(statements):
+    stack = list(statements)
+    while stack:
+        statement = stack.pop()
+        if statement.nodetype == 'print_statement':
+            return True
+        for name in ('children_body', 'children_if_branch', 'children_else_branch'):
+            stack.extend(getattr(statement, name, ()))
+    return False
+
+
+def bound_symbols(tree, semdata, names):
+    '''Return the symbol data of the top-level VARs named'''
+    top_level = {definition.value: definition.symdata for definition in tree.children_definitions
+                 if definition.nodetype == 'variable_def'}
+    symbols = []
+    for name in names:
+        if name not in top_level:
+            raise ValueError("'" + name + "' is not a top-level VAR")
+        if top_level[name] in symbols:
+            raise ValueError("'" + name + "' is bound twice")
+        symbols.append(top_level[name])
+    return symbols
+
+
+def check_input_types(names, bound, columns):
+    '''Raise ValueError if a column has a value of another type than its VAR'''
+    for name, symdata, values in zip(names, bound, columns):
+        expected = ARG_TYPES.get(symdata.valtype)
+        if expected is None or set(map(type, values)) <= {expected}:
+            continue
+        for lineno, value in enumerate(values, 2):
+            if type(value) is not expected:
+                raise ValueError("line {}: '{}' is {} VAR".format(lineno, name, TYPE_NAMES[symdata.valtype]))
+
+
+class RowRunner:
+    '''Runs a program one row at a time with the tree engine, recording the
+       values of its PRINT items instead of printing them'''
+
+    def __init__(self, tree, semdata, bound):
+        self.tree = tree
+        self.semdata = semdata
+        self.bound = bound
+        self.zeros = [0] * len(semdata.globals)
+        semdata.output = NullSink()
+        semdata.budget = None
+        semdata.memo_tables = make_memo_tables(tree, DEFAULT_MEMO_SIZE)
+
+    def run(self, row):
+        '''Run the program with the bound VARs set to the values of a row, and
+           return the items printed by each PRINT (by id) and the error'''
+        semdata = self.semdata
+        printed = dict()
+        semdata.globals[:] = self.zeros
+        values = dict(zip(map(id, self.bound), row))
+        semdata.frame = None
+        try:
+            for definition in self.tree.children_definitions:
+                if definition.nodetype == 'variable_def':
+                    if id(definition.symdata) in values:
+                        store_var(definition.symdata, values[id(definition.symdata)], semdata)
+                    else:
+                        eval_node(definition, semdata)
+            self.run_statements(self.tree.children_statements, printed)
+        except RunError as error:
+            return printed, error.message
+        except RecursionError:
+            return printed, "Line 0: Error: recursion too deep for the 'tree' engine"
+        except Exception as error:  # An error of the interpreter itself
+            return printed, "{}: {}".format(type(error).__name__, error)
+        return printed, None
+
+    def run_statements(self, statements, printed):
+        '''Run statements, and return True if a RETURN ended the program'''
+        semdata = self.semdata
+        for statement in statements:
+            nodetype = statement.nodetype
+            if nodetype == 'print_statement':
+                printed[id(statement)] = [eval_node(item, semdata)
+                                          for item in statement.children_print_items]
+            elif nodetype == 'if_statement':
+                if eval_node(statement.child_condition, semdata):
+                    branch = statement.children_if_branch
+                else:
+                    branch = statement.children_else_branch
+                if self.run_statements(branch, printed):
+                    return True
+            elif nodetype == 'return_statement':
+                eval_node(statement.child_expr, semdata)
+                return True
+            else:
+                eval_node(statement, semdata)
+        return False
+
+
+def to_datetime64(ordinal):
+    return np.datetime64(int(ordinal) - EPOCH, 'D')
+
+
+def date_attribute(attr, days):
+    '''Read an attribute of datetime64[D] dates, as int64'''
+    if attr == 'year':
+        return days.astype('datetime64[Y]').astype(np.int64) + 1970
+    if attr == 'month':
+        return days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    if attr == 'day':
+        return (days - days.astype('datetime64[M]')).astype(np.int64) + 1
+    weekday = (days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+    if attr == 'weekday':
+        return weekday
+    if attr == 'weeknum':
+        # The ISO week of a date is the week of its Thursday in that Thursday's year
+        thursday = days - weekday.astype('timedelta64[D]') + np.timedelta64(3, 'D')
+        return (thursday - thursday.astype('datetime64[Y]')).astype(np.int64) // 7 + 1
+    raise NotVectorizable("attribute '" + attr + "'")
+
+
+class VectorEvaluation:
+    '''Evaluates a program for all rows at once with NumPy
+
+       A value is a pair (kind, array), kind 'int', 'date' or 'str' (string
+       literals, which can only be printed). Scalars stand for columns of
+       equal values.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.variables = dict()  # id(symdata) -> (kind, value)
+        # Rows whose values can't be trusted and must be run one at a time
+        self.bad = np.zeros(size, dtype=bool)
+
+    def run(self, tree, bound, columns, prints):
+        '''Run a program with the bound VARs set to columns, and return the
+           (kind, value) of each item of each PRINT (by id)'''
+        for symdata, column in zip(bound, columns):
+            self.variables[id(symdata)] = self.input_column(column)
+        printed = dict()
+        with np.errstate(all='ignore'):
+            for definition in tree.children_definitions:
+                if definition.nodetype == 'variable_def' and id(definition.symdata) not in self.variables:
+                    self.variables[id(definition.symdata)] = self.evaluate(definition.child_expression)
+            for statement in tree.children_statements:
+                nodetype = statement.nodetype
+                if nodetype == 'assign' and not hasattr(statement.child_lvalue, 'child_write_attr'):
+                    self.variables[id(statement.child_lvalue.symdata)] = self.evaluate(statement.child_rvalue)
+                elif nodetype == 'print_statement':
+                    printed[id(statement)] = [self.evaluate(item) for item in statement.children_print_items]
+                else:
+                    raise NotVectorizable(nodetype)
+        return printed
+
+    def input_column(self, column):
+        if all(type(value) is int for value in column):
+            try:
+                return 'int', np.array(column, dtype=np.int64)
+            except OverflowError:
+                raise NotVectorizable("input out of int64 range")
+        if all(type(value) is DateValue for value in column):
+            return 'date', (np.array(column, dtype=np.int64) - EPOCH).astype('datetime64[D]')
+        raise NotVectorizable("input column of ints and dates")
+
+    def evaluate(self, node):
+        '''Return the (kind, value) of an expression, marking the rows it
+           fails on as bad'''
+        nodetype = node.nodetype
+        if nodetype in ('int_literal', 'date_literal', 'string_literal'):
+            value = node.value
+            if type(value) is int:
+                return 'int', np.int64(value)
+            if type(value) is DateValue:
+                return 'date', to_datetime64(value)
+            if nodetype == 'string_literal':
+                return 'str', value
+        elif nodetype == 'var':
+            if node.symdata.scope != 'global':
+                raise NotVectorizable("local variable")
+            kind, value = self.variables.get(id(node.symdata), ('int', np.int64(0)))
+            if not hasattr(node, 'child_read_attr'):
+                return kind, value
+            if kind == 'date':
+                return 'int', date_attribute(node.child_read_attr.value, value)
+        elif nodetype == 'operation':
+            return self.operation(node.value, self.evaluate(node.child_left_expr),
+                                  self.evaluate(node.child_right_expr))
+        elif nodetype == 'comparison':
+            l_kind, l_value = self.evaluate(node.child_left_expr)
+            r_kind, r_value = self.evaluate(node.child_right_expr)
+            if l_kind == r_kind and l_kind != 'str':
+                if node.value == '=':
+                    return 'int', (l_value == r_value).astype(np.int64)
+                if node.value == '<':
+                    return 'int', (l_value < r_value).astype(np.int64)
+        elif nodetype == 'if_expression':
+            c_kind, condition = self.evaluate(node.child_condition)
+            # Rows failing in the branch not taken are not bad
+            bad = self.bad
+            self.bad = np.zeros(self.size, dtype=bool)
+            if_kind, if_value = self.evaluate(node.child_if_body)
+            if_bad = self.bad
+            self.bad = np.zeros(self.size, dtype=bool)
+            else_kind, else_value = self.evaluate(node.child_else_body)
+            taken = condition != 0
+            self.bad = bad | np.where(taken, if_bad, self.bad)
+            if c_kind == 'int' and if_kind == else_kind and if_kind != 'str':
+                return if_kind, np.where(taken, if_value, else_value)
+        raise NotVectorizable(nodetype)
+
+    def operation(self, operation, left, right):
+        l_kind, l_value = left
+        r_kind, r_value = right
+        if l_kind == 'int' and r_kind == 'int':
+            self.bad |= (np.abs(l_value) >= INT_LIMIT) | (np.abs(r_value) >= INT_LIMIT)
+            if operation == '+':
+                return 'int', l_value + r_value
+            if operation == '-':
+                return 'int', l_value - r_value
+            if operation == '*':
+                product = np.abs(np.asarray(l_value, dtype=np.float64)) * np.abs(np.asarray(r_value, dtype=np.float64))
+                self.bad |= product >= INT_LIMIT
+                return 'int', l_value * r_value
+            if operation == '/':
+                zero = r_value == 0
+                self.bad |= zero
+                return 'int', np.floor_divide(l_value, np.where(zero, 1, r_value))
+        elif l_kind == 'date' and r_kind == 'int' and operation in ('+', '-'):
+            days = r_value if operation == '+' else -r_value
+            self.bad |= np.abs(days) > MAX_ORDINAL
+            days = np.where(np.abs(days) > MAX_ORDINAL, 0, days).astype('timedelta64[D]')
+            value = l_value + days
+            self.bad |= (value < to_datetime64(MIN_ORDINAL)) | (value > to_datetime64(MAX_ORDINAL))
+            return 'date', value
+        elif l_kind == 'date' and r_kind == 'date' and operation == '-':
+            return 'int', (l_value - r_value).astype(np.int64)
+        raise NotVectorizable("operation '" + operation + "' on " + l_kind + " and " + r_kind)
+
+
+def column_names(prints):
+    '''Return the name and line of each PRINT item column'''
+    return [("print{}.{}".format(k, j), statement.lineno)
+            for k, statement in enumerate(prints, 1)
+            for j in range(1, len(statement.children_print_items) + 1)]
+
+
+def make_array(values, present):
+    '''Return a NumPy array of Python values: int64 or datetime64[D] if they
+       all fit, else object'''
+    kinds = set(type(value) for value, here in zip(values, present) if here)
+    if kinds == {int}:
+        try:
+            return np.array([value if here else 0 for value, here in zip(values, present)], dtype=np.int64)
+        except OverflowError:
+            pass
+    elif kinds == {DateValue}:
+        return (np.array([value if here else EPOCH for value, here in zip(values, present)],
+                         dtype=np.int64) - EPOCH).astype('datetime64[D]')
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def store_value(array, row, value):
+    '''Store a Python value in a column array, and return the array (a new
+       one of object dtype if the value doesn't fit)'''
+    if array.dtype.kind == 'M':
+        if type(value) is DateValue:
+            array[row] = to_datetime64(value)
+            return array
+    elif array.dtype.kind == 'i':
+        if type(value) is int and -2**63 <= value < 2**63:
+            array[row] = value
+            return array
+    else:
+        array[row] = value
+        return array
+    array = array.astype(object)
+    array[row] = value
+    return array
+
+
+def from_numpy(kind, value):
+    '''A Python value of the interpreter for a NumPy value'''
+    if kind == 'date':
+        return DateValue(int(value.astype(np.int64)) + EPOCH)
+    if kind == 'int':
+        return int(value)
+    return value
+
+
+def run_columns(tree, semdata, names, columns, use_numpy=True):
+    '''Run a checked program once for each row of the input columns, with the
+       top-level VARs named bound to their values, and return a ColumnResult'''
+    prints = find_prints(tree)
+    bound = bound_symbols(tree, semdata, names)
+    check_input_types(names, bound, columns)
+    size = len(columns[0]) if columns else 1
+    names = column_names(prints)
+    errors = [None] * size
+    rows = list(zip(*columns)) if columns else [()]
+
+    printed = None
+    if np is not None and use_numpy and size:
+        evaluation = VectorEvaluation(size)
+        try:
+            printed = evaluation.run(tree, bound, columns, prints)
+        except NotVectorizable:
+            printed = None
+    if printed is None:
+        # Every row one at a time
+        runner = RowRunner(tree, semdata, bound)
+        results = [runner.run(row) for row in rows]
+        errors = [error for items, error in results]
+        result_columns = []
+        index = 0
+        for statement in prints:
+            for j in range(len(statement.children_print_items)):
+                present = [id(statement) in items for items, error in results]
+                values = [items[id(statement)][j] if here else None
+                          for (items, error), here in zip(results, present)]
+                if np is not None:
+                    values = make_array(values, present)
+                    present = np.array(present, dtype=bool)
+                result_columns.append(Column(*names[index], values, present))
+                index += 1
+        return ColumnResult(result_columns, errors, 0)
+
+    result_columns = []
+    index = 0
+    for statement in prints:
+        for kind, value in printed[id(statement)]:
+            if kind == 'str':
+                values = np.full(size, value, dtype=object)
+            else:
+                values = np.broadcast_to(value, (size,)).copy()
+            result_columns.append(Column(*names[index], values, np.ones(size, dtype=bool)))
+            index += 1
+    bad_rows = np.flatnonzero(evaluation.bad)
+    if len(bad_rows):
+        runner = RowRunner(tree, semdata, bound)
+        for row in bad_rows:
+            items, errors[row] = runner.run(rows[row])
+            index = 0
+            for statement in prints:
+                for j in range(len(statement.children_print_items)):
+                    column = result_columns[index]
+                    column.present[row] = id(statement) in items
+                    if column.present[row]:
+                        column.values = store_value(column.values, row, items[id(statement)][j])
+                    index += 1
+    return ColumnResult(result_columns, errors, size - len(bad_rows))
+
+
+def column_texts(column):
+    '''Return the values of a column as printed, '' where missing'''
+    values = column.values
+    if np is not None:
+        if values.dtype.kind == 'M':
+            texts = np.datetime_as_string(values).tolist()
+        else:
+            texts = values.astype(str).tolist()
+    else:
+        texts = list(map(str, values))
+    return [text if here else '' for text, here in zip(texts, column.present)]
+
+
+def write_columns(result, outfile):
+    '''Write a ColumnResult as CSV, a missing value as an empty cell'''
+    writer = csv.writer(outfile, lineterminator='\n')
+    writer.writerow([column.name for column in result.columns] + ['error'])
+    texts = [column_texts(column) for column in result.columns]
+    texts.append([error or '' for error in result.errors])
+    writer.writerows(zip(*texts))
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(
+        description='run a When program once for each row of input values, writing one column per PRINT item')
+    argParser.add_argument('-f', '--file', required=True, help='program to run')
+    argParser.add_argument('--input', required=True, metavar='FILE',
+                           help="CSV file whose header names top-level VARs ('-' for stdin)")
+    argParser.add_argument('--output', metavar='FILE', help='write the results to a file instead of stdout')
+    argParser.add_argument('--no-numpy', action='store_true', help='run every row one at a time')
+    argParser.add_argument('--no-optimize', action='store_true', help='run the program as written')
+    ns = argParser.parse_args()
+
+    import lexer
+    import main
+    from semantics_common import SemData
+    from symtbl_semantics_check import semantic_checks
+    with open(ns.file, encoding='utf-8') as infile:
+        data = infile.read()
+    tree = main.make_parser().parse(data, lexer=lexer.lexer)
+    semdata = SemData()
+    semantic_checks(tree, semdata)
+    if not ns.no_optimize:
+        from optimize import optimize
+        optimize(tree, semdata)
+
+    try:
+        with (contextlib.nullcontext(sys.stdin) if ns.input == '-'
+              else open(ns.input, encoding='utf-8', newline='')) as infile:
+            names, columns = read_inputs(infile)
+        start = time.perf_counter()
+        result = run_columns(tree, semdata, names, columns, not ns.no_numpy)
+    except ValueError as error:
+        argParser.error(str(error))
+    elapsed = time.perf_counter() - start
+    with (open(ns.output, 'w', encoding='utf-8', newline='') if ns.output
+          else contextlib.nullcontext(sys.stdout)) as outfile:
+        write_columns(result, outfile)
+    rows = len(result.errors)
+    print("{} rows in {:.3f} s: {} evaluated with NumPy, {} one at a time, {} errors".format(
+        rows, elapsed, result.vectorized, rows - result.vectorized,
+        sum(error is not None for error in result.errors)), file=sys.stderr)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#
+
+# Runtime representation of When dates
+#
+# A date is carried through the interpreter as its proleptic Gregorian
+# ordinal (0001-01-01 is day 1). Date arithmetics is then plain integer
+# arithmetics, and a datetime.date is only built when an attribute is read
+# or written, or when the date is printed.
+
+from datetime import date
+
+MIN_ORDINAL = date.min.toordinal()
+MAX_ORDINAL = date.max.toordinal()
+
+
+class DateValue(int):
+    '''A When date, i.e. an int holding the proleptic ordinal of the date'''
+    __slots__ = ()
+
+    @classmethod
+    def from_date(cls, value):
+        return cls(value.toordinal())
+
+    @classmethod
+    def fromisoformat(cls, text):
+        return cls(date.fromisoformat(text).toordinal())
+
+    @classmethod
+    def today(cls):
+        return cls(date.today().toordinal())
+
+    def to_date(self):
+        return date.fromordinal(self)
+
+    def __str__(self):
+        return date.fromordinal(self).isoformat()
+
+    def __repr__(self):
+        return "DateValue(" + str(self) + ")"
+
+
+def add_days(value, days):
+    '''Return the date `days` days after `value`, or None if it is out of range'''
+    ordinal = value + days
+    if MIN_ORDINAL <= ordinal <= MAX_ORDINAL:
+        return DateValue(ordinal)
+    return None
+
+
+def read_attribute(value, attr):
+    '''Read attribute year/month/day/weekday/weeknum of a date, None if unknown'''
+    parent = date.fromordinal(value)
+    if attr == 'year':
+        return parent.year
+    elif attr == 'month':
+        return parent.month
+    elif attr == 'day':
+        return parent.day
+    elif attr == 'weekday':
+        return parent.weekday()
+    elif attr == 'weeknum':
+        return parent.isocalendar()[1]
+    return None
+
+
+def write_attribute(value, attr, new_value):
+    '''Return a copy of a date with attribute year/month/day replaced
+
+       Raises ValueError if the resulting date does not exist.'''
+    parent = date.fromordinal(value)
+    if attr == 'year':
+        modified = parent.replace(year=new_value)
+    elif attr == 'month':
+        modified = parent.replace(month=new_value)
+    elif attr == 'day':
+        modified = parent.replace(day=new_value)
+    else:
+        raise ValueError("'" + attr + "' is not a writable attribute")
+    return DateValue(modified.toordinal())
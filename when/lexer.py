@@ -1,5 +1,4 @@
-import ply.lex as lex
-from datetime import date
+from datevalue import DateValue
 
 reserved = {'VAR', 'IS', 'IF', 'THEN', 
     'ELSE', 'ENDIF', 
@@ -47,7 +46,7 @@ def t_STRING(t):
 def t_DATE_LITERAL(t):
     r'\d{4}-\d{2}-\d{2}' # e.g. 2018-09-27
     try: 
-        t.value = date.fromisoformat(str(t.value))
+        t.value = DateValue.fromisoformat(str(t.value))
         return t
     except:
         raise Exception("Incorrect date at line {}: {}".format(t.lexer.lineno, t.value))
@@ -86,10 +85,47 @@ def t_whitespace(t):
 def t_error(t):
     raise Exception("Illegal character '{}' at line {}".format(t.value[0], t.lexer.lineno))
 
-lexer = lex.lex() # debug=1 for extra info
+def rules_signature():
+    '''Return a hash of the tokens and the rules above, which build_tables.py
+    stores in lextab.py
+
+    The rules are the regexes of the string rules and, in the order they are
+    tried, the names and regexes of the function rules.'''
+    import hashlib
+    rules = globals()
+    functions = sorted((value for name, value in rules.items() if name.startswith('t_') and callable(value)),
+                       key=lambda function: function.__code__.co_firstlineno)
+    strings = sorted((name, value) for name, value in rules.items()
+                     if name.startswith('t_') and isinstance(value, str))
+    text = repr((sorted(tokens), sorted(reserved), strings,
+                 [(function.__name__, function.__doc__) for function in functions]))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def make_lexer():
+    '''Return a lexer using the tables in lextab.py (see build_tables.py)
+    if they exist and were made from the rules above, otherwise a lexer
+    built from the rules'''
+    import ply.lex as lex
+    try:
+        import lextab
+    except ImportError:
+        lextab = None
+    if lextab is None or getattr(lextab, '_rules_signature', None) != rules_signature():
+        return lex.lex() # debug=1 for extra info
+    return lex.lex(optimize=True, lextab=lextab)
+
+def __getattr__(name):
+    # The lexer is made when it is first used, so that importing the token
+    # rules (e.g. for a cached program, see cache.py) doesn't import ply
+    if name == 'lexer':
+        global lexer
+        lexer = make_lexer()
+        return lexer
+    raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
 
 if __name__ == '__main__':
     import argparse, codecs
+    lexer = make_lexer()
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--who', action='store_true', help='who wrote this' )
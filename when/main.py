@@ -1,21 +1,20 @@
-import ply.yacc as yacc
-import ply.lex as lex
+import os
 import lexer
 import tree_print
+from ast_nodes import (ASTnode, Assign, Comparison, DateLiteral, FormalArg, FuncCall,
+                       FunctionDef, IfExpression, IfStatement, IntLiteral, Operation,
+                       PrintStatement, ProcCall, ProcedureDef, Program, ReadAttribute,
+                       ReturnStatement, StringLiteral, Var, VariableDef, WhileLoop,
+                       WriteAttribute)
 
 
 tokens = lexer.tokens
 
 
-class ASTnode:
-    def __init__(self, typestr):
-        self.nodetype = typestr
-
-
 def p_program(p):
     '''program : opt_definitions statement_list
                | statement_list'''
-    p[0] = ASTnode("program")
+    p[0] = Program()
     if len(p) == 3:
         p[0].children_definitions = p[1]
         p[0].children_statements = p[2]
@@ -63,7 +62,7 @@ def p_opt_definitions(p):
 
 def p_variable_definition(p):
     '''variable_definition : VAR IDENT IS expression'''
-    p[0] = ASTnode("variable_def")
+    p[0] = VariableDef()
     p[0].value = p[2]
     p[0].child_expression = p[4]
     p[0].lineno = p.lineno(1)
@@ -90,7 +89,7 @@ def p_variable_definition_list(p):
 
 def p_function_definition(p):
     '''function_definition : FUNCTION FUNC_IDENT LCURLY opt_formals RCURLY RETURN IDENT opt_variable_defs IS rvalue END FUNCTION'''
-    p[0] = ASTnode("function_def")
+    p[0] = FunctionDef()
     p[0].value = p[2]
     p[0].children_formals = p[4]
     p[0].children_variable_defs = p[8]
@@ -102,7 +101,7 @@ def p_function_definition(p):
 def p_procedure_definition(p):
     '''procedure_definition : PROCEDURE PROC_IDENT LCURLY opt_formals RCURLY RETURN IDENT opt_variable_defs IS statement_list END PROCEDURE
                             | PROCEDURE PROC_IDENT LCURLY opt_formals RCURLY opt_variable_defs IS statement_list END PROCEDURE'''
-    p[0] = ASTnode("procedure_def")
+    p[0] = ProcedureDef()
     p[0].value = p[2]
     p[0].children_formals = p[4]
     if len(p) == 11:
@@ -138,7 +137,7 @@ def p_opt_formals2(p):
 
 def p_formal_arg(p):
     '''formal_arg : IDENT LSQUARE IDENT RSQUARE'''
-    p[0] = ASTnode("formal_arg")
+    p[0] = FormalArg()
     p[0].value = p[1]
     p[0].type = p[3]
     p[0].lineno = p.lineno(1)
@@ -147,7 +146,7 @@ def p_formal_arg(p):
 def p_procedure_call(p):
     '''procedure_call : PROC_IDENT LPAREN arguments RPAREN
                       | PROC_IDENT LPAREN RPAREN'''
-    p[0] = ASTnode("proc_call")
+    p[0] = ProcCall()
     p[0].lineno = p.lineno(1)
     p[0].value = p[1]
     if len(p) == 5:
@@ -168,7 +167,7 @@ def p_arguments(p):
 
 def p_assignment(p):
     '''assignment : lvalue ASSIGN rvalue'''
-    p[0] = ASTnode("assign")
+    p[0] = Assign()
     p[0].child_lvalue = p[1]
     p[0].child_rvalue = p[3]
 
@@ -176,11 +175,11 @@ def p_assignment(p):
 def p_lvalue(p):
     '''lvalue : IDENT
               | IDENT DOT IDENT'''
-    p[0] = ASTnode("var")
+    p[0] = Var()
     p[0].value = p[1]
     p[0].lineno = p.lineno(1)
     if len(p) == 4:
-        p[0].child_write_attr = ASTnode("write_attribute")
+        p[0].child_write_attr = WriteAttribute()
         p[0].child_write_attr.lineno = p[0].lineno
         p[0].child_write_attr.value = p[3]
 
@@ -193,7 +192,7 @@ def p_rvalue(p):
 
 def p_print_statement(p):
     '''print_statement : PRINT print_list'''
-    p[0] = ASTnode("print_statement")
+    p[0] = PrintStatement()
     p[0].lineno = p.lineno(1)
     p[0].children_print_items = p[2]
 
@@ -205,7 +204,7 @@ def p_print_item1(p):
 
 def p_print_item2(p):
     '''print_item : STRING'''
-    p[0] = ASTnode("string_literal")
+    p[0] = StringLiteral()
     p[0].value = p[1]
 
 
@@ -227,14 +226,14 @@ def p_statement1(p):
     if len(p) == 2:  # pass
         p[0] = p[1]
     if len(p) == 3:  # Return statement
-        p[0] = ASTnode("return_statement")
+        p[0] = ReturnStatement()
         p[0].lineno = p.lineno(1)
         p[0].child_expr = p[2]
 
 
 def p_statement2(p):
     '''statement : WHILE expression DO statement_list ENDWHILE'''
-    p[0] = ASTnode("while_loop")
+    p[0] = WhileLoop()
     p[0].child_condition = p[2]
     p[0].children_body = p[4]
 
@@ -242,7 +241,7 @@ def p_statement2(p):
 def p_statement3(p):
     '''statement : IF expression THEN statement_list ELSE statement_list ENDIF
                  | IF expression THEN statement_list ENDIF'''
-    p[0] = ASTnode("if_statement")
+    p[0] = IfStatement()
     p[0].child_condition = p[2]
     p[0].children_if_branch = p[4]
     if len(p) == 8:
@@ -258,7 +257,7 @@ def p_expression(p):
     if len(p) == 2:
         p[0] = p[1]
     else:
-        p[0] = ASTnode("comparison")
+        p[0] = Comparison()
         p[0].child_left_expr = p[1]
         p[0].value = p[2]
         p[0].child_right_expr = p[3]
@@ -272,7 +271,7 @@ def p_simple_expr1(p):
 def p_simple_expr2(p):
     '''simple_expr : simple_expr PLUS term
                    | simple_expr MINUS term'''
-    p[0] = ASTnode("operation")
+    p[0] = Operation()
     p[0].lineno = p[1].lineno if hasattr(p[1], "lineno") else 0
     p[0].child_left_expr = p[1]
     p[0].value = p[2]
@@ -287,7 +286,7 @@ def p_term1(p):
 def p_term2(p):
     '''term : term MULT factor
             | term DIV factor'''
-    p[0] = ASTnode("operation")
+    p[0] = Operation()
     p[0].lineno = p[1].lineno
     p[0].child_left_expr = p[1]
     p[0].value = p[2]
@@ -318,25 +317,25 @@ def p_atom1(p):
 def p_atom2(p):
     '''atom : IDENT
             | IDENT APOSTROPHE IDENT'''
-    p[0] = ASTnode("var")
+    p[0] = Var()
     p[0].value = p[1]
     p[0].lineno = p.lineno(1)
     if len(p) > 2:
-        p[0].child_read_attr = ASTnode("read_attribute")
+        p[0].child_read_attr = ReadAttribute()
         p[0].child_read_attr.lineno = p[0].lineno
         p[0].child_read_attr.value = p[3]
 
 
 def p_atom3(p):
     '''atom : INT_LITERAL'''
-    p[0] = ASTnode("int_literal")
+    p[0] = IntLiteral()
     p[0].value = p[1]
     p[0].lineno = p.lineno(1)
 
 
 def p_atom4(p):
     '''atom : DATE_LITERAL'''
-    p[0] = ASTnode("date_literal")
+    p[0] = DateLiteral()
     p[0].value = p[1]
     p[0].lineno = p.lineno(1)
 
@@ -344,7 +343,7 @@ def p_atom4(p):
 def p_function_call(p):
     '''function_call : FUNC_IDENT LPAREN arguments RPAREN
                      | FUNC_IDENT LPAREN RPAREN'''
-    p[0] = ASTnode("func_call")
+    p[0] = FuncCall()
     p[0].value = p[1]
     p[0].lineno = p.lineno(1)
     if len(p) == 5:
@@ -355,7 +354,7 @@ def p_function_call(p):
 
 def p_if_expression(p):
     '''if_expression : IF expression THEN expression ELSE expression ENDIF'''
-    p[0] = ASTnode("if_expression")
+    p[0] = IfExpression()
     p[0].child_condition = p[2]
     p[0].child_if_body = p[4]
     p[0].child_else_body = p[6]
@@ -371,37 +370,165 @@ def p_error(p):
     raise SystemExit
 
 
-parser = yacc.yacc()
+# Parser tables made by build_tables.py
+PARSER_TABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parsetab.pickle')
+
+
+def make_parser():
+    '''Return a parser using the tables in PARSER_TABLES
+
+       The tables are used only if their signature matches the grammar above.
+       Otherwise (or if there are no tables) the parser is built in memory.
+       No files are written in either case.'''
+    import ply.yacc as yacc
+    pinfo = yacc.ParserReflect(globals())
+    pinfo.get_all()
+    tables = yacc.LRTable()
+    try:
+        signature = tables.read_pickle(PARSER_TABLES)
+    except (ImportError, yacc.VersionError):
+        signature = None
+    if signature == pinfo.signature():
+        tables.bind_callables(pinfo.pdict)
+        return yacc.LRParser(tables, pinfo.error_func)
+    return yacc.yacc(debug=False, write_tables=False, errorlog=yacc.NullLogger())
+
+
+def __getattr__(name):
+    # The parser is made when it is first used (from main import parser), so
+    # that a cached program (see cache.py) is run without importing ply
+    if name == 'parser':
+        global parser
+        parser = make_parser()
+        return parser
+    raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
 
 if __name__ == '__main__':
     import argparse
-    import codecs
+    from output import FileSink, parse_flush_policy
     argParser = argparse.ArgumentParser()
     argParser.add_argument(
-        '-t', '--treetype', help='type of output tree (unicode/ascii/dot)')
+        '-t', '--treetype', choices=tree_print.tree_formats,
+        help='print the syntax tree before running the program, in this format')
+    argParser.add_argument(
+        '--tree-output', metavar='FILE',
+        help='write the syntax tree to a file instead of stdout (unicode unless --treetype is given)')
 
     argParser.add_argument('-d', '--debug', action='store_true', help='debug?')
+    argParser.add_argument(
+        '-e', '--engine', choices=['closure', 'tree', 'vm', 'python'], default='closure',
+        help='execution engine (closure = compiled closures, tree = AST walker, vm = bytecode VM, '
+             'python = translated to Python source)')
+    argParser.add_argument(
+        '--dis', action='store_true', help='print the bytecode of the program before running it')
+    argParser.add_argument(
+        '--emit-python', metavar='FILE',
+        help="write the program translated to Python to a file ('-' for stdout) before running it")
+    argParser.add_argument(
+        '--memo-size', type=int, default=4096,
+        help='results memoized per pure function (0 disables memoization)')
+    argParser.add_argument(
+        '--max-depth', type=int, default=None,
+        help='maximum depth of function/procedure calls '
+             '(default 1000000 in the vm engine, Python\'s recursion limit in the others)')
+    argParser.add_argument(
+        '--max-steps', type=int, default=None,
+        help='stop the program after this many loop rounds and function/procedure calls')
+    argParser.add_argument(
+        '--max-time', type=float, default=None, help='stop the program after this many seconds')
+    argParser.add_argument(
+        '--max-memory', type=float, default=None,
+        help='stop the program when the interpreter has grown by this many megabytes')
+    argParser.add_argument(
+        '--memo-stats', action='store_true', help='print memoization counters after running')
+    argParser.add_argument(
+        '--profile', action='store_true',
+        help='print where the program spends its time, by node type, line and function (closure and tree engines)')
+    argParser.add_argument(
+        '--no-optimize', action='store_true',
+        help='run the program as written, without folding constants')
+    argParser.add_argument(
+        '--stats', action='store_true', help='print how many nodes were optimized away after running')
+    argParser.add_argument(
+        '--lexer', choices=['ply', 'scanner'], default='ply',
+        help='lexer (ply = lexer.py, scanner = master regex scanner over the mmapped file)')
+    argParser.add_argument(
+        '--watch', action='store_true',
+        help='run the program again whenever the file changes, reparsing and rechecking only what changed')
+
+    argParser.add_argument(
+        '--output', metavar='FILE', help='write the output of the program to a file instead of stdout')
+    argParser.add_argument(
+        '--flush', type=parse_flush_policy,
+        help="when output is flushed: 'line', 'exit' or after a number of characters "
+             "(default 'line' on a terminal, otherwise 65536)")
+
+    argParser.add_argument(
+        '--cache-dir',
+        help='directory for caching checked programs, which are then loaded instead of parsed and checked again')
+    argParser.add_argument(
+        '--cache-size', type=float, default=64,
+        help='size limit of the cache directory in megabytes (default 64)')
 
     group = argParser.add_mutually_exclusive_group()
     group.add_argument('--who', action='store_true', help='who wrote this')
     group.add_argument('-f', '--file', help='filename to process')
     ns = argParser.parse_args()
+    if ns.max_depth is not None and ns.max_depth < 0:
+        argParser.error("--max-depth can't be negative")
+    if ns.profile and ns.engine in ('vm', 'python'):
+        argParser.error("the " + ns.engine + " engine can't be profiled, use -e closure or -e tree")
 
     Debug = True if ns.debug else False
 
-    outFormat = "unicode"
-    if ns.treetype:
-        outFormat = ns.treetype
+    budget = None
+    if any(limit is not None for limit in (ns.max_depth, ns.max_steps, ns.max_time, ns.max_memory)):
+        from budget import Budget
+        budget = Budget(ns.max_steps, ns.max_time, ns.max_depth,
+                        None if ns.max_memory is None else int(ns.max_memory * 2**20))
+    max_depth = 1000000 if ns.max_depth is None else ns.max_depth
+
+    outFormat = ns.treetype
+    if ns.tree_output and not outFormat:
+        outFormat = "unicode"
     if ns.who == True:
         # identify who wrote this
         print('Jaakko Hirvelä')
     elif ns.file is None:
         # user didn't provide input filename
         argParser.print_help()
+    elif ns.watch:
+        from watch import watch
+        watch(ns.file, ns.engine, ns.memo_size, max_depth, budget=budget)
     else:
-        data = codecs.open(ns.file, encoding='utf-8').read()
-        syntax_tree = parser.parse(data, lexer=lexer.lexer, debug=Debug)
-        tree_print.treeprint(syntax_tree, outFormat)
+        cache = None
+        cached = None
+        if ns.cache_dir:
+            from cache import ProgramCache, source_key
+            cache = ProgramCache(ns.cache_dir, int(ns.cache_size * 2**20))
+            with open(ns.file, 'rb') as infile:
+                key = source_key(infile.read(), 'no-optimize' if ns.no_optimize else '')
+            # The tree is printed as parsed, a cached tree has been optimized
+            if not outFormat:
+                cached = cache.load(key)
+
+        if cached is not None:
+            syntax_tree, semdata = cached
+        else:
+            parser = make_parser()
+            if ns.lexer == 'scanner':
+                from scanner import Scanner, open_source
+                with open_source(ns.file) as data:
+                    syntax_tree = parser.parse(data, lexer=Scanner(), debug=Debug)
+            else:
+                with open(ns.file, encoding='utf-8') as infile:
+                    data = infile.read()
+                syntax_tree = parser.parse(data, lexer=lexer.lexer, debug=Debug)
+        if ns.tree_output:
+            with open(ns.tree_output, 'w', encoding='utf-8') as treefile:
+                tree_print.treeprint(syntax_tree, outFormat, treefile)
+        elif outFormat:
+            tree_print.treeprint(syntax_tree, outFormat)
         if syntax_tree is None:
             print('syntax OK')
 
@@ -410,7 +537,45 @@ if __name__ == '__main__':
         from semantics_run import run_program
         from semantics_common import SemData
 
-        semdata = SemData()
-        semantic_checks(syntax_tree, semdata)
-        run_program(syntax_tree, semdata)
+        if cached is None:
+            semdata = SemData()
+            semantic_checks(syntax_tree, semdata)
+            if not ns.no_optimize:
+                from optimize import optimize
+                optimize(syntax_tree, semdata)
+            if cache is not None:
+                cache.store(key, syntax_tree, semdata)
+        if ns.dis:
+            from semantics_vm import compile_bytecode, disassemble
+            disassemble(compile_bytecode(syntax_tree, semdata))
+        if ns.emit_python:
+            from memo import make_memo_tables
+            from transpile import transpile
+            source = transpile(syntax_tree, semdata, make_memo_tables(syntax_tree, ns.memo_size))
+            if ns.emit_python == '-':
+                print(source)
+            else:
+                with open(ns.emit_python, 'w', encoding='utf-8') as outfile:
+                    outfile.write(source)
+        profile = None
+        if ns.profile:
+            from profiler import Profile
+            profile = Profile()
+        if ns.output:
+            with open(ns.output, 'w', encoding='utf-8') as outfile:
+                run_program(syntax_tree, semdata, ns.engine, ns.memo_size, max_depth,
+                            FileSink(outfile, ns.flush), profile, budget)
+        else:
+            run_program(syntax_tree, semdata, ns.engine, ns.memo_size, max_depth,
+                        FileSink(flush=ns.flush), profile, budget)
+        if ns.memo_stats:
+            from memo import print_memo_stats
+            print_memo_stats(semdata)
+        if ns.stats:
+            from optimize import print_optimize_stats
+            print_optimize_stats(semdata)
+        if profile is not None:
+            from profiler import print_profile
+            with open(ns.file, encoding='utf-8') as infile:
+                print_profile(profile, infile.read().splitlines())
         # print_symbol_table(semdata, 'Symbol table after:')
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+
+# Automatic memoization of pure FUNCTIONs
+#
+# A FUNCTION is pure if its result depends only on its arguments: it does not
+# read global variables, call Today() or PROCEDUREs, and calls only pure
+# FUNCTIONs. Calls to pure FUNCTIONs can be served from a per-function memo
+# table, which keeps at most a given number of results and evicts the least
+# recently used one when full.
+
+from collections import OrderedDict
+from datevalue import DateValue
+
+DEFAULT_MEMO_SIZE = 4096
+
+ARG_TYPES = {'int': int, 'date': DateValue}
+
+# Returned by MemoTable.lookup when the result is not in the table
+MISSING = object()
+
+
+# The analysis is run as a semantic check (see symtbl_semantics_check.CHECKS):
+# while a function_def is visited, impure nodes and calls to other FUNCTIONs
+# in it are recorded, and mark_pure_functions sets attribute pure of every
+# function_def node once the whole tree is visited.
+
+def init_purity(semdata):
+    semdata.purity_function = None  # name of the FUNCTION being visited
+    semdata.impure_functions = set()
+    semdata.callees = dict()  # FUNCTION name -> names of FUNCTIONs it calls
+
+
+def purity_before(node, semdata):
+    nodetype = node.nodetype
+    name = semdata.purity_function
+    if nodetype == 'function_def':
+        semdata.purity_function = node.value
+        semdata.callees[node.value] = set()
+    elif name is None:
+        return None
+    elif nodetype == 'proc_call' or (nodetype == 'func_call' and node.value == 'Today'):
+        semdata.impure_functions.add(name)
+    elif nodetype == 'func_call':
+        semdata.callees[name].add(node.value)
+    elif nodetype == 'var' and node.symdata.scope == 'global':
+        semdata.impure_functions.add(name)
+
+
+def purity_after(node, semdata):
+    if node.nodetype == 'function_def':
+        semdata.purity_function = None
+
+
+def mark_pure_functions(semdata):
+    '''Set attribute pure of every function_def node'''
+    impure = semdata.impure_functions
+    # A function calling an impure function is impure too
+    changed = True
+    while changed:
+        changed = False
+        for name, called in semdata.callees.items():
+            if name not in impure and not called.isdisjoint(impure):
+                impure.add(name)
+                changed = True
+
+    for symdata in semdata.symtbl.values():
+        if symdata.symtype == 'func':
+            symdata.defnode.pure = symdata.defnode.value not in impure
+
+
+class MemoTable:
+    '''Results of a pure FUNCTION, keyed by argument values, with LRU eviction'''
+
+    def __init__(self, name, arg_types, max_size=DEFAULT_MEMO_SIZE):
+        self.name = name
+        self.arg_types = arg_types
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, args):
+        '''Return the key for a list of argument values
+
+           None is returned if the values don't have the declared types of
+           the formals (an int and a date with the same ordinal are equal
+           in Python), and such a call must not use the table.'''
+        for value, arg_type in zip(args, self.arg_types):
+            if type(value) is not arg_type:
+                return None
+        return tuple(args)
+
+    def lookup(self, key):
+        result = self.entries.get(key, MISSING)
+        if result is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return result
+
+    def store(self, key, result):
+        entries = self.entries
+        entries[key] = result
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+
+def make_memo_tables(tree, max_size=DEFAULT_MEMO_SIZE):
+    '''Return a dict of memo tables for the pure FUNCTIONs of a checked tree
+
+       max_size is the number of results kept per FUNCTION, 0 disables memoization.'''
+    tables = dict()
+    if max_size <= 0:
+        return tables
+    for definition in tree.children_definitions:
+        if definition.nodetype == 'function_def' and definition.pure:
+            arg_types = [ARG_TYPES.get(formal.type) for formal in definition.children_formals]
+            tables[definition.value] = MemoTable(definition.value, arg_types, max_size)
+    return tables
+
+
+def print_memo_stats(semdata):
+    '''Print the counters of the memo tables used in the last run'''
+    print("Memoized functions:")
+    if not semdata.memo_tables:
+        print("  (none)")
+    for memo in semdata.memo_tables.values():
+        print("  {}: {}/{} entries, {} hits, {} misses, {} evictions".format(
+            memo.name, len(memo.entries), memo.max_size, memo.hits, memo.misses, memo.evictions))
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+#
+
+# Optimizations of a checked syntax tree
+#
+# fold_constants evaluates arithmetics and comparisons whose operands are int
+# or date literals, and replaces them with a literal of the result. An IF
+# statement or expression with a constant condition is replaced with the
+# branch taken, and a WHILE loop whose condition is constant false is removed.
+# Operations that would fail at run time (division by zero, a date out of
+# range, an operation undefined for the types) are left for the run time to
+# report, and so are results that could not be written as a literal (at least
+# 2**42, see lexer.t_INT_LITERAL).
+#
+# hoist_invariants then finds the expressions in WHILE loops whose value
+# doesn't change while the loop runs, and wraps them in loop_invariant nodes.
+# Such an expression is evaluated when it is first needed after the loop has
+# started, and its value is kept in a temporary for the rest of the loop. As
+# the first evaluation happens where it did before, errors are reported at the
+# same point, and an expression the loop never reaches is never evaluated.
+
+from collections import Counter
+
+from ast_nodes import DateLiteral, IntLiteral, LoopInvariant
+from datevalue import DateValue, add_days
+from semantics_common import SymbolData
+
+# Int literals must be less than this
+INT_LIMIT = 2**42
+
+# What the counters in semdata.optimize_stats mean
+STATS = [
+    ('operations', 'constant operations folded'),
+    ('comparisons', 'constant comparisons folded'),
+    ('if_expressions', 'IF expressions with a constant condition'),
+    ('if_statements', 'IF statements with a constant condition'),
+    ('while_loops', 'WHILE loops never run removed'),
+    ('invariants', 'loop invariants hoisted'),
+]
+
+STATEMENT_LISTS = ('children_statements', 'children_body',
+                   'children_if_branch', 'children_else_branch')
+# Expressions that take more than loading a value, and are worth hoisting
+HOISTED_TYPES = ('operation', 'comparison', 'if_expression', 'func_call')
+
+
+def constant_value(node):
+    '''Return the value of an int or date literal, None for other nodes
+
+       (A literal after a unary minus or plus has the sign as its value, see
+       main.p_factor, and is not constant here.)'''
+    nodetype = node.nodetype
+    if nodetype == 'int_literal' and type(node.value) is int:
+        return node.value
+    if nodetype == 'date_literal' and type(node.value) is DateValue:
+        return node.value
+    return None
+
+
+def fold_arithmetics(operation, l_value, r_value):
+    '''The result of semantics_run.arithmetics, None if it raises an error'''
+    if type(l_value) is DateValue and type(r_value) is int:
+        if operation == '+':
+            return add_days(l_value, r_value)
+        if operation == '-':
+            return add_days(l_value, -r_value)
+    elif type(l_value) is DateValue and type(r_value) is DateValue:
+        if operation == '-':
+            return int(l_value) - int(r_value)
+    elif type(l_value) is int and type(r_value) is int:
+        if operation == '*':
+            return l_value * r_value
+        if operation == '+':
+            return l_value + r_value
+        if operation == '-':
+            return l_value - r_value
+        if operation == '/' and r_value != 0:
+            return l_value // r_value
+    return None
+
+
+def fold_comparison(comparison, l_value, r_value):
+    if comparison == '=':
+        return 1 if l_value == r_value else 0
+    if comparison == '<':
+        return 1 if l_value < r_value else 0
+    return None
+
+
+def make_literal(value, node):
+    '''Return a literal node of value in place of node, None if value can't be
+       written as a literal'''
+    if type(value) is DateValue:
+        literal = DateLiteral()
+    elif value < INT_LIMIT:
+        literal = IntLiteral()
+    else:
+        return None
+    literal.value = value
+    literal.valtype = 'date' if type(value) is DateValue else 'int'
+    for child in (node, getattr(node, 'child_left_expr', None)):
+        if hasattr(child, 'lineno'):
+            literal.lineno = child.lineno
+            break
+    return literal
+
+
+def fold_expression(node, stats):
+    '''Return the node to use in place of an expression whose children are
+       already folded'''
+    nodetype = node.nodetype
+    if nodetype == 'operation' or nodetype == 'comparison':
+        l_value = constant_value(node.child_left_expr)
+        r_value = constant_value(node.child_right_expr)
+        if l_value is None or r_value is None:
+            return node
+        if nodetype == 'operation':
+            value = fold_arithmetics(node.value, l_value, r_value)
+        else:
+            value = fold_comparison(node.value, l_value, r_value)
+        literal = None if value is None else make_literal(value, node)
+        if literal is None:
+            return node
+        stats[nodetype + 's'] += 1
+        return literal
+    if nodetype == 'if_expression':
+        condition = constant_value(node.child_condition)
+        if condition is None:
+            return node
+        stats['if_expressions'] += 1
+        return node.child_if_body if condition else node.child_else_body
+    return node
+
+
+def fold_statements(statements, stats):
+    '''Return a statement list without the IF statements and WHILE loops
+       whose condition is constant'''
+    folded = []
+    for statement in statements:
+        nodetype = statement.nodetype
+        if nodetype == 'if_statement':
+            condition = constant_value(statement.child_condition)
+            if condition is not None:
+                stats['if_statements'] += 1
+                folded.extend(statement.children_if_branch if condition
+                              else statement.children_else_branch)
+                continue
+        elif nodetype == 'while_loop':
+            if constant_value(statement.child_condition) == 0:
+                stats['while_loops'] += 1
+                continue
+        folded.append(statement)
+    return folded
+
+
+def fold_constants(tree, semdata):
+    '''Fold the constants of a checked tree in place
+
+       The number of folded nodes of each kind is put in
+       semdata.optimize_stats.'''
+    stats = semdata.optimize_stats = Counter()
+    # Children are folded before their parent, which then replaces them.
+    # Each stack entry is a node and whether its children have been folded.
+    stack = [(tree, False)]
+    while stack:
+        node, children_folded = stack.pop()
+        schema = type(node).child_schema
+        if not children_folded:
+            stack.append((node, True))
+            for name, is_list in schema:
+                children = getattr(node, name, None)
+                if children is None:
+                    continue
+                if is_list:
+                    stack.extend((child, False) for child in reversed(children))
+                else:
+                    stack.append((children, False))
+            continue
+
+        for name, is_list in schema:
+            children = getattr(node, name, None)
+            if children is None:
+                continue
+            if is_list:
+                children = [fold_expression(child, stats) for child in children]
+                if name in STATEMENT_LISTS:
+                    children = fold_statements(children, stats)
+                setattr(node, name, children)
+            else:
+                setattr(node, name, fold_expression(children, stats))
+
+
+def subtree(node):
+    '''Generate the nodes of a subtree, parents before children'''
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        for name, is_list in type(node).child_schema:
+            children = getattr(node, name, None)
+            if children is None:
+                continue
+            if is_list:
+                stack.extend(reversed(children))
+            else:
+                stack.append(children)
+
+
+def pure_call(node):
+    '''Whether a func_call is to a pure FUNCTION (not Today(), see memo.py)'''
+    symdata = getattr(node, 'symdata', None)
+    return symdata is not None and symdata.defnode.pure
+
+
+def loop_writes(loop):
+    '''Return the ids of the symbol data of the variables assigned in a
+       loop, and whether PROCEDUREs called in it may assign global variables
+       (FUNCTIONs can't assign anything)'''
+    assigned = set()
+    calls_procedures = False
+    for node in subtree(loop):
+        nodetype = node.nodetype
+        if nodetype == 'assign':
+            assigned.add(id(node.child_lvalue.symdata))
+        elif nodetype == 'proc_call':
+            calls_procedures = True
+    return assigned, calls_procedures
+
+
+def invariant_nodes(loop):
+    '''Return the ids of the expressions in a loop whose value doesn't
+       change while the loop runs'''
+    assigned, calls_procedures = loop_writes(loop)
+    invariant = set()
+    # Children are decided before their parents
+    for node in reversed(list(subtree(loop))):
+        nodetype = node.nodetype
+        if nodetype in ('int_literal', 'date_literal', 'string_literal', 'loop_invariant'):
+            pass
+        elif nodetype == 'var':
+            symdata = node.symdata
+            if id(symdata) in assigned or (calls_procedures and symdata.scope == 'global'):
+                continue
+        elif nodetype == 'operation' or nodetype == 'comparison':
+            if id(node.child_left_expr) not in invariant or id(node.child_right_expr) not in invariant:
+                continue
+        elif nodetype == 'if_expression':
+            if (id(node.child_condition) not in invariant or id(node.child_if_body) not in invariant
+                    or id(node.child_else_body) not in invariant):
+                continue
+        elif nodetype == 'func_call':
+            if not pure_call(node) or not all(id(arg) in invariant for arg in node.children_args):
+                continue
+        else:
+            continue
+        invariant.add(id(node))
+    return invariant
+
+
+def make_temporary(node, owner, semdata):
+    '''Return symbol data for the temporary of a loop invariant: a new slot
+       in the frame of the PROCEDURE owner, or a global if owner is None'''
+    if owner is None:
+        return semdata.add_global(SymbolData('temp', node))
+    slot = owner.frame_size
+    owner.frame_size += 1
+    return SymbolData('temp', node, 'local', slot)
+
+
+def hoist_loop(loop, owner, semdata):
+    '''Wrap the largest invariant expressions of a loop, inner loops
+       included, in loop_invariant nodes'''
+    stats = semdata.optimize_stats
+    invariant = invariant_nodes(loop)
+    temporaries = []
+    stack = [loop]
+    while stack:
+        node = stack.pop()
+        for name, is_list in type(node).child_schema:
+            # An lvalue is written, not read
+            if name == 'child_lvalue':
+                continue
+            children = getattr(node, name, None)
+            if children is None:
+                continue
+            for i, child in enumerate(children if is_list else [children]):
+                nodetype = child.nodetype
+                if nodetype == 'loop_invariant':
+                    continue
+                if id(child) not in invariant or not (nodetype in HOISTED_TYPES or (
+                        nodetype == 'var' and hasattr(child, 'child_read_attr'))):
+                    stack.append(child)
+                    continue
+                stats['invariants'] += 1
+                hoisted = LoopInvariant()
+                # Names the temporary in tree and bytecode listings
+                hoisted.value = 'invariant_' + str(stats['invariants'])
+                hoisted.child_expr = child
+                if hasattr(child, 'lineno'):
+                    hoisted.lineno = child.lineno
+                hoisted.valtype = getattr(child, 'valtype', None)
+                hoisted.symdata = make_temporary(hoisted, owner, semdata)
+                hoisted.symdata.valtype = hoisted.valtype
+                temporaries.append(hoisted.symdata)
+                if is_list:
+                    children[i] = hoisted
+                else:
+                    setattr(node, name, hoisted)
+    if temporaries:
+        loop.invariants = temporaries
+
+
+def hoist_invariants(tree, semdata):
+    '''Hoist the loop invariants of the WHILE loops of a checked tree
+
+       The number of hoisted expressions is added to semdata.optimize_stats.'''
+    bodies = [(tree.children_statements, None)]
+    bodies += [(definition.children_statements, definition)
+               for definition in tree.children_definitions
+               if definition.nodetype == 'procedure_def']
+    for statements, owner in bodies:
+        # Outer loops first, so that an expression is hoisted out of as many
+        # loops as it can be
+        loops = [node for statement in statements for node in subtree(statement)
+                 if node.nodetype == 'while_loop']
+        for loop in loops:
+            hoist_loop(loop, owner, semdata)
+
+
+def optimize(tree, semdata):
+    '''Run all optimizations on a checked tree'''
+    fold_constants(tree, semdata)
+    hoist_invariants(tree, semdata)
+
+
+def print_optimize_stats(semdata):
+    '''Print the counters of the optimizations done'''
+    stats = getattr(semdata, 'optimize_stats', Counter())
+    print("Optimizations:")
+    for key, description in STATS:
+        print("  {}: {}".format(description, stats[key]))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+
+# Output of PRINT statements
+#
+# The engines don't print directly, they write lines to an output sink given
+# to run_program. A sink collects the text in a buffer and passes it on to its
+# target (a file, a list of lines or nowhere) when its flush policy says so:
+#
+#     'line'  after every line, for interactive use
+#     'exit'  only when the program ends (run_program flushes the sink)
+#     N       whenever at least N characters have been collected
+#
+# Run-time error messages are written to the same sink, so they come out
+# after the output printed before the error.
+
+import sys
+
+DEFAULT_BUFFER_SIZE = 1 << 16
+
+
+def parse_flush_policy(text):
+    '''Return the flush policy given as a string: 'line', 'exit' or a
+       number of characters'''
+    if text in ('line', 'exit'):
+        return text
+    size = int(text)
+    if size < 1:
+        raise ValueError("buffer size must be positive")
+    return size
+
+
+class OutputSink:
+    '''Buffered output, passed on to the target by emit()'''
+
+    def __init__(self, flush='exit'):
+        self.flush_policy = flush
+        self.flush_lines = flush == 'line'
+        self.limit = flush if isinstance(flush, int) else float('inf')
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.limit:
+            self.flush()
+
+    def end_line(self):
+        self.write('\n')
+        if self.flush_lines:
+            self.flush()
+
+    def write_line(self, items):
+        '''Write the items of a PRINT statement, each followed by a space,
+           and end the line'''
+        if items:
+            self.write(' '.join(map(str, items)) + ' ')
+        self.end_line()
+
+    def flush(self):
+        if self.buffer:
+            text = ''.join(self.buffer)
+            self.buffer = []
+            self.size = 0
+            self.emit(text)
+
+    def emit(self, text):
+        raise NotImplementedError
+
+
+class FileSink(OutputSink):
+    '''Output to a text file, sys.stdout by default
+
+       Without a flush policy, an interactive file is flushed after every
+       line, and others when DEFAULT_BUFFER_SIZE characters are collected.'''
+
+    def __init__(self, file=None, flush=None):
+        if file is None:
+            file = sys.stdout
+        if flush is None:
+            flush = 'line' if file.isatty() else DEFAULT_BUFFER_SIZE
+        super().__init__(flush)
+        self.file = file
+
+    def emit(self, text):
+        self.file.write(text)
+        self.file.flush()
+
+
+class ListSink(OutputSink):
+    '''Output collected into a list of lines (without newlines)
+
+       A line not ended yet is kept in tail.'''
+
+    def __init__(self, flush='exit'):
+        super().__init__(flush)
+        self.lines = []
+        self.tail = ''
+
+    def emit(self, text):
+        lines = (self.tail + text).split('\n')
+        self.tail = lines.pop()
+        self.lines.extend(lines)
+
+
+class NullSink(OutputSink):
+    '''Output that is discarded'''
+
+    def write(self, text):
+        pass
+
+    def end_line(self):
+        pass
+
+    def write_line(self, items):
+        pass
+
+    def emit(self, text):
+        pass
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+
+# Execution profiler
+#
+# A Profile counts the evaluations of syntax tree nodes and the time spent in
+# them, by node type, by source line and by called FUNCTION/PROCEDURE. It is
+# given to run_program, which then runs the program with instrumented versions
+# of semantics_run.eval_node (tree engine) or semantics_compile.compile_node
+# (closure engine) put in place of the real ones for the run. The engines
+# themselves have no profiling code, so there is no cost when not profiling.
+#
+# Times are self times: the time of a node minus the time of its children. A
+# node without a line number of its own (e.g. a comparison) is counted on the
+# line of its first child. The time of a FUNCTION or PROCEDURE is the total
+# time of its calls, recursive calls counted once.
+
+import time
+from contextlib import contextmanager
+
+from ast_nodes import node_line
+
+CALL_TYPES = ('func_call', 'proc_call')
+
+
+class Profile:
+    '''Counters and times of a profiled run'''
+
+    def __init__(self):
+        self.node_types = dict()   # nodetype -> [count, self time]
+        self.lines = dict()        # lineno -> [count, self time]
+        self.subroutines = dict()  # name -> [calls, total time, active calls]
+        self.total = 0.0
+        # For each node being evaluated: time of its children, and time of its
+        # nearest descendants with a line number
+        self.stack = []
+
+    def entries(self, node):
+        '''Return the counters of a node: of its type, of its line (None if
+           it has no line number) and of the subroutine it calls (None if it
+           is not a call)'''
+        type_entry = self.node_types.setdefault(node.nodetype, [0, 0.0])
+        lineno = node_line(node)
+        line_entry = self.lines.setdefault(lineno, [0, 0.0]) if lineno else None
+        call_entry = None
+        if node.nodetype in CALL_TYPES:
+            call_entry = self.subroutines.setdefault(node.value, [0, 0.0, 0])
+        return type_entry, line_entry, call_entry
+
+    def make_profiled(self, run, type_entry, line_entry, call_entry, *fixed):
+        '''Return a function calling run(*fixed, *args) and counting the call
+           and its time in the given entries'''
+        stack = self.stack
+        clock = time.perf_counter
+
+        def profiled(*args):
+            if call_entry is not None:
+                call_entry[0] += 1
+                call_entry[2] += 1
+            children = [0.0, 0.0]
+            stack.append(children)
+            start = clock()
+            try:
+                return run(*fixed, *args)
+            finally:
+                elapsed = clock() - start
+                stack.pop()
+                type_entry[0] += 1
+                type_entry[1] += elapsed - children[0]
+                if stack:
+                    parent = stack[-1]
+                    parent[0] += elapsed
+                if line_entry is not None:
+                    line_entry[0] += 1
+                    line_entry[1] += elapsed - children[1]
+                    if stack:
+                        parent[1] += elapsed
+                elif stack:
+                    parent[1] += children[1]
+                if call_entry is not None:
+                    call_entry[2] -= 1
+                    if call_entry[2] == 0:
+                        call_entry[1] += elapsed
+        return profiled
+
+    def wrap_eval_node(self, eval_node):
+        '''Return an instrumented eval_node'''
+        profiled_nodes = dict()  # id(node) -> instrumented evaluation of the node
+
+        def profiled_eval_node(node, semdata):
+            profiled = profiled_nodes.get(id(node))
+            if profiled is None:
+                profiled = profiled_nodes[id(node)] = self.make_profiled(
+                    eval_node, *self.entries(node), node)
+            return profiled(semdata)
+        return profiled_eval_node
+
+    def wrap_compile_node(self, compile_node):
+        '''Return an instrumented compile_node'''
+        def profiled_compile_node(node, semdata):
+            return self.make_profiled(compile_node(node, semdata), *self.entries(node))
+        return profiled_compile_node
+
+    @contextmanager
+    def instrumented(self, engine):
+        '''Put the instrumented functions of an engine in place for a block'''
+        if engine == 'tree':
+            import semantics_run as module
+            name = 'eval_node'
+            wrapped = self.wrap_eval_node(module.eval_node)
+        elif engine == 'closure':
+            import semantics_compile as module
+            name = 'compile_node'
+            wrapped = self.wrap_compile_node(module.compile_node)
+        else:
+            raise ValueError("the '" + engine + "' engine can't be profiled")
+        original = getattr(module, name)
+        setattr(module, name, wrapped)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.total += time.perf_counter() - start
+            setattr(module, name, original)
+
+
+def print_profile(profile, source_lines=None, limit=20):
+    '''Print the hot spots of a profile, at most limit lines of each kind,
+       with the text of the source lines if given'''
+    total = profile.total or 1.0
+
+    def percent(seconds):
+        return "{:6.1%}".format(seconds / total)
+
+    print("Profile ({:.3f} s):".format(profile.total))
+    print("  {:<20} {:>10} {:>10} {:>7}".format("node type", "count", "self s", ""))
+    for nodetype, (count, seconds) in sorted(profile.node_types.items(), key=lambda item: -item[1][1])[:limit]:
+        print("  {:<20} {:>10} {:>10.4f} {}".format(nodetype, count, seconds, percent(seconds)))
+    print("  {:<20} {:>10} {:>10} {:>7}".format("line", "count", "self s", ""))
+    for lineno, (count, seconds) in sorted(profile.lines.items(), key=lambda item: -item[1][1])[:limit]:
+        text = ""
+        if source_lines is not None and 0 < lineno <= len(source_lines):
+            text = "  " + source_lines[lineno - 1].strip()
+        print("  {:<20} {:>10} {:>10.4f} {}{}".format(lineno, count, seconds, percent(seconds), text))
+    if profile.subroutines:
+        print("  {:<20} {:>10} {:>10} {:>7}".format("function/procedure", "calls", "total s", ""))
+        for name, (calls, seconds, active) in sorted(profile.subroutines.items(),
+                                                      key=lambda item: -item[1][1])[:limit]:
+            print("  {:<20} {:>10} {:>10.4f} {}".format(name, calls, seconds, percent(seconds)))
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+#
+
+# Standalone scanner
+#
+# An alternative to the PLY lexer in lexer.py for large inputs. It works
+# directly over the input buffer, a str, bytes or an mmap of the source file
+# (see open_source), so the file is never copied into one big string.
+#
+# The token rules are taken from lexer.py, in the order PLY tries them, and
+# joined into a single master regex. The input is scanned a chunk (about
+# CHUNK_SIZE bytes, ending at a newline) at a time: one findall call splits the
+# chunk into whitespace runs and token texts, and everything else is done per
+# distinct text, which is classified once (matched against the rules and passed
+# to its rule function) and then looked up in a dict. The tokens of a chunk are
+# built with map and zip, without a Python loop per token.
+#
+# The tokens, values, line numbers and errors are the same as with
+# lexer.lexer. The rule functions of lexer.py are assumed to depend only on
+# the text of the token, except for the error messages. Texts that don't
+# classify cleanly (illegal characters, a bad date, or a string or comment cut
+# off at the end of a chunk) are matched again at their position in the whole
+# input, exactly like PLY does, and any error is raised only when the parser
+# asks for that token.
+#
+# A Scanner can be passed to parser.parse as its lexer:
+#
+#     with open_source(filename) as data:
+#         tree = parser.parse(data, lexer=Scanner())
+
+import mmap
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+from itertools import accumulate, chain, compress, islice, repeat
+from operator import add, is_not, itemgetter
+
+from ply.lex import LexToken
+
+import lexer
+
+CHUNK_SIZE = 1 << 16
+
+# Not token rules: whitespace is split off by the master regex, and t_error is
+# called for illegal characters
+IGNORED_RULES = ('t_whitespace', 't_error')
+
+# The tokens given to the parser have the attributes of PLY's LexToken. Each
+# Scanner makes a subclass with its own lexer attribute.
+Token = namedtuple('Token', ['type', 'value', 'lineno', 'lexpos'])
+
+# Texts are classified as (token type, value, newlines, length of whitespace),
+# where newlines and whitespace are those before the token. Whitespace at the
+# end of input and comments have token type None.
+ERROR_TYPE = 'error'
+TYPE = itemgetter(0)
+VALUE = itemgetter(1)
+NEWLINES = itemgetter(2)
+WHITESPACE = itemgetter(3)
+NON_ASCII = re.compile(rb'[\x80-\xff]')
+
+
+def token_rules(module=lexer):
+    '''Return (token type, regex, rule function or None) of the token rules of
+       a PLY lexer module, in the order PLY tries them'''
+    functions = [value for name, value in vars(module).items()
+                 if name.startswith('t_') and callable(value) and name not in IGNORED_RULES]
+    functions.sort(key=lambda function: function.__code__.co_firstlineno)
+    strings = [(name, value) for name, value in vars(module).items()
+               if name.startswith('t_') and isinstance(value, str)]
+    strings.sort(key=lambda rule: len(rule[1]), reverse=True)
+    return ([(function.__name__[2:], function.__doc__, function) for function in functions]
+            + [(name[2:], regex, None) for name, regex in strings])
+
+
+def compile_rules(rules, binary):
+    '''Compile the regexes of the scanner for str or bytes (binary) input
+
+       Returns a regex splitting input into tokens or single illegal
+       characters, each with the whitespace before it, and a regex matching a
+       token, where group i + 1 is the token matched by rule i. Like PLY, they
+       are in verbose mode.'''
+    splitter = r'\s*(?:' + '|'.join('(?:%s)' % rule[1] for rule in rules) + r'|\S)|\s+'
+    grouped = '|'.join('(%s)' % rule[1] for rule in rules)
+    if binary:
+        # \w and \s of bytes patterns match ASCII only. Input with non-ASCII
+        # bytes is decoded to str (see Scanner.input).
+        splitter = splitter.encode('ascii')
+        grouped = grouped.encode('ascii')
+    return re.compile(splitter, re.VERBOSE), re.compile(grouped, re.VERBOSE)
+
+
+RULES = token_rules()
+REGEXES = compile_rules(RULES, binary=False)
+REGEXES_BYTES = compile_rules(RULES, binary=True)
+
+
+class Scanner:
+    '''A lexer object for ply.yacc, scanning a chunk of input at a time
+
+       lineno and lexpos are those at the end of the last scanned chunk.'''
+
+    def __init__(self, chunk_size=CHUNK_SIZE, rules=RULES):
+        self.chunk_size = chunk_size
+        self.lineno = 1
+        self.lexpos = 0
+        # Indexed by the group of the rule: token type and rule function
+        self.types = [None] + [rule[0] for rule in rules]
+        self.functions = [None] + [rule[2] for rule in rules]
+        self.Token = type('Token', (Token,), {'__slots__': (), 'lexer': self})
+        self.make_token = partial(tuple.__new__, self.Token)
+        self.input('')
+
+    def input(self, data, pos=0):
+        '''Start scanning a str, or bytes or a buffer (e.g. an mmap) of UTF-8,
+           from position pos on'''
+        self.binary = not isinstance(data, str)
+        if self.binary and NON_ASCII.search(data):
+            data = str(data, 'utf-8')
+            self.binary = False
+        splitter, grouped = REGEXES_BYTES if self.binary else REGEXES
+        self.findall = splitter.findall
+        self.match = grouped.match
+        self.newline = b'\n' if self.binary else '\n'
+        self.data = data
+        self.lexpos = pos
+        self.classified = dict()
+        self.tokens = chain.from_iterable(self.scan())
+
+    def token(self):
+        '''Return the next token, or None at the end of input'''
+        return next(self.tokens, None)
+
+    def __iter__(self):
+        return self.tokens
+
+    def scan(self):
+        '''Generate the tokens of the input as lists, a chunk at a time'''
+        data = self.data
+        size = len(data)
+        classified = self.classified
+        pos = self.lexpos
+        while pos < size:
+            end = data.find(self.newline, pos + self.chunk_size) + 1 or size
+            texts = self.findall(data, pos, end)
+            entries = list(map(classified.get, texts))
+            if None in entries:
+                self.classify(texts, entries)
+            types = list(map(TYPE, entries))
+            count = types.index(ERROR_TYPE) if ERROR_TYPE in types else len(texts)
+            linenos = list(accumulate(map(NEWLINES, entries), initial=self.lineno))
+            starts = accumulate(map(len, texts), initial=pos)
+            positions = map(add, starts, map(WHITESPACE, entries))
+
+            rows = islice(zip(types, map(VALUE, entries), islice(linenos, 1, None), positions), count)
+            if None in types:
+                rows = compress(rows, map(is_not, types, repeat(None)))
+            yield list(map(self.make_token, rows))
+
+            if count < len(texts):
+                # Match the text again at its position in the whole input
+                self.lineno = linenos[count + 1]
+                tok_pos = pos + sum(map(len, texts[:count])) + entries[count][3]
+                tok, pos = self.exact_token(tok_pos)
+                if tok is not None:
+                    yield [tok]
+            else:
+                self.lineno = linenos[-1]
+                pos = end
+            self.lexpos = pos
+
+    def classify(self, texts, entries):
+        '''Fill in the entries of texts not classified yet'''
+        classified = self.classified
+        i = entries.index(None)
+        while True:
+            text = texts[i]
+            entry = classified.get(text)
+            if entry is None:
+                entry = classified[text] = self.classify_text(text)
+            entries[i] = entry
+            try:
+                i = entries.index(None, i + 1)
+            except ValueError:
+                return
+
+    def classify_text(self, text):
+        '''Return the (token type, value, newlines, whitespace) of a text'''
+        token_text = text.lstrip()
+        whitespace = len(text) - len(token_text)
+        newlines = text.count(self.newline, 0, whitespace)
+        if not token_text:
+            return (None, None, newlines, whitespace)
+        found = self.match(token_text)
+        if found is None or found.end() != len(token_text):
+            return (ERROR_TYPE, None, newlines, whitespace)
+        try:
+            tok = self.rule_token(found)
+        except Exception:
+            return (ERROR_TYPE, None, newlines, whitespace)
+        if tok is None:
+            return (None, None, newlines, whitespace)
+        return (tok.type, tok.value, newlines, whitespace)
+
+    def rule_token(self, found):
+        '''Return the token of a match of the rules, None if it is discarded'''
+        rule = found.lastindex
+        tok = LexToken()
+        tok.type = self.types[rule]
+        tok.value = found.group(rule)
+        if self.binary:
+            tok.value = tok.value.decode('ascii')
+        tok.lineno = self.lineno
+        tok.lexpos = found.start(rule)
+        tok.lexer = self
+        function = self.functions[rule]
+        if function is not None:
+            tok = function(tok)
+        return tok
+
+    def exact_token(self, pos):
+        '''Match a token at a position of the whole input, like PLY
+
+           Returns the token (None if it is discarded) and the position after
+           it. Errors of the rule functions and illegal characters raise the
+           same exceptions as with the PLY lexer.'''
+        data = self.data
+        found = self.match(data, pos)
+        if found is None:
+            tok = LexToken()
+            tok.value = data[pos:pos + 1]
+            if self.binary:
+                tok.value = tok.value.decode('ascii')
+            tok.lineno = self.lineno
+            tok.lexpos = pos
+            tok.lexer = self
+            lexer.t_error(tok)
+        tok = self.rule_token(found)
+        if tok is not None:
+            tok = self.Token(tok.type, tok.value, tok.lineno, tok.lexpos)
+        return tok, found.end()
+
+
+@contextmanager
+def open_source(filename):
+    '''Map a source file into memory for scanning, read-only'''
+    with open(filename, 'rb') as infile:
+        try:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # An empty file can't be mapped
+            yield b''
+            return
+        with data:
+            yield data
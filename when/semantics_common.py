@@ -4,7 +4,7 @@
 # Generic useful stuff for semantic analysis and interpretation/code generation
 
 import sys
-from tree_print import get_childvars
+from tree_print import get_children
 
 
 # A class for collecting data needed during semantic analysis etc.
@@ -13,56 +13,168 @@ from tree_print import get_childvars
 class SemData:
     def __init__(self):
         self.symtbl = dict()
+        # Symbol table of the FUNCTION/PROCEDURE definition being checked
+        # (formals and local variables), None outside definitions
+        self.localtbl = None
+        # Memo tables of pure FUNCTIONs (memo.py), filled in by run_program
+        self.memo_tables = dict()
+        # Values of the global variables (and temporaries) at run time, and
+        # their symbol data, by slot
+        self.globals = []
+        self.global_symbols = []
+
+    def add_global(self, symdata):
+        '''Give the symbol data of a global variable the next global slot'''
+        symdata.slot = len(self.globals)
+        self.globals.append(0)
+        self.global_symbols.append(symdata)
+        return symdata
 
 # An element in the symbol table, by default containing symbols type
-# and reference to its definition in the syntax tree
+# and reference to its definition in the syntax tree.
+# Formals and local variables of a definition have scope 'local' and
+# a slot, i.e. their index in the frame array of a call. Global variables
+# have a slot in semdata.globals.
 
 
 class SymbolData:
-    def __init__(self, symtype, defnode):
+    def __init__(self, symtype, defnode, scope='global', slot=None):
         self.symtype = symtype
         self.defnode = defnode
+        self.scope = scope
+        self.slot = slot
+        self.valtype = None  # 'int' or 'date' if known (see typecheck.py)
 
 # The function is given the root of the tree
 
 
 def visit_tree(node, before_func=None, after_func=None, semdata=None):
-    '''A generic visitor (which uses tree_print.get_childvars)
+    '''A generic visitor (which uses tree_print.get_children)
 
        Parameters:
        node: root of the (sub)tree to be traversed
        before_func: When a node is found, this function is first called,
-                  then all the childrens of the node are visited recursively, then
+                  then all the childrens of the node are visited (depth first), then
                   the second function (after_func) is called. NOTE: If function returns
                   anything except None, it's regarded as an error message, which is printed
                   out and execution is terminated. If node contains an attribute 'lineno',
                   that's included in the error message.
        after_func: When a node is found, the func_before function is first called,
-                  then all the childrens of the node are visited recursively, then
+                  then all the childrens of the node are visited (depth first), then
                   this function is called. NOTE: If function returns
                   anything except None, it's regarded as an error message, which is printed
                   out and execution is terminated. If node contains an attribute 'lineno',
                   that's included in the error message.
        semdata: optional data that is passed to all functions'''
 
-    if before_func:
-        err = before_func(node, semdata)
-        if not err is None:
-            if hasattr(node, "lineno"):
-                err = "Line " + str(node.lineno) + ": " + err
-            print(err)
-            sys.exit()
-
-    children = get_childvars(node)
-
-    for name, child in children:
-        if child:
-            visit_tree(child, before_func, after_func, semdata)
-
-    if after_func:
-        err = after_func(node, semdata)
-        if not err is None:
-            if hasattr(node, "lineno"):
-                err = "Line " + str(node.lineno) + ": " + err
-            print(err)
-            sys.exit()
+    # The tree is traversed with an explicit stack instead of recursion,
+    # so deep trees don't run into Python's recursion limit. Each entry is
+    # a node and whether its children have already been visited.
+    stack = [(node, False)]
+    while stack:
+        node, children_visited = stack.pop()
+        if children_visited:
+            if after_func:
+                report_error(after_func(node, semdata), node)
+            continue
+
+        if before_func:
+            report_error(before_func(node, semdata), node)
+
+        stack.append((node, True))
+        children = get_children(node)
+        for child in reversed(children):
+            if child:
+                stack.append((child, False))
+
+
+def report_error(err, node):
+    '''Print an error message returned by a visitor function and terminate'''
+    if not err is None:
+        if hasattr(node, "lineno"):
+            err = "Line " + str(node.lineno) + ": " + err
+        print(err)
+        sys.exit()
+
+
+# Semantic checks are registered declaratively as Check objects and run
+# together in a single traversal of the tree
+
+class Check:
+    '''A semantic check
+
+       nodetypes: types of the nodes the check is interested in
+       before: called as before(node, semdata) when such a node is found, before
+               its children are visited (see visit_tree for the error convention)
+       after: called as after(node, semdata) after the children are visited
+       finish: called as finish(semdata) once the whole tree is visited'''
+
+    def __init__(self, nodetypes, before=None, after=None, finish=None):
+        self.nodetypes = nodetypes
+        self.before = before
+        self.after = after
+        self.finish = finish
+
+
+def run_checks(tree, checks, semdata, finish=True):
+    '''Run a list of Checks in a single traversal of the tree
+
+       For each node, the before/after functions of all checks registered for
+       its type are called in the order the checks are listed. The finish
+       functions are called at the end if finish is true.'''
+    befores = dict()
+    afters = dict()
+    for check in checks:
+        for nodetype in check.nodetypes:
+            if check.before:
+                befores.setdefault(nodetype, []).append(check.before)
+            if check.after:
+                afters.setdefault(nodetype, []).append(check.after)
+
+    stack = [(tree, False)]
+    while stack:
+        node, children_visited = stack.pop()
+        if children_visited:
+            for after_func in afters[node.nodetype]:
+                report_error(after_func(node, semdata), node)
+            continue
+
+        nodetype = node.nodetype
+        if nodetype in befores:
+            for before_func in befores[nodetype]:
+                report_error(before_func(node, semdata), node)
+
+        if nodetype in afters:
+            stack.append((node, True))
+        children = get_children(node)
+        for child in reversed(children):
+            if child:
+                stack.append((child, False))
+
+    if finish:
+        for check in checks:
+            if check.finish:
+                check.finish(semdata)
+
+
+def run_checks_multipass(tree, checks, semdata):
+    '''Run a list of Checks with one traversal of the tree per check
+
+       Gives the same result as run_checks for independent checks, and is
+       kept for comparing the two.'''
+    for check in checks:
+        if check.before or check.after:
+            nodetypes = set(check.nodetypes)
+            before_func = check.before
+            after_func = check.after
+
+            def before(node, semdata):
+                if before_func and node.nodetype in nodetypes:
+                    return before_func(node, semdata)
+
+            def after(node, semdata):
+                if after_func and node.nodetype in nodetypes:
+                    return after_func(node, semdata)
+            visit_tree(tree, before, after, semdata)
+        if check.finish:
+            check.finish(semdata)
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+#
+
+# Closure compiling execution engine
+#
+# The checked syntax tree is turned once into a tree of Python closures, each
+# with its children and symbol data already bound. Running the program is then
+# just calling the root closure, with no per-node dispatch on nodetype strings
+# or hasattr probes at runtime.
+#
+# Every closure takes the frame of the current FUNCTION/PROCEDURE call (a list
+# indexed by the slots of formals and local variables) as its only argument.
+# The main program runs with frame None.
+
+from ast_nodes import node_line
+from datevalue import DateValue
+from memo import MISSING
+from semantics_run import (raise_error, arithmetics, read_var_attribute, modify_date,
+                           recursion_too_deep, add_ints, subtract_ints, multiply_ints)
+
+
+def compile_program(tree, semdata):
+    '''Compile a checked syntax tree into a callable that runs the program
+
+       Parameters:
+       tree: root of the syntax tree (a 'program' node)
+       semdata: SemData filled in by the semantic checks'''
+    semdata.compiled_subroutines = dict()
+    program = compile_node(tree, semdata)
+    return lambda: program(None)
+
+
+def compile_node(node, semdata):
+    compiler = COMPILERS.get(node.nodetype, compile_unknown)
+    return compiler(node, semdata)
+
+
+def compile_statements(nodes, semdata):
+    '''Compile a list of statements into a single closure'''
+    statements = tuple(compile_node(node, semdata) for node in nodes)
+    if len(statements) == 0:
+        def run(frame):
+            return None
+    elif len(statements) == 1:
+        run = statements[0]
+    else:
+        def run(frame):
+            for statement in statements:
+                statement(frame)
+    return run
+
+
+def compile_body(nodes, semdata):
+    '''Compile the statements of a program or a PROCEDURE
+
+       The closure returns the value of the RETURN statement, which can only
+       appear directly in the statement list, so it ends the list.'''
+    for i, node in enumerate(nodes):
+        if node.nodetype == 'return_statement':
+            statements = compile_statements(nodes[:i], semdata)
+            expression = compile_node(node.child_expr, semdata)
+
+            def run(frame):
+                statements(frame)
+                return expression(frame)
+            return run
+    statements = compile_statements(nodes, semdata)
+
+    def run(frame):
+        statements(frame)
+        return None
+    return run
+
+
+def compile_program_node(node, semdata):
+    var_defs = [d for d in node.children_definitions if d.nodetype == 'variable_def']
+    definitions = compile_statements(var_defs, semdata)
+    statements = compile_body(node.children_statements, semdata)
+
+    def run(frame):
+        definitions(frame)
+        statements(frame)
+    return run
+
+
+def compile_store(symdata, expression, semdata):
+    '''Compile storing the value of an expression closure into a variable'''
+    slot = symdata.slot
+    if symdata.scope == 'local':
+        def run(frame):
+            frame[slot] = expression(frame)
+    else:
+        values = semdata.globals
+
+        def run(frame):
+            values[slot] = expression(frame)
+    return run
+
+
+def compile_variable_def(node, semdata):
+    expression = compile_node(node.child_expression, semdata)
+    return compile_store(node.symdata, expression, semdata)
+
+
+def compile_literal(node, semdata):
+    value = node.value
+    return lambda frame: value
+
+
+def compile_load(symdata, semdata):
+    slot = symdata.slot
+    if symdata.scope == 'local':
+        return lambda frame: frame[slot]
+    else:
+        values = semdata.globals
+        return lambda frame: values[slot]
+
+
+def compile_var(node, semdata):
+    load = compile_load(node.symdata, semdata)
+    if hasattr(node, "child_read_attr"):
+        read_attr = node.child_read_attr.value
+        lineno = node.lineno
+
+        def run(frame):
+            return read_var_attribute(read_attr, load(frame), lineno)
+    else:
+        run = load
+    return run
+
+
+def compile_operation(node, semdata):
+    left = compile_node(node.child_left_expr, semdata)
+    right = compile_node(node.child_right_expr, semdata)
+    operation = node.value
+    lineno = getattr(node, "lineno", 0)
+    operate = getattr(node, "operate", None)
+
+    # With the types of the operands known (see typecheck.py), integer
+    # arithmetics is done directly and other operations call their
+    # specialized function, without testing the types of the values
+    if operate is add_ints:
+        def run(frame):
+            return left(frame) + right(frame)
+    elif operate is subtract_ints:
+        def run(frame):
+            return left(frame) - right(frame)
+    elif operate is multiply_ints:
+        def run(frame):
+            return left(frame) * right(frame)
+    elif operate is not None:
+        def run(frame):
+            return operate(left(frame), right(frame), lineno)
+    # Otherwise integer arithmetics is the common case, so it is tried first
+    # without going through the generic helper
+    elif operation == '+':
+        def run(frame):
+            l_value = left(frame)
+            r_value = right(frame)
+            if type(l_value) is int and type(r_value) is int:
+                return l_value + r_value
+            return arithmetics(operation, l_value, r_value, lineno)
+    elif operation == '-':
+        def run(frame):
+            l_value = left(frame)
+            r_value = right(frame)
+            if type(l_value) is int and type(r_value) is int:
+                return l_value - r_value
+            return arithmetics(operation, l_value, r_value, lineno)
+    elif operation == '*':
+        def run(frame):
+            l_value = left(frame)
+            r_value = right(frame)
+            if type(l_value) is int and type(r_value) is int:
+                return l_value * r_value
+            return arithmetics(operation, l_value, r_value, lineno)
+    else:
+        def run(frame):
+            return arithmetics(operation, left(frame), right(frame), lineno)
+    return run
+
+
+def compile_comparison(node, semdata):
+    left = compile_node(node.child_left_expr, semdata)
+    right = compile_node(node.child_right_expr, semdata)
+    comparison_type = node.value
+    if comparison_type == '=':
+        def run(frame):
+            return 1 if left(frame) == right(frame) else 0
+    elif comparison_type == '<':
+        def run(frame):
+            return 1 if left(frame) < right(frame) else 0
+    else:
+        def run(frame):
+            raise_error("undefined comparison type '" + comparison_type + "'", node.lineno)
+    return run
+
+
+def compile_assign(node, semdata):
+    rvalue = compile_node(node.child_rvalue, semdata)
+    lvalue = node.child_lvalue
+    if hasattr(lvalue, "child_write_attr"):  # Change a single attribute
+        write_attr = lvalue.child_write_attr.value  # year, month or day
+        load = compile_load(lvalue.symdata, semdata)
+        lineno = lvalue.lineno
+
+        def modified(frame):
+            return modify_date(load(frame), write_attr, rvalue(frame), lineno)
+        return compile_store(lvalue.symdata, modified, semdata)
+    else:
+        return compile_store(lvalue.symdata, rvalue, semdata)
+
+
+def compile_print_statement(node, semdata):
+    items = tuple(compile_node(item, semdata) for item in node.children_print_items)
+    write = semdata.output.write
+    end_line = semdata.output.end_line
+
+    def run(frame):
+        for item in items:
+            write(str(item(frame)) + " ")
+        end_line()
+    return run
+
+
+def compile_if_statement(node, semdata):
+    condition = compile_node(node.child_condition, semdata)
+    if_branch = compile_statements(node.children_if_branch, semdata)
+    else_branch = compile_statements(node.children_else_branch, semdata)
+
+    def run(frame):
+        if condition(frame):
+            if_branch(frame)
+        else:
+            else_branch(frame)
+    return run
+
+
+def compile_if_expression(node, semdata):
+    condition = compile_node(node.child_condition, semdata)
+    if_body = compile_node(node.child_if_body, semdata)
+    else_body = compile_node(node.child_else_body, semdata)
+
+    def run(frame):
+        return if_body(frame) if condition(frame) else else_body(frame)
+    return run
+
+
+def compile_while_loop(node, semdata):
+    condition = compile_node(node.child_condition, semdata)
+    body = compile_statements(node.children_body, semdata)
+    # Temporaries of hoisted loop invariants (see optimize.py)
+    resets = [compile_store(symdata, lambda frame: None, semdata)
+              for symdata in getattr(node, 'invariants', ())]
+    budget = getattr(semdata, 'budget', None)
+
+    if budget is not None:
+        # Each round is a step of the budget
+        step = budget.step
+        lineno = node_line(node)
+
+        def run(frame):
+            for reset in resets:
+                reset(frame)
+            while condition(frame):
+                step(lineno)
+                body(frame)
+    else:
+        def run(frame):
+            for reset in resets:
+                reset(frame)
+            while condition(frame):
+                body(frame)
+    return run
+
+
+def compile_loop_invariant(node, semdata):
+    load = compile_load(node.symdata, semdata)
+    store = compile_store(node.symdata, compile_node(node.child_expr, semdata), semdata)
+
+    def run(frame):
+        value = load(frame)
+        if value is None:
+            store(frame)
+            value = load(frame)
+        return value
+    return run
+
+
+def compile_call(node, semdata):
+    if node.value == 'Today':
+        return lambda frame: DateValue.today()
+    definition = node.symdata.defnode
+    # Each definition is compiled once, when the first call to it is compiled.
+    # Calls look the closure up at run time, so a definition can call itself.
+    compiled = semdata.compiled_subroutines
+    if definition.value not in compiled:
+        compiled[definition.value] = None
+        compiled[definition.value] = compile_subroutine(definition, semdata)
+    args = tuple(compile_node(arg, semdata) for arg in node.children_args)
+    padding = [0] * (definition.frame_size - len(args))
+    name = definition.value
+    memo = semdata.memo_tables.get(name)
+    budget = getattr(semdata, 'budget', None)
+
+    lineno = node.lineno
+
+    # Python's recursion limit reached in a call is reported at its line
+    if budget is not None:
+        return compile_budgeted_call(node, args, padding, memo, compiled, budget)
+    if memo is not None:
+        def run(frame):
+            values = [arg(frame) for arg in args]
+            key = memo.key(values)
+            try:
+                if key is None:
+                    return compiled[name](values + padding)
+                result = memo.lookup(key)
+                if result is MISSING:
+                    result = compiled[name](values + padding)
+                    memo.store(key, result)
+            except RecursionError:
+                recursion_too_deep('closure', lineno)
+            return result
+    elif len(args) == 1 and not padding:
+        arg = args[0]
+
+        def run(frame):
+            try:
+                return compiled[name]([arg(frame)])
+            except RecursionError:
+                recursion_too_deep('closure', lineno)
+    else:
+        def run(frame):
+            try:
+                return compiled[name]([arg(frame) for arg in args] + padding)
+            except RecursionError:
+                recursion_too_deep('closure', lineno)
+    return run
+
+
+def compile_budgeted_call(node, args, padding, memo, compiled, budget):
+    '''A call counting a step of the budget, and the call depth when the
+       result is not found in the memo table'''
+    name = node.value
+    lineno = node.lineno
+    step, enter, leave = budget.step, budget.enter, budget.leave
+
+    def run(frame):
+        values = [arg(frame) for arg in args]
+        step(lineno)
+        key = None if memo is None else memo.key(values)
+        if key is not None:
+            result = memo.lookup(key)
+            if result is not MISSING:
+                return result
+        enter(name, lineno)
+        try:
+            result = compiled[name](values + padding)
+        except RecursionError:
+            recursion_too_deep('closure', lineno)
+        leave()
+        if key is not None:
+            memo.store(key, result)
+        return result
+    return run
+
+
+def compile_subroutine(node, semdata):
+    '''Compile a FUNCTION or PROCEDURE definition
+
+       The closure is called with a new frame holding the argument values.'''
+    if node.nodetype == 'function_def':
+        var_defs = compile_statements(node.children_variable_defs, semdata)
+        body = compile_node(node.child_body, semdata)
+    else:
+        var_defs = compile_statements(node.children_var_defs, semdata)
+        body = compile_body(node.children_statements, semdata)
+
+    def run(frame):
+        var_defs(frame)
+        return body(frame)
+    return run
+
+
+def compile_unknown(node, semdata):
+    nodetype = node.nodetype
+    output = semdata.output
+
+    def run(frame):
+        output.write("Error, unknown node of type " + nodetype)
+        output.end_line()
+        return None
+    return run
+
+
+COMPILERS = {
+    'program': compile_program_node,
+    'variable_def': compile_variable_def,
+    'date_literal': compile_literal,
+    'string_literal': compile_literal,
+    'int_literal': compile_literal,
+    'var': compile_var,
+    'operation': compile_operation,
+    'comparison': compile_comparison,
+    'assign': compile_assign,
+    'print_statement': compile_print_statement,
+    'if_statement': compile_if_statement,
+    'if_expression': compile_if_expression,
+    'while_loop': compile_while_loop,
+    'loop_invariant': compile_loop_invariant,
+    'func_call': compile_call,
+    'proc_call': compile_call,
+}
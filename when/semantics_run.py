@@ -1,43 +1,163 @@
 #!/usr/bin/env python3
 #
 
-from datetime import datetime
-from datetime import timedelta
-from main import ASTnode
+from ast_nodes import node_line
+from datevalue import DateValue, add_days, read_attribute, write_attribute
+from memo import make_memo_tables, DEFAULT_MEMO_SIZE, MISSING
+from output import FileSink
 
-def run_program(tree, semdata):
-  # Initialize all variables to zero
-  for symdata in semdata.symtbl.values():
-    if symdata.symtype == 'var':
-      symdata.value = 0
-  eval_node(tree, semdata) # Do the actual execution
+ENGINES = ['closure', 'tree', 'vm', 'python']
+
+# Maximum depth of FUNCTION/PROCEDURE calls in the vm engine
+DEFAULT_MAX_DEPTH = 1000000
+
+def run_program(tree, semdata, engine='closure', memo_size=DEFAULT_MEMO_SIZE,
+                max_depth=DEFAULT_MAX_DEPTH, output=None, profile=None, budget=None):
+  '''Execute a checked syntax tree
+
+     engine selects how the tree is executed:
+     "closure" (default) compiles the tree into Python closures first (semantics_compile.py),
+     "tree" walks the syntax tree directly with eval_node,
+     "vm" compiles the tree into bytecode run by a virtual machine (semantics_vm.py),
+     "python" translates the tree into Python source run with exec (transpile.py).
+     memo_size is the number of results memoized per pure FUNCTION (0 = no memoization).
+     max_depth limits the depth of calls in the vm engine, which keeps its frames
+     in its own stack. The other engines recurse in Python and are limited by
+     Python's recursion limit.
+     output is the sink (output.py) PRINT statements and run-time errors are
+     written to, by default stdout. It is flushed when the program ends.
+     profile is a profiler.Profile to count evaluations and time in, None
+     (default) to run without profiling. The vm and python engines can't be
+     profiled.
+     budget is a budget.Budget limiting the steps, time, call depth and memory
+     of the run, None (default) for no limits.'''
+  if output is None:
+    output = FileSink()
+  semdata.output = output
+  semdata.budget = budget
+  if budget is not None:
+    budget.start()
+  # Initialize all global variables to zero
+  semdata.globals[:] = [0] * len(semdata.globals)
+  semdata.memo_tables = make_memo_tables(tree, memo_size)
+  # Do the actual execution
+  try:
+    if profile is None:
+      execute(tree, semdata, engine, max_depth)
+    else:
+      with profile.instrumented(engine):
+        execute(tree, semdata, engine, max_depth)
+  except RunError as error:
+    output.write(error.message)
+    output.end_line()
+    raise
+  finally:
+    if budget is not None:
+      budget.stop()
+    output.flush()
+
+def execute(tree, semdata, engine, max_depth):
+  try:
+    if engine == 'closure':
+      from semantics_compile import compile_program
+      compile_program(tree, semdata)()
+    elif engine == 'tree':
+      eval_node(tree, semdata)
+    elif engine == 'vm':
+      from semantics_vm import compile_bytecode, run_bytecode
+      run_bytecode(compile_bytecode(tree, semdata), max_depth, semdata.output, semdata.budget)
+    elif engine == 'python':
+      from transpile import run_python
+      run_python(tree, semdata)
+    else:
+      raise ValueError("unknown engine '" + engine + "'")
+  except RecursionError: # Not in a call, e.g. a very deeply nested expression
+    recursion_too_deep(engine)
+
+def recursion_too_deep(engine, lineno=0):
+  '''Report Python's recursion limit reached, in the call at line lineno'''
+  raise_error("recursion too deep for the '" + engine + "' engine (the 'vm' engine allows deeper recursion)", lineno)
+
+class RunError(SystemExit):
+  '''A run-time error, which ends the program like SystemExit. run_program
+     writes the message to the output.'''
+  def __init__(self, message):
+    super().__init__()
+    self.message = message
 
 def raise_error(message, lineno=0):
-  print("Line " + str(lineno) + ": Error: " + message)
-  raise SystemExit
+  raise RunError("Line " + str(lineno) + ": Error: " + message)
 
 def eval_arithmetics(node, semdata):
-  operation = node.value
   l_value = eval_node(node.child_left_expr, semdata)
   r_value = eval_node(node.child_right_expr, semdata)
-  if type(l_value) is str and type(r_value) is int:
-    l_value = datetime.strptime(l_value, "%Y-%m-%d")
+  operate = getattr(node, 'operate', None)
+  if operate is not None:
+    return operate(l_value, r_value, node.lineno)
+  return arithmetics(node.value, l_value, r_value, node.lineno)
+
+# Operations for operand types known before running (see typecheck.py), which
+# don't test the types of the values
+def add_ints(l_value, r_value, lineno=0):
+  return l_value + r_value
+
+def subtract_ints(l_value, r_value, lineno=0):
+  return l_value - r_value
+
+def multiply_ints(l_value, r_value, lineno=0):
+  return l_value * r_value
+
+def divide_ints(l_value, r_value, lineno=0):
+  if r_value == 0:
+    raise_error("division by zero", lineno)
+  return l_value // r_value
+
+def add_days_to_date(l_value, r_value, lineno=0):
+  result = add_days(l_value, r_value)
+  if result is None:
+    raise_error("date out of range", lineno)
+  return result
+
+def subtract_days_from_date(l_value, r_value, lineno=0):
+  return add_days_to_date(l_value, -r_value, lineno)
+
+def subtract_dates(l_value, r_value, lineno=0):
+  return int(l_value) - int(r_value)
+
+# (operation, left type, right type) -> function
+SPECIALIZED_OPERATIONS = {
+  ('+', 'int', 'int'): add_ints,
+  ('-', 'int', 'int'): subtract_ints,
+  ('*', 'int', 'int'): multiply_ints,
+  ('/', 'int', 'int'): divide_ints,
+  ('+', 'date', 'int'): add_days_to_date,
+  ('-', 'date', 'int'): subtract_days_from_date,
+  ('-', 'date', 'date'): subtract_dates,
+}
+
+def type_name(value):
+  '''Name of the type of a value in error messages'''
+  if type(value) is DateValue:
+    return 'date'
+  elif type(value) is int:
+    return 'int'
+  return 'no value' if value is None else type(value).__name__
+
+def arithmetics(operation, l_value, r_value, lineno=0):
+  if type(l_value) is DateValue and type(r_value) is int:
     if operation == '+': # date + days(int)
-      result = l_value + timedelta(days=r_value)
+      result = add_days(l_value, r_value)
     elif operation == '-': # date - days(int)
-      result = l_value - timedelta(days=r_value)
+      result = add_days(l_value, -r_value)
     else:
-      raise_error("operation '" + operation + "' is undefined for an operation between a date and an integer", node.lineno)
-
-    result = result.strftime("%Y-%m-%d")
-  elif type(l_value) is str and type(r_value) is str:
-    l_value = datetime.strptime(l_value, "%Y-%m-%d")
-    r_value = datetime.strptime(r_value, "%Y-%m-%d")
+      raise_error("operation '" + operation + "' is undefined for an operation between a date and an integer", lineno)
+    if result is None:
+      raise_error("date out of range", lineno)
+  elif type(l_value) is DateValue and type(r_value) is DateValue:
     if operation == '-': # Date - date = diff. in days (int)
-      diff = l_value - r_value
-      result = int(diff.days)
+      result = int(l_value) - int(r_value)
     else:
-      raise_error("operation '" + operation + "' is undefined for an operation between two dates", node.lineno)
+      raise_error("operation '" + operation + "' is undefined for an operation between two dates", lineno)
   elif type(l_value) is int and type(r_value) is int:
     if operation == '*':
       result = l_value * r_value
@@ -46,70 +166,134 @@ def eval_arithmetics(node, semdata):
     elif operation == '-':
       result = l_value - r_value
     elif operation == '/':
+      if r_value == 0:
+        raise_error("division by zero", lineno)
       result = l_value // r_value
-  else: # TODO: check already in semantics_check
-    raise_error("undefined arithmetic operation between type " + type(l_value) + " and " + type(r_value), node.lineno)
+  else: # Only when the types are not known before running, see typecheck.py
+    raise_error("undefined arithmetic operation between type " + type_name(l_value) + " and " + type_name(r_value), lineno)
 
   return result
 
-def read_var_attribute(read_attr, parent_value, node):
-  parent_value = datetime.strptime(parent_value, "%Y-%m-%d")
-  if read_attr == 'year':
-    return parent_value.year
-  elif read_attr == 'month':
-    return parent_value.month
-  elif read_attr == 'day':
-    return parent_value.day
-  elif read_attr == 'weekday':
-    return parent_value.weekday()
-  elif read_attr == 'weeknum':
-    return parent_value.isocalendar()[1]
-  else: # This branch should never be taken as these are checked already in simple_semantics_check.py
-    raise_error("'" + read_attr + "' is not a readable attribute of a 'date' object", node.lineno)
+def read_var_attribute(read_attr, parent_value, lineno=0):
+  if type(parent_value) is not DateValue:
+    raise_error("'" + read_attr + "' can only be read from a 'date' object", lineno)
+  value = read_attribute(parent_value, read_attr)
+  if value is None: # This branch should never be taken as these are checked already in simple_semantics_check.py
+    raise_error("'" + read_attr + "' is not a readable attribute of a 'date' object", lineno)
+  return value
+
+def modify_date(date, write_attr, new_value, lineno=0):
+  if type(date) is not DateValue:
+    raise_error("'" + write_attr + "' can only be written to a 'date' object", lineno)
+  try:
+    return write_attribute(date, write_attr, new_value)
+  except ValueError as e: # e.g. day 31 in a month with 30 days
+    raise_error(str(e), lineno)
+  except OverflowError: # Too large even for the checks of ValueError
+    raise_error(write_attr + " " + str(new_value) + " is out of range", lineno)
 
 def write_var_attribute(var, write_attr, new_value, semdata):
-  date = datetime.strptime(eval_node(var ,semdata), "%Y-%m-%d")
-  if write_attr == 'year':
-    modified_date = datetime.strftime(date.replace(year=new_value), "%Y-%m-%d")
-  elif write_attr == 'month':
-    modified_date = datetime.strftime(date.replace(month=new_value), "%Y-%m-%d")
-  elif write_attr == 'day':
-    modified_date = datetime.strftime(date.replace(day=new_value), "%Y-%m-%d")
-  else: # This should be checked in sematic checks
-    raise_error("'" + write_attr.value + "' is not a writable attribute of a 'date' object", var.lineno)
-  var.symdata.value = modified_date
+  old_value = load_var(var.symdata, semdata)
+  store_var(var.symdata, modify_date(old_value, write_attr, new_value, var.lineno), semdata)
+
+# Globals live in semdata.globals, formals and local variables in the frame
+# array of the current call
+def load_var(symdata, semdata):
+  if symdata.scope == 'local':
+    return semdata.frame[symdata.slot]
+  return semdata.globals[symdata.slot]
+
+def store_var(symdata, value, semdata):
+  if symdata.scope == 'local':
+    semdata.frame[symdata.slot] = value
+  else:
+    semdata.globals[symdata.slot] = value
+
+def eval_statements(statements, semdata):
+  '''Execute a statement list, stopping at a RETURN statement
+
+     Returns the value of the RETURN statement, or None.'''
+  for statement in statements:
+    if statement.nodetype == 'return_statement':
+      return eval_node(statement.child_expr, semdata)
+    eval_node(statement, semdata)
+  return None
+
+def call_subroutine(node, semdata):
+  '''Call a FUNCTION or a PROCEDURE and return its value'''
+  definition = node.symdata.defnode
+  frame = [eval_node(arg, semdata) for arg in node.children_args]
+  budget = semdata.budget
+  if budget is not None:
+    budget.step(node.lineno)
+  memo = semdata.memo_tables.get(definition.value)
+  if memo is not None:
+    key = memo.key(frame)
+    if key is not None:
+      result = memo.lookup(key)
+      if result is not MISSING:
+        return result
+  frame.extend([0] * (definition.frame_size - len(frame)))
+  if budget is not None:
+    budget.enter(definition.value, node.lineno)
+  caller_frame = semdata.frame
+  semdata.frame = frame
+  try:
+    if definition.nodetype == 'function_def':
+      for var_def in definition.children_variable_defs:
+        eval_node(var_def, semdata)
+      result = eval_node(definition.child_body, semdata)
+    else:
+      for var_def in definition.children_var_defs:
+        eval_node(var_def, semdata)
+      result = eval_statements(definition.children_statements, semdata)
+  except RecursionError:
+    recursion_too_deep('tree', node.lineno)
+  semdata.frame = caller_frame
+  if budget is not None:
+    budget.leave()
+  if memo is not None and key is not None:
+    memo.store(key, result)
+  return result
 
 
 def eval_node(node, semdata):
-  symtbl = semdata.symtbl
   nodetype = node.nodetype
   if nodetype == 'program':
-    # Execute each definition in program
+    # Execute each variable definition in program
+    semdata.frame = None
     for i in node.children_definitions:
-      eval_node(i, semdata)
-    for i in node.children_statements:
-      eval_node(i, semdata)
+      if i.nodetype == 'variable_def':
+        eval_node(i, semdata)
+    eval_statements(node.children_statements, semdata)
     return None
   elif nodetype == 'variable_def':
     # Execute the expression
     expr_value = eval_node(node.child_expression, semdata)
-    # Change the value of the variable in symbol data
-    node.symdata.value = expr_value
+    # Change the value of the variable in symbol data (or frame)
+    store_var(node.symdata, expr_value, semdata)
     return None
   elif nodetype == 'date_literal':
-    return str(node.value)
+    return node.value
   elif nodetype == 'string_literal':
     return node.value
   elif nodetype == 'var':
     # Return the value of the variable in symtbl as result
-    parent_value = node.symdata.value
+    parent_value = load_var(node.symdata, semdata)
     if hasattr(node, "child_read_attr"):
       read_attr = node.child_read_attr.value
-      return read_var_attribute(read_attr, parent_value, node)
+      return read_var_attribute(read_attr, parent_value, node.lineno)
     else:
       return parent_value
   elif nodetype == 'int_literal':
     return node.value
+  elif nodetype == 'loop_invariant':
+    # Evaluated once per loop, when first needed
+    value = load_var(node.symdata, semdata)
+    if value is None:
+      value = eval_node(node.child_expr, semdata)
+      store_var(node.symdata, value, semdata)
+    return value
   elif nodetype == 'operation':
     return eval_arithmetics(node, semdata)
   elif nodetype == 'assign':
@@ -118,23 +302,40 @@ def eval_node(node, semdata):
       write_attr = node.child_lvalue.child_write_attr.value # year, month or day
       write_var_attribute(node.child_lvalue, write_attr, r_value, semdata)
     else:
-      l_value = symtbl[node.child_lvalue.value]
-      l_value.value = r_value
+      store_var(node.child_lvalue.symdata, r_value, semdata)
     return None
   elif nodetype == 'print_statement':
+    output = semdata.output
     for item in node.children_print_items:
-      print(eval_node(item, semdata), end=" ")
-    print()
+      output.write(str(eval_node(item, semdata)) + " ")
+    output.end_line()
   elif nodetype == 'if_statement':
     condition = eval_node(node.child_condition, semdata)
-    if condition:
-      eval_node(node.children_if_branch[0], semdata) # TODO: Why a list?
+    branch = node.children_if_branch if condition else node.children_else_branch
+    for child in branch:
+      eval_node(child, semdata)
+    return None
+  elif nodetype == 'if_expression':
+    if eval_node(node.child_condition, semdata):
+      return eval_node(node.child_if_body, semdata)
     else:
-      eval_node(node.children_else_branch[0], semdata)
+      return eval_node(node.child_else_body, semdata)
   elif nodetype == 'while_loop':
-    while eval_node(node.child_condition, semdata):
-      for child in node.children_body:
-        eval_node(child, semdata)
+    # Temporaries of hoisted loop invariants (see optimize.py)
+    for symdata in getattr(node, "invariants", ()):
+      store_var(symdata, None, semdata)
+    budget = semdata.budget
+    if budget is None:
+      while eval_node(node.child_condition, semdata):
+        for child in node.children_body:
+          eval_node(child, semdata)
+    else:
+      # Each round is a step of the budget
+      lineno = node_line(node)
+      while eval_node(node.child_condition, semdata):
+        budget.step(lineno)
+        for child in node.children_body:
+          eval_node(child, semdata)
     return None
   elif nodetype == 'comparison':
     left_expr = eval_node(node.child_left_expr, semdata)
@@ -146,16 +347,14 @@ def eval_node(node, semdata):
       return 1 if left_expr < right_expr else 0
     else:
       raise_error("undefined comparison type '" + comparison_type + "'", node.lineno)
-  elif nodetype == 'func_call':
+  elif nodetype == 'func_call' or nodetype == 'proc_call':
     func_name = node.value
     if func_name == 'Today':
-      node = ASTnode('date_literal')
-      today = datetime.today()
-      node.value = today.strftime("%Y-%m-%d")
-      return eval_node(node, semdata)
+      return DateValue.today()
     else:
-      raise_error("TODO: Functions", node.lineno) # TODO
+      return call_subroutine(node, semdata)
   else:
-    print("Error, unknown node of type " + nodetype)
+    semdata.output.write("Error, unknown node of type " + nodetype)
+    semdata.output.end_line()
     return None
 
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+#
+
+# Bytecode compiler and virtual machine
+#
+# The checked syntax tree is compiled into flat bytecode: three parallel arrays
+# holding the opcode, the operand and the source line of every instruction.
+# The virtual machine runs it in a single dispatch loop with an operand stack.
+# FUNCTIONs and PROCEDUREs are compiled into the same code arrays and are called
+# with a frame stack kept by the VM itself, so When-level calls do not turn
+# into Python calls. Formals and local variables are accessed by the frame
+# slots given to them in the semantic analysis.
+
+from array import array
+from ast_nodes import node_line
+from datevalue import DateValue
+from memo import MISSING
+from output import FileSink
+from semantics_run import (raise_error, arithmetics, read_var_attribute, modify_date,
+                           add_ints, subtract_ints, multiply_ints)
+
+# Opcodes. The operand of each instruction is described after the name.
+OPNAMES = [
+    'CONST',         # index to constants, push the constant
+    'LOAD_GLOBAL',   # global slot (in semdata.globals), push the value of a global variable
+    'STORE_GLOBAL',  # global slot, pop a value into a global variable
+    'LOAD_LOCAL',    # frame slot, push the value of a formal or a local variable
+    'STORE_LOCAL',   # frame slot, pop a value into a formal or a local variable
+    'ADD',           # -, pop two values and push their sum
+    'SUB',           # -, pop two values and push their difference
+    'MUL',           # -, pop two values and push their product
+    'DIV',           # -, pop two values and push their quotient
+    'ADD_INT',       # -, ADD of two values known to be integers (see typecheck.py)
+    'SUB_INT',       # -, SUB of two values known to be integers
+    'MUL_INT',       # -, MUL of two values known to be integers
+    'OPERATE',       # index to constants (function), pop two values and push the function of them
+    'EQ',            # -, pop two values and push 1 if they are equal, else 0
+    'LT',            # -, pop two values and push 1 if the first is less, else 0
+    'READ_ATTR',     # index to constants (attribute name), replace a date with its attribute
+    'WRITE_ATTR',    # index to constants (attribute name), pop a value and a date, push the modified date
+    'JUMP',          # address, continue from the address
+    'JUMP_IF_FALSE', # address, pop a value and jump if it is false
+    'JUMP_IF_TRUE',  # address, pop a value and jump if it is true
+    'JUMP_IF_SET',   # address, jump if the topmost value is not None, else pop it
+    'CALL',          # index to functions, call a FUNCTION or a PROCEDURE
+    'RETURN',        # -, pop the return value and return from the current call
+    'POP',           # -, discard the topmost value
+    'DUP',           # -, push the topmost value again
+    'PRINT_ITEM',    # -, pop a value and print it followed by a space
+    'END_LINE',      # -, end the line printed by PRINT_ITEMs
+    'TODAY',         # -, push today's date
+    'ERROR',         # index to constants (message), print the message and continue
+    'STEP',          # -, count a step of the budget (only emitted when there is a budget)
+    'HALT',          # -, stop the program
+]
+
+(CONST, LOAD_GLOBAL, STORE_GLOBAL, LOAD_LOCAL, STORE_LOCAL, ADD, SUB, MUL, DIV, ADD_INT,
+ SUB_INT, MUL_INT, OPERATE, EQ, LT, READ_ATTR, WRITE_ATTR, JUMP, JUMP_IF_FALSE, JUMP_IF_TRUE, JUMP_IF_SET, CALL, RETURN, POP,
+ DUP, PRINT_ITEM, END_LINE, TODAY, ERROR, STEP, HALT) = range(len(OPNAMES))
+
+ARITHMETIC_OPS = {'+': ADD, '-': SUB, '*': MUL, '/': DIV}
+# Specialized operations (see typecheck.py) with an instruction of their own
+SPECIALIZED_OPS = {add_ints: ADD_INT, subtract_ints: SUB_INT, multiply_ints: MUL_INT}
+COMPARISON_OPS = {'=': EQ, '<': LT}
+
+
+class Function:
+    '''A compiled FUNCTION or PROCEDURE'''
+
+    def __init__(self, name, nargs, frame_size, memo=None):
+        self.name = name
+        self.nargs = nargs
+        self.frame_size = frame_size
+        self.memo = memo  # MemoTable if calls are memoized
+        self.entry = None
+
+
+class Bytecode:
+    '''A compiled program: instruction arrays, constants, globals and functions'''
+
+    def __init__(self):
+        self.ops = array('B')
+        self.args = array('q')
+        self.lines = array('l')
+        self.consts = []
+        self.const_index = dict()  # (type, value) -> index to consts
+        self.globals = []  # Values of the global variables (semdata.globals)
+        self.global_symbols = []  # SymbolData of each global slot
+        self.functions = []
+
+    def emit(self, op, arg=0, lineno=0):
+        '''Append an instruction, return its address'''
+        self.ops.append(op)
+        self.args.append(arg)
+        self.lines.append(lineno)
+        return len(self.ops) - 1
+
+    def patch(self, address, arg):
+        '''Set the operand of an already emitted (jump) instruction'''
+        self.args[address] = arg
+
+    def here(self):
+        return len(self.ops)
+
+    def const(self, value):
+        '''Return the index of a constant, adding it if needed'''
+        key = (type(value), value)
+        if key not in self.const_index:
+            self.const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return self.const_index[key]
+
+
+class BytecodeCompiler:
+    '''Compiles a checked syntax tree into Bytecode'''
+
+    def __init__(self, semdata):
+        self.semdata = semdata
+        self.code = Bytecode()
+        self.code.globals = semdata.globals
+        self.code.global_symbols = semdata.global_symbols
+        self.function_index = dict()  # function/procedure name -> index to code.functions
+        self.in_subroutine = False
+        # Steps are counted only when the program is run with a budget
+        self.budget = getattr(semdata, 'budget', None)
+
+    def compile_program(self, tree):
+        code = self.code
+        subroutines = [d for d in tree.children_definitions
+                       if d.nodetype in ('function_def', 'procedure_def')]
+        for definition in subroutines:
+            self.function_index[definition.value] = len(code.functions)
+            code.functions.append(Function(definition.value, len(definition.children_formals),
+                                           definition.frame_size,
+                                           self.semdata.memo_tables.get(definition.value)))
+        for definition in tree.children_definitions:
+            if definition.nodetype == 'variable_def':
+                self.compile_node(definition)
+        self.compile_statements(tree.children_statements)
+        code.emit(HALT)
+        for definition in subroutines:
+            self.compile_subroutine(definition)
+        return code
+
+    def compile_subroutine(self, node):
+        function = self.code.functions[self.function_index[node.value]]
+        function.entry = self.code.here()
+        self.in_subroutine = True
+        if node.nodetype == 'function_def':
+            self.compile_statements(node.children_variable_defs)
+            self.compile_node(node.child_body)
+        else:
+            self.compile_statements(node.children_var_defs)
+            self.compile_statements(node.children_statements)
+            self.code.emit(CONST, self.code.const(None))
+        self.code.emit(RETURN, 0, node.lineno)
+        self.in_subroutine = False
+
+    def compile_statements(self, nodes):
+        for node in nodes:
+            self.compile_node(node)
+            if node.nodetype == 'proc_call':
+                self.code.emit(POP)  # Discard the return value of a procedure without return type
+
+    def emit_load(self, symdata, lineno):
+        if symdata.scope == 'local':
+            self.code.emit(LOAD_LOCAL, symdata.slot, lineno)
+        else:
+            self.code.emit(LOAD_GLOBAL, symdata.slot, lineno)
+
+    def emit_store(self, symdata, lineno):
+        if symdata.scope == 'local':
+            self.code.emit(STORE_LOCAL, symdata.slot, lineno)
+        else:
+            self.code.emit(STORE_GLOBAL, symdata.slot, lineno)
+
+    def compile_node(self, node):
+        code = self.code
+        nodetype = node.nodetype
+        lineno = getattr(node, "lineno", 0)
+        if nodetype == 'variable_def':
+            self.compile_node(node.child_expression)
+            self.emit_store(node.symdata, lineno)
+        elif nodetype in ('int_literal', 'date_literal', 'string_literal'):
+            code.emit(CONST, code.const(node.value), lineno)
+        elif nodetype == 'var':
+            self.emit_load(node.symdata, lineno)
+            if hasattr(node, "child_read_attr"):
+                code.emit(READ_ATTR, code.const(node.child_read_attr.value), lineno)
+        elif nodetype == 'operation':
+            self.compile_node(node.child_left_expr)
+            self.compile_node(node.child_right_expr)
+            operate = getattr(node, "operate", None)
+            if operate in SPECIALIZED_OPS:
+                code.emit(SPECIALIZED_OPS[operate], 0, lineno)
+            elif operate is not None:
+                code.emit(OPERATE, code.const(operate), lineno)
+            else:
+                code.emit(ARITHMETIC_OPS[node.value], 0, lineno)
+        elif nodetype == 'comparison':
+            self.compile_node(node.child_left_expr)
+            self.compile_node(node.child_right_expr)
+            code.emit(COMPARISON_OPS[node.value], 0, lineno)
+        elif nodetype == 'assign':
+            lvalue = node.child_lvalue
+            if hasattr(lvalue, "child_write_attr"):  # Change a single attribute
+                self.emit_load(lvalue.symdata, lvalue.lineno)
+                self.compile_node(node.child_rvalue)
+                code.emit(WRITE_ATTR, code.const(lvalue.child_write_attr.value), lvalue.lineno)
+            else:
+                self.compile_node(node.child_rvalue)
+            self.emit_store(lvalue.symdata, lvalue.lineno)
+        elif nodetype == 'print_statement':
+            # Each item is printed when it has been evaluated, so the items
+            # before one failing are printed like in the other engines
+            for item in node.children_print_items:
+                self.compile_node(item)
+                code.emit(PRINT_ITEM, 0, lineno)
+            code.emit(END_LINE, 0, lineno)
+        elif nodetype == 'if_statement':
+            self.compile_node(node.child_condition)
+            jump_to_else = code.emit(JUMP_IF_FALSE)
+            self.compile_statements(node.children_if_branch)
+            if node.children_else_branch:
+                jump_to_end = code.emit(JUMP)
+                code.patch(jump_to_else, code.here())
+                self.compile_statements(node.children_else_branch)
+                code.patch(jump_to_end, code.here())
+            else:
+                code.patch(jump_to_else, code.here())
+        elif nodetype == 'if_expression':
+            self.compile_node(node.child_condition)
+            jump_to_else = code.emit(JUMP_IF_FALSE)
+            self.compile_node(node.child_if_body)
+            jump_to_end = code.emit(JUMP)
+            code.patch(jump_to_else, code.here())
+            self.compile_node(node.child_else_body)
+            code.patch(jump_to_end, code.here())
+        elif nodetype == 'while_loop':
+            # Temporaries of hoisted loop invariants (see optimize.py)
+            for symdata in getattr(node, "invariants", ()):
+                code.emit(CONST, code.const(None), lineno)
+                self.emit_store(symdata, lineno)
+            # The condition is placed after the body so that each round
+            # takes only one jump
+            jump_to_condition = code.emit(JUMP)
+            body = code.here()
+            if self.budget is not None:
+                code.emit(STEP, 0, node_line(node))
+            self.compile_statements(node.children_body)
+            code.patch(jump_to_condition, code.here())
+            self.compile_node(node.child_condition)
+            code.emit(JUMP_IF_TRUE, body)
+        elif nodetype == 'loop_invariant':
+            # Evaluated once per loop, when first needed
+            self.emit_load(node.symdata, lineno)
+            jump_to_end = code.emit(JUMP_IF_SET)
+            self.compile_node(node.child_expr)
+            code.emit(DUP)
+            self.emit_store(node.symdata, lineno)
+            code.patch(jump_to_end, code.here())
+        elif nodetype == 'return_statement':
+            self.compile_node(node.child_expr)
+            if not self.in_subroutine:
+                code.emit(HALT, 0, lineno)  # RETURN in the main program ends it
+            else:
+                code.emit(RETURN, 0, lineno)
+        elif nodetype == 'func_call' and node.value == 'Today':
+            code.emit(TODAY, 0, lineno)
+        elif nodetype in ('func_call', 'proc_call'):
+            for arg in node.children_args:
+                self.compile_node(arg)
+            if self.budget is not None:
+                code.emit(STEP, 0, lineno)
+            code.emit(CALL, self.function_index[node.value], lineno)
+        else:
+            code.emit(ERROR, code.const("Error, unknown node of type " + nodetype), lineno)
+            code.emit(CONST, code.const(None), lineno)
+
+
+def compile_bytecode(tree, semdata):
+    '''Compile a checked syntax tree into Bytecode'''
+    return BytecodeCompiler(semdata).compile_program(tree)
+
+
+def run_bytecode(code, max_depth=None, output=None, budget=None):
+    '''Execute Bytecode in the virtual machine
+
+       max_depth is the maximum depth of calls, None for no limit other than memory.
+       output is the sink (output.py) PRINT_ITEM writes to, by default stdout. It
+       is not flushed here.
+       budget is the budget.Budget STEP instructions count steps of. Its
+       max_depth applies if it is less than max_depth.'''
+    if output is None:
+        output = FileSink()
+    if budget is not None and budget.max_depth is not None:
+        max_depth = budget.max_depth if max_depth is None else min(max_depth, budget.max_depth)
+    write = output.write
+    end_line = output.end_line
+    ops = code.ops
+    args = code.args
+    lines = code.lines
+    consts = code.consts
+    functions = code.functions
+    global_vars = code.globals
+
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    frames = []  # (return address, frame, memo table, memo key) of each active call
+    frame = None
+    pc = 0
+    while True:
+        op = ops[pc]
+        arg = args[pc]
+        pc += 1
+        # Most frequent instructions first
+        if op == LOAD_LOCAL:
+            push(frame[arg])
+        elif op == LOAD_GLOBAL:
+            push(global_vars[arg])
+        elif op == CONST:
+            push(consts[arg])
+        elif op == STORE_GLOBAL:
+            global_vars[arg] = pop()
+        elif op == STORE_LOCAL:
+            frame[arg] = pop()
+        elif op == ADD_INT:
+            r_value = pop()
+            stack[-1] += r_value
+        elif op == SUB_INT:
+            r_value = pop()
+            stack[-1] -= r_value
+        elif op == LT:
+            r_value = pop()
+            stack[-1] = 1 if stack[-1] < r_value else 0
+        elif op == EQ:
+            r_value = pop()
+            stack[-1] = 1 if stack[-1] == r_value else 0
+        elif op == JUMP_IF_FALSE:
+            if not pop():
+                pc = arg
+        elif op == JUMP_IF_TRUE:
+            if pop():
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == JUMP_IF_SET:
+            if stack[-1] is not None:
+                pc = arg
+            else:
+                pop()
+        elif op == CALL:
+            function = functions[arg]
+            new_frame = [0] * function.frame_size
+            nargs = function.nargs
+            if nargs:
+                new_frame[:nargs] = stack[-nargs:]
+                del stack[-nargs:]
+            memo = function.memo
+            key = None
+            if memo is not None:
+                key = memo.key(new_frame[:nargs])
+                if key is not None:
+                    result = memo.lookup(key)
+                    if result is not MISSING:
+                        push(result)
+                        continue
+            if len(frames) == max_depth:
+                message = "maximum recursion depth " + str(max_depth) + " exceeded in '" + function.name + "'"
+                if budget is not None and max_depth == budget.max_depth:
+                    budget.exceeded(message, lines[pc - 1])
+                raise_error(message, lines[pc - 1])
+            frames.append((pc, frame, memo, key))
+            frame = new_frame
+            pc = function.entry
+        elif op == RETURN:
+            pc, frame, memo, key = frames.pop()
+            if key is not None:
+                memo.store(key, stack[-1])
+        elif op == MUL_INT:
+            r_value = pop()
+            stack[-1] *= r_value
+        elif op == OPERATE:
+            r_value = pop()
+            stack[-1] = consts[arg](stack[-1], r_value, lines[pc - 1])
+        # Operations on values of types not known before running
+        elif op == ADD:
+            r_value = pop()
+            l_value = stack[-1]
+            if type(l_value) is int and type(r_value) is int:
+                stack[-1] = l_value + r_value
+            else:
+                stack[-1] = arithmetics('+', l_value, r_value, lines[pc - 1])
+        elif op == SUB:
+            r_value = pop()
+            l_value = stack[-1]
+            if type(l_value) is int and type(r_value) is int:
+                stack[-1] = l_value - r_value
+            else:
+                stack[-1] = arithmetics('-', l_value, r_value, lines[pc - 1])
+        elif op == MUL:
+            r_value = pop()
+            stack[-1] = arithmetics('*', stack[-1], r_value, lines[pc - 1])
+        elif op == DIV:
+            r_value = pop()
+            stack[-1] = arithmetics('/', stack[-1], r_value, lines[pc - 1])
+        elif op == POP:
+            pop()
+        elif op == DUP:
+            push(stack[-1])
+        elif op == STEP:
+            budget.step(lines[pc - 1])
+        elif op == PRINT_ITEM:
+            write(str(pop()) + ' ')
+        elif op == END_LINE:
+            end_line()
+        elif op == READ_ATTR:
+            stack[-1] = read_var_attribute(consts[arg], stack[-1], lines[pc - 1])
+        elif op == WRITE_ATTR:
+            new_value = pop()
+            stack[-1] = modify_date(stack[-1], consts[arg], new_value, lines[pc - 1])
+        elif op == TODAY:
+            push(DateValue.today())
+        elif op == ERROR:
+            output.write(consts[arg])
+            output.end_line()
+        elif op == HALT:
+            break
+
+
+def disassemble(code, out=None):
+    '''Print a human readable listing of Bytecode'''
+    entries = {function.entry: function.name for function in code.functions}
+    for address, (op, arg, lineno) in enumerate(zip(code.ops, code.args, code.lines)):
+        if address in entries:
+            print(entries[address] + ":", file=out)
+        opname = OPNAMES[op]
+        if op in (CONST, READ_ATTR, WRITE_ATTR, ERROR):
+            detail = repr(code.consts[arg])
+        elif op == OPERATE:
+            detail = code.consts[arg].__name__
+        elif op in (LOAD_GLOBAL, STORE_GLOBAL):
+            detail = code.global_symbols[arg].defnode.value
+        elif op == CALL:
+            detail = code.functions[arg].name
+        else:
+            detail = ""
+        has_arg = op not in (ADD, SUB, MUL, DIV, ADD_INT, SUB_INT, MUL_INT, EQ, LT, RETURN, POP, DUP,
+                             PRINT_ITEM, END_LINE, TODAY, STEP, HALT)
+        print("{:>6} {:>5}  {:<14}{:>6}  {}".format(
+            "#" + str(lineno) if lineno else "", address, opname,
+            arg if has_arg else "", detail), file=out)
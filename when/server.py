@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+#
+
+# Execution server: runs When programs sent over a socket
+#
+#     python3 server.py --socket PATH | --port PORT [-j JOBS] [--timeout SECONDS]
+#     python3 server.py --socket PATH | --port PORT --send FILE...
+#
+# The server keeps a pool of worker processes (batch.Worker), each with its
+# lexer and parser made once and the programs it has checked kept in memory,
+# so a request costs no interpreter startup and a repeated program is not
+# parsed or checked again. Connections are served concurrently with asyncio,
+# and programs are run in the workers.
+#
+# Requests and responses are JSON objects, one per line. A request has either
+# the source of a program or the key of a program sent earlier:
+#
+#     {"id": 1, "source": "PRINT 1;"}
+#     {"id": 2, "program": "<key>", "engine": "vm", "timeout": 0.5, "max_steps": 100000}
+#
+# The response has the id of the request, the key of the program and the
+# result fields of batch.py (status, output, error, times). A program key the
+# server no longer remembers gives status "unknown_program", a request that
+# can't be read status "bad_request", and a program whose worker died status
+# "crash" (the pool of workers is then started again). The timeout and the
+# step limit of a request can't be more than those of the server.
+#
+# Backpressure: at most max_pending programs are queued or running at a time.
+# When that many are, the server stops reading requests until one finishes,
+# and clients are slowed down by their socket buffers filling up.
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import signal
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import batch
+from cache import source_key
+from semantics_run import DEFAULT_MAX_DEPTH, ENGINES
+
+DEFAULT_MAX_PROGRAMS = 256
+# Longest request line, a program source included
+MAX_REQUEST_SIZE = 16 * 2**20
+
+
+def run_request(source, key, engine, timeout, max_steps):
+    '''Run a program in a worker process'''
+    return batch._worker.run_source(source, {}, key, engine, timeout, max_steps)
+
+
+class Server:
+    '''Runs programs received over connections in a pool of workers'''
+
+    def __init__(self, jobs=None, engine='closure', memo_size=4096, max_depth=DEFAULT_MAX_DEPTH,
+                 optimize=True, timeout=batch.DEFAULT_TIMEOUT, max_programs=DEFAULT_MAX_PROGRAMS,
+                 max_pending=None, budget=None):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.timeout = timeout
+        self.options = (engine, memo_size, max_depth, optimize, timeout, max_programs, budget)
+        self.optimize = optimize
+        self.max_programs = max_programs
+        self.sources = OrderedDict()  # key -> source, least recently used first
+        self.pending = asyncio.Semaphore(max_pending or 2 * self.jobs)
+        self.pool = None
+
+    def start_pool(self):
+        self.pool = ProcessPoolExecutor(self.jobs, initializer=batch.init_worker,
+                                        initargs=self.options)
+
+    def restart_pool(self, broken):
+        '''Replace the pool broken, unless another request has already done it'''
+        if self.pool is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.start_pool()
+
+    def program_source(self, request):
+        '''Return (key, source) of the program of a request, source None if
+           the key is not known'''
+        source = request.get('source')
+        if source is not None:
+            if not isinstance(source, str):
+                raise ValueError("source must be a string")
+            key = source_key(source.encode('utf-8'), '' if self.optimize else 'no-optimize')
+            self.sources[key] = source
+            if len(self.sources) > self.max_programs:
+                self.sources.popitem(last=False)
+        else:
+            key = request.get('program')
+            if not isinstance(key, str):
+                raise ValueError("a request needs a source or a program key")
+            source = self.sources.get(key)
+        if source is not None:
+            self.sources.move_to_end(key)
+        return key, source
+
+    async def handle_request(self, line):
+        '''Return the response to a request line'''
+        request = dict()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                request = dict()
+                raise ValueError("a request must be a JSON object")
+            engine = request.get('engine')
+            if engine is not None and engine not in ENGINES:
+                raise ValueError("unknown engine '{}'".format(engine))
+            timeout = request.get('timeout', self.timeout)
+            if not isinstance(timeout, (int, float)) or not math.isfinite(timeout) or timeout < 0:
+                raise ValueError("timeout must be a non-negative number")
+            if self.timeout:
+                timeout = min(timeout, self.timeout) if timeout else self.timeout
+            max_steps = request.get('max_steps')
+            if max_steps is not None and (type(max_steps) is not int or max_steps < 0):
+                raise ValueError("max_steps must be a non-negative integer")
+            key, source = self.program_source(request)
+        except ValueError as error:
+            return {'id': request.get('id'), 'status': 'bad_request', 'error': str(error)}
+        response = {'id': request.get('id'), 'program': key}
+        if source is None:
+            response.update(status='unknown_program', error="unknown program '{}'".format(key))
+            return response
+        async with self.pending:
+            loop = asyncio.get_running_loop()
+            pool = self.pool
+            try:
+                result = await loop.run_in_executor(pool, run_request, source, key, engine,
+                                                    timeout, max_steps)
+            except Exception as error:
+                if isinstance(error, BrokenProcessPool):
+                    # A worker died (e.g. killed for using too much memory)
+                    self.restart_pool(pool)
+                result = {'status': 'crash', 'output': [], 'times': {},
+                          'error': "{}: {}".format(type(error).__name__, error)}
+        response.update(result)
+        return response
+
+    async def handle_connection(self, reader, writer):
+        '''Answer the requests of a connection, in order'''
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # Longer than MAX_REQUEST_SIZE
+                    writer.write(json.dumps({'id': None, 'status': 'bad_request',
+                                             'error': "request too long"}).encode('utf-8') + b'\n')
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                response = await self.handle_request(line)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host='127.0.0.1', port=None):
+        '''Serve on a Unix socket at path, or on a TCP port, until cancelled
+           or terminated (SIGTERM)'''
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        self.start_pool()
+        try:
+            if path is not None:
+                server = await asyncio.start_unix_server(self.handle_connection, path,
+                                                         limit=MAX_REQUEST_SIZE)
+            else:
+                server = await asyncio.start_server(self.handle_connection, host, port,
+                                                    limit=MAX_REQUEST_SIZE)
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+
+def send(sources, path=None, host='127.0.0.1', port=None):
+    '''Send program sources to a server and generate its responses'''
+    import socket
+    if path is not None:
+        connection = socket.socket(socket.AF_UNIX)
+        connection.connect(path)
+    else:
+        connection = socket.create_connection((host, port))
+    with connection, connection.makefile('rwb') as stream:
+        for i, source in enumerate(sources):
+            stream.write(json.dumps({'id': i, 'source': source}).encode('utf-8') + b'\n')
+            stream.flush()
+            yield json.loads(stream.readline())
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='serve When program runs over a socket')
+    address = argParser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', metavar='PATH', help='Unix socket to listen on')
+    address.add_argument('--port', type=int, help='TCP port to listen on')
+    argParser.add_argument('--host', default='127.0.0.1', help='TCP address to listen on (default 127.0.0.1)')
+    argParser.add_argument('--send', nargs='+', metavar='FILE',
+                           help='send programs to a running server and print their output')
+    argParser.add_argument('-j', '--jobs', type=int, default=None,
+                           help='worker processes (default one per CPU)')
+    argParser.add_argument('--timeout', type=float, default=batch.DEFAULT_TIMEOUT,
+                           help='most seconds allowed per program (default 10, 0 for no limit)')
+    argParser.add_argument('-e', '--engine', choices=ENGINES, default='closure', help='default execution engine')
+    argParser.add_argument('--memo-size', type=int, default=4096,
+                           help='results memoized per pure function (0 disables memoization)')
+    argParser.add_argument('--max-depth', type=int, default=DEFAULT_MAX_DEPTH,
+                           help='maximum depth of function/procedure calls in the vm engine')
+    argParser.add_argument('--max-steps', type=int, default=None,
+                           help='loop rounds and function/procedure calls allowed per program')
+    argParser.add_argument('--max-memory', type=float, default=None,
+                           help='megabytes a worker may grow by while running a program')
+    argParser.add_argument('--no-optimize', action='store_true', help='run the programs as written')
+    argParser.add_argument('--max-programs', type=int, default=DEFAULT_MAX_PROGRAMS,
+                           help='checked programs kept in memory (default 256)')
+    argParser.add_argument('--max-pending', type=int, default=None,
+                           help='programs queued or running at a time (default twice the jobs)')
+    ns = argParser.parse_args()
+
+    if ns.send:
+        sources = []
+        for filename in ns.send:
+            with open(filename, encoding='utf-8') as infile:
+                sources.append(infile.read())
+        for response in send(sources, ns.socket, ns.host, ns.port):
+            for line in response.get('output', []):
+                print(line)
+            if response['status'] not in ('ok', 'run_error', 'limit_exceeded'):
+                print(response['error'], file=sys.stderr)
+    else:
+        server = Server(ns.jobs, ns.engine, ns.memo_size, ns.max_depth, not ns.no_optimize,
+                        ns.timeout, ns.max_programs, ns.max_pending,
+                        batch.make_budget(ns.max_steps, ns.max_memory))
+        try:
+            asyncio.run(server.serve(ns.socket, ns.host, ns.port))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
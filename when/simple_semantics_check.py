@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 #
 
-from semantics_common import visit_tree
+from semantics_common import Check, run_checks
 
 WRITABLE_ATTRIBUTES = ["day", "month", "year"]
 READABLE_ATTRIBUTES = ["day", "month", "year", "weekday", "weeknum"]
@@ -35,7 +35,7 @@ def check_return_and_param_types(node, semdata):
 
 def count_while_and_if_level_before(node, semdata):
     nodetype = node.nodetype
-    if nodetype == 'while loop':
+    if nodetype == 'while_loop':
         semdata.nested_whiles += 1
         return None
 
@@ -52,7 +52,7 @@ def count_while_and_if_level_before(node, semdata):
 
 def count_while_and_if_level_after(node, semdata):
     nodetype = node.nodetype
-    if nodetype == 'while loop':
+    if nodetype == 'while_loop':
         semdata.nested_whiles -= 1
         return None
 
@@ -71,16 +71,26 @@ def check_proc_defs(node, semdata):
                 return None
 
 
-def semantic_checks(tree, semdata):
-    '''run simple semantic checks'''
+# The checks of this module, run in a single traversal of the tree
+CHECKS = [
+    Check(['write_attribute', 'read_attribute'], check_attributes),
+    Check(['procedure_def', 'function_def', 'formal_arg'], check_return_and_param_types),
+    Check(['while_loop', 'if_statement', 'return_statement'],
+          count_while_and_if_level_before, count_while_and_if_level_after),
+    Check(['procedure_def'], check_proc_defs),
+]
+
+
+def init_semdata(semdata):
     semdata.nested_ifs = 0
     semdata.nested_whiles = 0
-    visit_tree(tree, check_attributes, None, semdata)
-    visit_tree(tree, check_return_and_param_types, None, semdata)
-    visit_tree(tree, count_while_and_if_level_before,
-               count_while_and_if_level_after, semdata)
-    visit_tree(tree, check_proc_defs, None, semdata)
+
+
+def semantic_checks(tree, semdata):
+    '''run simple semantic checks'''
+    init_semdata(semdata)
+    run_checks(tree, CHECKS, semdata)
 
 
 def run_simple_semantic_checks(tree, semdata):
-    semantic_checks(tree, semdata)
\ No newline at end of file
+    semantic_checks(tree, semdata)
@@ -1,61 +1,91 @@
 #!/usr/bin/env python3
 #
 
-from simple_semantics_check import run_simple_semantic_checks
-from semantics_common import visit_tree, SymbolData, SemData
+import simple_semantics_check
+import memo
+import typecheck
+from semantics_common import Check, run_checks, run_checks_multipass, SymbolData, SemData
 
 # Define semantic check functions
 
 
 # Collect variables to the symbol table
+# Formals and variables of a FUNCTION/PROCEDURE go to a local symbol table
+# and get a slot in the frame of the definition
 def add_vars(node, semdata):
   nodetype = node.nodetype
-  if nodetype == 'variable_def':
+  if nodetype == 'function_def' or nodetype == 'procedure_def':
+    semdata.localtbl = dict()
+
+  elif nodetype == 'variable_def':
     var_name = node.value
-    if var_name in semdata.symtbl:
-      definition_node = semdata.symtbl[var_name].defnode
+    symtbl = semdata.symtbl if semdata.localtbl is None else semdata.localtbl
+    if var_name in symtbl:
+      definition_node = symtbl[var_name].defnode
       # Variable is already in the symbol table
       return "Error, redefined variable '" + var_name + "' (earlier definition on line "+str(definition_node.lineno)+")"
     else:
       # Add variable to symbol table
-      symdata = SymbolData('var', node)
-      semdata.symtbl[var_name] = symdata
+      if semdata.localtbl is None:
+        symdata = semdata.add_global(SymbolData('var', node))
+      else:
+        symdata = SymbolData('var', node, 'local', len(symtbl))
+      symtbl[var_name] = symdata
       node.symdata = symdata  # Add a link to the symbol data to AST node for execution
 
   elif nodetype == 'formal_arg':
     arg_name = node.value
-    if arg_name in semdata.symtbl:
-      definition_node = semdata.symtbl[arg_name].defnode
+    if arg_name in semdata.localtbl:
       return "Error, multiple arguments with the same name '" + arg_name + "'"
     else:
-      symdata = SymbolData('arg', node)
-      semdata.symtbl[arg_name] = symdata
+      symdata = SymbolData('arg', node, 'local', len(semdata.localtbl))
+      semdata.localtbl[arg_name] = symdata
       node.symdata = symdata
 
   elif nodetype == 'var':
     var_name = node.value
-    if var_name not in semdata.symtbl:
+    if semdata.localtbl is not None and var_name in semdata.localtbl:
+      node.symdata = semdata.localtbl[var_name]
+    elif var_name not in semdata.symtbl:
       return "Error, undefined variable '" + var_name + "'"
     else:
       # Add symbol data link to variable's AST node (for execution)
       node.symdata = semdata.symtbl[var_name]
 
+def add_vars_after(node, semdata):
+  nodetype = node.nodetype
+  if nodetype == 'function_def' or nodetype == 'procedure_def':
+    # Size of the frame array a call needs
+    node.frame_size = len(semdata.localtbl)
+    semdata.localtbl = None
+
+# Definitions can only appear at the top level of the program, so they are
+# collected when the program node is found, and subroutines can be called
+# before their definition
+def collect_functions_and_procedures(node, semdata):
+  if node.nodetype == 'program':
+    for definition in node.children_definitions:
+      nodetype = definition.nodetype
+      name = definition.value
+      if (nodetype == 'function_def' or nodetype == 'procedure_def') and name not in semdata.symtbl:
+        symtype = 'func' if nodetype == 'function_def' else 'proc'
+        semdata.symtbl[name] = SymbolData(symtype, definition)
+
 def add_functions_and_procedures(node, semdata):
   nodetype = node.nodetype
   if nodetype == 'function_def' or nodetype == 'procedure_def':
     name = node.value
-    if name in semdata.symtbl:
-      definition_node = semdata.symtbl[name].defnode
+    definition_node = semdata.symtbl[name].defnode
+    if definition_node is not node:
       return "Error, redefined '" + name + "' (earlier definition on line " + str(definition_node.lineno)+")"
     else:
-      symtype = 'func' if nodetype == 'function_def' else 'proc'
-      symdata = SymbolData(symtype, node)
-      semdata.symtbl[name] = symdata
-      node.symdata = symdata
-  
-  elif nodetype == 'func_call' or nodetype == 'proc_call':
+      node.symdata = semdata.symtbl[name]
+
+def check_calls(node, semdata):
+  nodetype = node.nodetype
+  if nodetype == 'func_call' or nodetype == 'proc_call':
     name = node.value
-    if name not in semdata.symtbl:       
+    if name not in semdata.symtbl:
       if name == 'Today': # Today() is a built-in function
         return None
       else:
@@ -109,17 +139,45 @@ def print_symbol_table(semdata, title):
       print("  ", attr, "=", printvalue)
 
 
+# All semantic checks, run in a single traversal of the tree. Checks for
+# the same node are called in this order.
+CHECKS = simple_semantics_check.CHECKS + [
+  Check(['function_def', 'procedure_def', 'variable_def', 'formal_arg', 'var'],
+        add_vars, add_vars_after),
+  Check(['program'], collect_functions_and_procedures),
+  Check(['function_def', 'procedure_def'], add_functions_and_procedures),
+  Check(['func_call', 'proc_call'], check_calls),
+  Check(['print_statement', 'return_statement', 'expr', 'proc_call'],
+        check_procs_before, check_procs_after),
+  # Find FUNCTIONs whose calls can be memoized
+  Check(['function_def', 'func_call', 'proc_call', 'var'],
+        memo.purity_before, memo.purity_after, memo.mark_pure_functions),
+  # Infer the types of expressions and check that they go together
+  Check(['procedure_def', 'function_def', 'formal_arg', 'variable_def', 'var', 'int_literal',
+         'date_literal', 'operation', 'comparison', 'if_expression', 'func_call', 'proc_call',
+         'assign', 'return_statement'],
+        typecheck.types_before, typecheck.infer_types),
+]
+
+
+def init_semdata(semdata):
+  simple_semantics_check.init_semdata(semdata)
+  semdata.inside_expr = 0
+  memo.init_purity(semdata)
+  typecheck.init_types(semdata)
+
+
 def semantic_checks(tree, semdata):
   '''run all semantic checks'''
-  # First run simple semantic checks implemented previously
-  run_simple_semantic_checks(tree, semdata)
-  # Gather variables and check their usage:
-  visit_tree(tree, add_vars, None, semdata)
-  # Gather and check function definitions:
-  visit_tree(tree, add_functions_and_procedures, None, semdata)
-  semdata.inside_expr = 0
-  visit_tree(tree, check_procs_before, check_procs_after, semdata)
+  init_semdata(semdata)
+  run_checks(tree, CHECKS, semdata)
 
   # print_symbol_table(semdata, "Symbol table before:")  # Just for debugging
 
 
+def semantic_checks_multipass(tree, semdata):
+  '''run all semantic checks, one traversal of the tree per check
+
+     Gives the same result as semantic_checks, kept for comparing the two.'''
+  init_semdata(semdata)
+  run_checks_multipass(tree, CHECKS, semdata)
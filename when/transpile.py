@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+#
+
+# Python backend: a checked When program translated into Python source
+#
+# FUNCTIONs and PROCEDUREs become Python functions with their formals and
+# local variables as locals, global variables (and the temporaries of hoisted
+# loop invariants) become module globals, and WHILE loops and IFs become
+# native loops and conditionals. Operations whose operand types are known (see
+# typecheck.py) become Python operators for ints and calls to the specialized
+# functions of semantics_run for the others. The source is compiled with
+# compile() and run with exec, so CPython's own compiler and interpreter do
+# the work.
+#
+# The program runs like in the closure engine: PRINT items are written as
+# they are evaluated, calls to pure FUNCTIONs are memoized, and steps and the
+# call depth are counted only when there is a budget. run_python puts the
+# output sink, the memo tables and the budget of the run in the globals of the
+# module before calling its main(). The module also runs as a script, with
+# the interpreter's directory on the Python path:
+#
+#     python3 main.py -f prog.when --emit-python prog.py
+#     PYTHONPATH=. python3 prog.py
+
+from ast_nodes import node_line
+from datevalue import DateValue
+from semantics_run import raise_error, recursion_too_deep
+
+INDENT = '    '
+# File name of the generated module in tracebacks
+SOURCE_NAME = '<when>'
+
+# Precedences of the generated Python expressions, higher binds tighter
+CONDITIONAL = 1
+OR_TEST = 2
+COMPARISON = 3
+ARITHMETIC_OPERAND = 4
+SUM = 5
+PRODUCT = 6
+UNARY = 7
+ATOM = 9
+
+# Operations done with a Python operator: function -> (operator, precedence)
+OPERATORS = {
+    'add_ints': ('+', SUM),
+    'subtract_ints': ('-', SUM),
+    'multiply_ints': ('*', PRODUCT),
+}
+COMPARISONS = {'=': '==', '<': '<'}
+
+HEADER = '''\
+# Generated from a When program by transpile.py
+
+from datevalue import DateValue
+from memo import MISSING, MemoTable
+from semantics_run import (add_days_to_date, arithmetics, divide_ints, modify_date,
+                           read_var_attribute, subtract_dates, subtract_days_from_date)
+
+# Set by run_python, or below when run as a script
+output = write = end_line = write_line = budget = None
+
+
+def unknown(nodetype):
+    write("Error, unknown node of type " + nodetype)
+    end_line()
+'''
+
+FOOTER = '''
+
+if __name__ == '__main__':
+    from output import FileSink
+    from semantics_run import RunError
+    output = FileSink()
+    write, end_line, write_line = output.write, output.end_line, output.write_line
+    try:
+        main()
+    except RunError as error:
+        output.write(error.message)
+        output.end_line()
+    finally:
+        output.flush()
+'''
+
+
+def variable_name(symdata):
+    '''Python name of a variable, formal or temporary
+
+       Formals and local variables have a prefix of their own, so that a
+       local variable doesn't hide a global one read before it is defined.'''
+    if symdata.symtype == 'temp':
+        return 't_' + symdata.defnode.value
+    if symdata.scope != 'global':
+        return 'l_' + symdata.defnode.value
+    return 'v_' + symdata.defnode.value
+
+
+def cannot_fail(node):
+    '''Can an expression be evaluated without a run-time error'''
+    nodetype = node.nodetype
+    if nodetype in ('int_literal', 'date_literal', 'string_literal'):
+        return True
+    if nodetype == 'var':
+        return not hasattr(node, 'child_read_attr')
+    if nodetype == 'operation':
+        return (getattr(node, 'operate', None) is not None and node.operate.__name__ in OPERATORS
+                and cannot_fail(node.child_left_expr) and cannot_fail(node.child_right_expr))
+    if nodetype == 'comparison':
+        return cannot_fail(node.child_left_expr) and cannot_fail(node.child_right_expr)
+    if nodetype == 'if_expression':
+        return (cannot_fail(node.child_condition) and cannot_fail(node.child_if_body)
+                and cannot_fail(node.child_else_body))
+    if nodetype == 'loop_invariant':
+        return cannot_fail(node.child_expr)
+    return False
+
+
+def assigned_globals(statements):
+    '''Return the Python names of the global variables assigned in statements'''
+    names = []
+    stack = list(statements)
+    while stack:
+        node = stack.pop()
+        if node.nodetype == 'assign' and node.child_lvalue.symdata.scope == 'global':
+            name = variable_name(node.child_lvalue.symdata)
+            if name not in names:
+                names.append(name)
+        for name in ('children_body', 'children_if_branch', 'children_else_branch'):
+            stack.extend(getattr(node, name, ()))
+    return names
+
+
+class PythonGenerator:
+    '''Translates a checked syntax tree into the source of a Python module
+
+       memo_tables are the memo tables (memo.py) of the FUNCTIONs to memoize,
+       and budget is the budget.Budget of the run, None if there is none.'''
+
+    def __init__(self, semdata, memo_tables, budget=None):
+        self.semdata = semdata
+        self.memo_tables = memo_tables
+        self.budget = budget
+        self.lines = []
+        self.level = 0
+        self.lineno = 0  # When line of the statement being translated
+        self.line_numbers = dict()  # index in self.lines -> When line
+        self.source_lines = dict()  # line of the generated source -> When line
+        self.constants = dict()  # date -> Python name
+        self.in_subroutine = False
+
+    def emit(self, line):
+        self.line_numbers[len(self.lines)] = self.lineno
+        self.lines.append(INDENT * self.level + line)
+
+    def constant(self, value):
+        name = self.constants.get(value)
+        if name is None:
+            name = self.constants[value] = 'd_' + str(len(self.constants))
+        return name
+
+    def generate(self, tree):
+        '''Return the source of the module'''
+        lines = [HEADER]
+        body = self.lines
+        for definition in tree.children_definitions:
+            if definition.nodetype == 'function_def':
+                self.function(definition)
+            elif definition.nodetype == 'procedure_def':
+                self.procedure(definition)
+        self.main(tree)
+
+        for value, name in self.constants.items():
+            lines.append("{} = DateValue({})  # {}".format(name, int(value), value))
+        for name, memo in self.memo_tables.items():
+            arg_types = ', '.join(arg_type.__name__ if arg_type is not None else 'None'
+                                  for arg_type in memo.arg_types)
+            lines.append("m_{} = MemoTable({!r}, [{}], {})".format(name, name, arg_types, memo.max_size))
+        for symdata in self.semdata.global_symbols:
+            lines.append(variable_name(symdata) + " = 0")
+        offset = '\n'.join(lines).count('\n') + 2  # Line number of body[0]
+        self.source_lines = {offset + index: lineno for index, lineno in self.line_numbers.items()}
+        lines.extend(body)
+        lines.append(FOOTER)
+        return '\n'.join(lines)
+
+    # Definitions
+
+    def signature(self, node):
+        self.lineno = node.lineno
+        args = [variable_name(formal.symdata) for formal in node.children_formals]
+        if self.budget is not None:
+            args.append('lineno')  # of the call, for the errors of the budget
+        self.lines.append('')
+        self.lines.append('')
+        self.emit("def f_{}({}):".format(node.value, ', '.join(args)))
+        self.level += 1
+        if self.budget is not None:
+            self.emit("budget.step(lineno)")
+
+    def local_definitions(self, var_defs):
+        for var_def in var_defs:
+            # A VAR read in its own initializer has the initial value 0
+            if any(node.nodetype == 'var' and node.symdata is var_def.symdata
+                   for node in subtree(var_def.child_expression)):
+                self.emit(variable_name(var_def.symdata) + " = 0")
+            self.statement(var_def)
+
+    def function(self, node):
+        self.in_subroutine = True
+        self.signature(node)
+        memo = node.value in self.memo_tables
+        if memo:
+            formals = [variable_name(formal.symdata) for formal in node.children_formals]
+            self.emit("key = (" + ''.join(name + ', ' for name in formals).rstrip(' ') + ")")
+            self.emit("result = m_{}.lookup(key)".format(node.value))
+            self.emit("if result is not MISSING:")
+            self.emit(INDENT + "return result")
+        if self.budget is not None:
+            self.emit("budget.enter({!r}, lineno)".format(node.value))
+        self.local_definitions(node.children_variable_defs)
+        self.lineno = node_line(node.child_body)
+        body = self.expression(node.child_body)
+        if not memo and self.budget is None:
+            self.emit("return " + body)
+        else:
+            self.emit("result = " + body)
+            if self.budget is not None:
+                self.emit("budget.leave()")
+            if memo:
+                self.emit("m_{}.store(key, result)".format(node.value))
+            self.emit("return result")
+        self.level -= 1
+        self.in_subroutine = False
+
+    def procedure(self, node):
+        self.in_subroutine = True
+        self.signature(node)
+        names = assigned_globals(node.children_statements)
+        if names:
+            self.emit("global " + ', '.join(names))
+        if self.budget is not None:
+            self.emit("budget.enter({!r}, lineno)".format(node.value))
+        self.local_definitions(node.children_var_defs)
+        result = self.body(node.children_statements)
+        if self.budget is not None:
+            if result is not None:
+                self.emit("result = " + result)
+            self.emit("budget.leave()")
+            if result is not None:
+                self.emit("return result")
+        elif result is not None:
+            self.emit("return " + result)
+        elif not node.children_var_defs and not node.children_statements:
+            self.emit("pass")
+        self.level -= 1
+        self.in_subroutine = False
+
+    def main(self, tree):
+        self.lines.append('')
+        self.lines.append('')
+        self.lineno = 0
+        self.emit("def main():")
+        self.level += 1
+        names = [variable_name(symdata) for symdata in self.semdata.global_symbols]
+        if names:
+            self.emit("global " + ', '.join(names))
+        for definition in tree.children_definitions:
+            if definition.nodetype == 'variable_def':
+                self.statement(definition)
+        result = self.body(tree.children_statements)
+        if result is not None:
+            # RETURN ends the program, its value is not used
+            self.emit(result)
+        if len(self.lines) and self.lines[-1].endswith("def main():"):
+            self.emit("pass")
+        self.level -= 1
+
+    # Statements
+
+    def body(self, statements):
+        '''Emit the statements of a program or PROCEDURE, and return the
+           expression of its RETURN statement, None if there is none
+
+           A RETURN can only end the statement list directly, the statements
+           after it are not run.'''
+        for statement in statements:
+            if statement.nodetype == 'return_statement':
+                self.lineno = node_line(statement)
+                return self.expression(statement.child_expr)
+            self.statement(statement)
+        return None
+
+    def block(self, statements):
+        self.level += 1
+        for statement in statements:
+            self.statement(statement)
+        if not statements:
+            self.emit("pass")
+        self.level -= 1
+
+    def statement(self, node):
+        self.lineno = node_line(node)
+        nodetype = node.nodetype
+        if nodetype == 'variable_def':
+            self.emit(variable_name(node.symdata) + " = " + self.expression(node.child_expression))
+        elif nodetype == 'assign':
+            lvalue = node.child_lvalue
+            name = variable_name(lvalue.symdata)
+            if hasattr(lvalue, 'child_write_attr'):  # Change a single attribute
+                self.emit("{} = modify_date({}, {!r}, {}, {})".format(
+                    name, name, lvalue.child_write_attr.value, self.expression(node.child_rvalue),
+                    lvalue.lineno))
+            else:
+                self.emit(name + " = " + self.expression(node.child_rvalue))
+        elif nodetype == 'print_statement':
+            items = node.children_print_items
+            if all(cannot_fail(item) for item in items):
+                self.emit("write_line((" + ''.join(self.expression(item) + ', ' for item in items)
+                          .rstrip(' ') + "))")
+            else:
+                # Items printed before an error are written
+                for item in items:
+                    if item.nodetype == 'string_literal':
+                        self.emit("write({!r})".format(str(item.value) + ' '))
+                    else:
+                        self.emit("write(str(" + self.expression(item) + ") + ' ')")
+                self.emit("end_line()")
+        elif nodetype == 'if_statement':
+            self.emit("if " + self.condition(node.child_condition) + ":")
+            self.block(node.children_if_branch)
+            if node.children_else_branch:
+                self.emit("else:")
+                self.block(node.children_else_branch)
+        elif nodetype == 'while_loop':
+            # Temporaries of hoisted loop invariants (see optimize.py)
+            for symdata in getattr(node, 'invariants', ()):
+                self.emit(variable_name(symdata) + " = None")
+            self.emit("while " + self.condition(node.child_condition) + ":")
+            if self.budget is not None:
+                self.level += 1
+                self.emit("budget.step({})".format(node_line(node)))
+                self.level -= 1
+                if not node.children_body:
+                    return
+            self.block(node.children_body)
+        elif nodetype == 'proc_call':
+            self.emit(self.expression(node))
+        else:
+            # e.g. a RETURN inside an IF or a WHILE
+            self.emit("unknown({!r})".format(nodetype))
+
+    # Expressions
+
+    def condition(self, node):
+        '''Source of an expression used only for its truth value'''
+        if node.nodetype == 'comparison':
+            return self.comparison(node)
+        return self.operand(node, OR_TEST)
+
+    def comparison(self, node):
+        return (self.operand(node.child_left_expr, ARITHMETIC_OPERAND) + " "
+                + COMPARISONS[node.value] + " "
+                + self.operand(node.child_right_expr, ARITHMETIC_OPERAND))
+
+    def operand(self, node, precedence):
+        '''Source of an expression, in parentheses if it binds less tightly
+           than precedence'''
+        text, own = self.generate_expression(node)
+        return text if own >= precedence else "(" + text + ")"
+
+    def expression(self, node):
+        return self.generate_expression(node)[0]
+
+    def generate_expression(self, node):
+        '''Return the source of an expression and its precedence'''
+        nodetype = node.nodetype
+        if nodetype in ('int_literal', 'string_literal'):
+            value = node.value
+            return repr(value), UNARY if type(value) is int and value < 0 else ATOM
+        if nodetype == 'date_literal':
+            if type(node.value) is DateValue:
+                return self.constant(node.value), ATOM
+            return repr(node.value), ATOM  # A sign, see main.p_factor
+        if nodetype == 'var':
+            name = variable_name(node.symdata)
+            if hasattr(node, 'child_read_attr'):
+                return "read_var_attribute({!r}, {}, {})".format(
+                    node.child_read_attr.value, name, node.lineno), ATOM
+            return name, ATOM
+        if nodetype == 'operation':
+            lineno = getattr(node, 'lineno', 0)
+            operate = getattr(node, 'operate', None)
+            if operate is not None and operate.__name__ in OPERATORS:
+                operator, precedence = OPERATORS[operate.__name__]
+                return (self.operand(node.child_left_expr, precedence) + " " + operator + " "
+                        + self.operand(node.child_right_expr, precedence + 1)), precedence
+            left = self.expression(node.child_left_expr)
+            right = self.expression(node.child_right_expr)
+            if operate is not None:
+                return "{}({}, {}, {})".format(operate.__name__, left, right, lineno), ATOM
+            return "arithmetics({!r}, {}, {}, {})".format(node.value, left, right, lineno), ATOM
+        if nodetype == 'comparison':
+            return "1 if " + self.comparison(node) + " else 0", CONDITIONAL
+        if nodetype == 'if_expression':
+            return (self.operand(node.child_if_body, OR_TEST) + " if "
+                    + self.condition(node.child_condition) + " else "
+                    + self.operand(node.child_else_body, CONDITIONAL)), CONDITIONAL
+        if nodetype == 'loop_invariant':
+            # Evaluated once per loop, when first needed
+            name = variable_name(node.symdata)
+            return "{} if {} is not None else ({} := {})".format(
+                name, name, name, self.expression(node.child_expr)), CONDITIONAL
+        if nodetype == 'func_call' or nodetype == 'proc_call':
+            if node.value == 'Today':
+                return "DateValue.today()", ATOM
+            args = [self.expression(arg) for arg in node.children_args]
+            if self.budget is not None:
+                args.append(str(node.lineno))
+            return "f_{}({})".format(node.value, ', '.join(args)), ATOM
+        raise ValueError("unknown node of type " + nodetype)
+
+
+def subtree(node):
+    '''Generate the nodes of a subtree'''
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        for name, is_list in type(node).child_schema:
+            child = getattr(node, name, None)
+            if is_list:
+                stack.extend(child or ())
+            elif child is not None:
+                stack.append(child)
+
+
+def transpile(tree, semdata, memo_tables=None, budget=None):
+    '''Return the source of a Python module running a checked tree
+
+       memo_tables are the memo tables of the FUNCTIONs to memoize (see
+       memo.make_memo_tables), none by default. With a budget, the module
+       counts steps and call depths in the budget given to it when run.'''
+    return PythonGenerator(semdata, memo_tables or dict(), budget).generate(tree)
+
+
+def call_line(traceback, source_lines):
+    '''Return the When line of the innermost call from the generated module
+       to itself in a traceback, 0 if there is none'''
+    lineno = 0
+    while traceback is not None and traceback.tb_next is not None:
+        if (traceback.tb_frame.f_code.co_filename == SOURCE_NAME
+                and traceback.tb_next.tb_frame.f_code.co_filename == SOURCE_NAME):
+            lineno = source_lines.get(traceback.tb_lineno, lineno)
+        traceback = traceback.tb_next
+    return lineno
+
+
+def run_python(tree, semdata):
+    '''Translate a checked tree into Python and run it with the output sink,
+       memo tables and budget of semdata (see run_program)'''
+    generator = PythonGenerator(semdata, semdata.memo_tables, semdata.budget)
+    source = generator.generate(tree)
+    try:
+        code = compile(source, SOURCE_NAME, 'exec')
+    except SyntaxError as error:  # e.g. too many nested parentheses
+        raise_error("the program is nested too deeply for the 'python' engine (" + error.msg + ")")
+    namespace = {'__name__': 'when_program'}
+    exec(code, namespace)
+    output = semdata.output
+    namespace.update(output=output, write=output.write, end_line=output.end_line,
+                     write_line=output.write_line, budget=semdata.budget)
+    for name, memo in semdata.memo_tables.items():
+        namespace['m_' + name] = memo
+    try:
+        namespace['main']()
+    except RecursionError as error:
+        recursion_too_deep('python', call_line(error.__traceback__, generator.source_lines))
+    finally:
+        # Leave the final values of the global variables in semdata.globals
+        for symdata in semdata.global_symbols:
+            semdata.globals[symdata.slot] = namespace[variable_name(symdata)]
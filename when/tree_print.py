@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # ----------------------------------------------------------------------
 
+import itertools
+import sys
+
 # Values to control the module's working
 
 # How to recognize attributes in nodes by their names
@@ -11,10 +14,54 @@ value_attr = "value"
 nodetype_attr = "nodetype"
 lineno_attr = "lineno"
 type_attr = "type"
+child_fields_attr = "child_fields"
 
 # Finding and creating a list of all children nodes of a node, based on
 # attribute names of a node
 
+def child_names(node):
+  '''Return the names of the attributes of a node that may refer to children'''
+  # Syntax tree nodes (ast_nodes.py) list their child attributes, other
+  # objects are searched for attributes with the prefixes
+  child_fields = getattr(type(node), child_fields_attr, None)
+  if child_fields is not None:
+    return [name for name in child_fields if hasattr(node, name)]
+  elif hasattr(node, "__dict__"):
+    return list(vars(node))
+  return []
+
+def iter_childvars(node, child_prefix=child_prefix_default,
+                   children_prefix=children_prefix_default):
+  '''Generate the (label, child) pairs of get_childvars one at a time
+
+  This way a node with a long child list (e.g. the statements of a large
+  program) doesn't need a list of all its labels while they are printed.'''
+
+  # Iterate though all attributes of the node object
+  for name in child_names(node):
+    val = getattr(node, name)
+    # An attribute containing one child node
+    if name.startswith(child_prefix):
+      label = name[len(child_prefix):]
+      yield (label, val)
+    # An attribute containing a child list
+    elif name.startswith(children_prefix):
+      label = name[len(children_prefix):]
+      # Make sure contents is not None and is a list (or actually, can
+      # be iterated through
+      if val is None:
+        yield (label+"[NONE stored instead of a list!!!]", None)
+      else:
+        if not hasattr(val, "__iter__"):
+          yield (label+"[Not a list!!!]", None)
+        # An empty list/iterable (no nodes)
+        elif not val:
+          yield (label+"[EMPTY]", None)
+        # A non-empty list/iterable
+        else:
+          for (i, child) in enumerate(val):
+            yield (label+"["+str(i)+"]", child)
+
 def get_childvars(node, child_prefix=child_prefix_default,
                   children_prefix=children_prefix_default):
   '''Return all children nodes of a tree node
@@ -28,32 +75,22 @@ def get_childvars(node, child_prefix=child_prefix_default,
   also contains the number of the child, or EMPTY if the list is empty
   (in which case None is used as the second element, as there is no child).'''
 
-  childvars = []
-  # Only search for attributes if we have an object
-  if hasattr(node, "__dict__"):
-    # Iterate though all attributes of the node object
-    for name,val in vars(node).items():
-      # An attribute containing one child node
-      if name.startswith(child_prefix):
-        label = name[len(child_prefix):]
-        childvars.append((label, val))
-      # An attribute containing a child list
-      elif name.startswith(children_prefix):
-        label = name[len(children_prefix):]
-        # Make sure contents is not None and is a list (or actually, can
-        # be iterated through
-        if val is None:
-          childvars.append((label+"[NONE stored instead of a list!!!]", None))
-        else:
-          if not hasattr(val, "__iter__"):
-            childvars.append((label+"[Not a list!!!]", None))
-          # An empty list/iterable (no nodes)
-          elif not val:
-            childvars.append((label+"[EMPTY]", None))
-          # A non-empty list/iterable
-          else:
-            childvars.extend([(label+"["+str(i)+"]", child) for (i, child) in enumerate(val)])
-  return childvars
+  return list(iter_childvars(node, child_prefix, children_prefix))
+
+def get_children(node):
+  '''Return all children nodes of a syntax tree node, without labels
+
+  A faster version of get_childvars for traversals that don't need the
+  labels. Only nodes with a child_fields schema (ast_nodes.py) are supported.'''
+  children = []
+  for name, is_list in type(node).child_schema:
+    if is_list:
+      children.extend(getattr(node, name))
+    else:
+      child = getattr(node, name, None)
+      if child is not None:
+        children.append(child)
+  return children
 
 
 # Printing the syntax tree (AST)
@@ -95,8 +132,46 @@ def dotnodeid(nodenum):
   '''Convert node number to a dot id'''
   return "N"+str(nodenum)
 
-def treeprint_indent(node, outtype="unicode", label="", first_indent="", indent=""):
-  '''Print out an ASCII/Unicode version of a subtree in a tree.
+def describe_node(node):
+  '''Return the texts printed for a node: its node type, and its value, type
+  and line number (if it has them)'''
+  # If node has node type attribute, print that, otherwise try to print the whole
+  # node take help in finding the error
+  if hasattr(node, nodetype_attr):
+    head = getattr(node, nodetype_attr)
+  else:
+    head = "??? '" + str(node) + "' ???"
+  details = ""
+  # If node has a value attribute, print the value of the node in parenthesis
+  if hasattr(node, value_attr):
+    details += " (" + str(getattr(node, value_attr)) + ")"
+  if hasattr(node, type_attr):
+    details += " :" + str(getattr(node, type_attr))
+  if hasattr(node, lineno_attr):
+    details += " #" + str(getattr(node, lineno_attr))
+  return head, details
+
+# The printers below are generators, one per node, which yield the text of
+# the node and argument tuples for its children. walk_tree runs them with
+# an explicit stack instead of recursion, so the depth of the tree isn't
+# limited by Python's recursion limit, and the text of a child comes before
+# whatever its parent yields after it.
+
+def walk_tree(printer, args):
+  '''Generate the text of a tree printed by printer, starting with printer(*args)'''
+  stack = [printer(*args)]
+  while stack:
+    for item in stack[-1]:
+      if type(item) is str:
+        yield item
+      else:
+        stack.append(printer(*item))
+        break
+    else:
+      stack.pop()
+
+def indent_lines(node, outtype, label, first_indent, indent):
+  '''Generate an ASCII/Unicode version of a subtree in a tree.
   
   node = the root of the subtree
   outtype = unicode/ascii
@@ -109,49 +184,28 @@ def treeprint_indent(node, outtype="unicode", label="", first_indent="", indent=
     first_indent += label + ": "
   if not node:
     # If node is None, just print NONE
-    print(first_indent + "NONE")
+    yield first_indent + "NONE\n"
+    return
+  head, details = describe_node(node)
+  yield first_indent + head + details + "\n"
+  if outtype == "unicode":
+    child_indent, normal_indent = child_indent_uni, normal_indent_uni
+    last_child_indent, last_normal_indent = last_child_indent_uni, last_normal_indent_uni
   else:
-    # If node has node type attribute, print that, otherwise try to print the whole
-    # node take help in finding the error
-    if hasattr(node, nodetype_attr):
-      print(first_indent + getattr(node, nodetype_attr), end="")
-    else:
-      print(first_indent + "??? '" + str(node) + "' ???", end="")
-    # If node has a value attribute, print the value of the node in parenthesis
-    if hasattr(node, value_attr):
-      print(" (" + str(getattr(node, value_attr)) + ")", end="")
-    if hasattr(node, type_attr):
-      print(" :" + str(getattr(node, type_attr)), end="")
-    if hasattr(node, lineno_attr):
-      print(" #" + str(getattr(node, lineno_attr)), end="")
-    print()
-    # Get all children of the node and iterate through them
-    childvars = get_childvars(node)
-    i = len(childvars)
-    for name,value in childvars:
-      i -= 1
-      if i > 0:
-        # Not the last child, use normal indentation
-        if outtype == "unicode":
-          first_indent = child_indent_uni
-          rest_indent = normal_indent_uni
-        else:
-          first_indent = child_indent_asc
-          rest_indent = normal_indent_asc
-      else:
-        # The last child, use indentation for that case
-        if outtype == "unicode":
-          first_indent = last_child_indent_uni
-          rest_indent = last_normal_indent_uni
-        else:
-          first_indent = last_child_indent_asc
-          rest_indent = last_normal_indent_asc
-      # Recursively print the child subtrees, adding indentation
-      treeprint_indent(value, outtype, name, indent+first_indent,
-                indent+rest_indent)
-
-def treeprint_dot(node, nodenum, nodecount):
-  '''Print a subtree in dot format.
+    child_indent, normal_indent = child_indent_asc, normal_indent_asc
+    last_child_indent, last_normal_indent = last_child_indent_asc, last_normal_indent_asc
+  # Print the child subtrees, adding indentation. A child is printed when
+  # the next one is found, so that the last one gets its own indentation
+  previous = None
+  for childvar in iter_childvars(node):
+    if previous is not None:
+      yield (previous[1], outtype, previous[0], indent+child_indent, indent+normal_indent)
+    previous = childvar
+  if previous is not None:
+    yield (previous[1], outtype, previous[0], indent+last_child_indent, indent+last_normal_indent)
+
+def dot_lines(node, nodenum, nodecount):
+  '''Generate a subtree in dot format.
   
   nodenum = number of the node (for dot id generation)
   nodecount = a list containing the maximum used id'''
@@ -159,51 +213,105 @@ def treeprint_dot(node, nodenum, nodecount):
   nodeline = dotnodeid(nodenum)
   if not node:
     # None is output as an ellipse with label NONE
-    nodeline += ' [shape="ellipse", label="NONE"]'
-    print(nodeline)
-  else:
-    # Normal nodes use the default shape
-    nodeline += ' [label="'
-    # If node has node type attribute, print that, otherwise try to print the whole
-    # node take help in finding the error
-    if hasattr(node, nodetype_attr):
-      nodeline += getattr(node, nodetype_attr)
-    else:
-      nodeline += "??? '" + str(node) + "' ???"
-    nextnodeline = ""
-    # If node has a value attribute, output the value in parenthesis
-    if hasattr(node, value_attr):
-      nextnodeline += " (" + str(getattr(node, value_attr)) + ")"
-    if hasattr(node, type_attr):
-      nextnodeline += " :" + str(getattr(node, type_attr))
-    if hasattr(node, lineno_attr):
-      nextnodeline += " #" + str(getattr(node, lineno_attr))
-    if nextnodeline:
-      nodeline += "\n"+nextnodeline
-    nodeline += '"]'
-    print(nodeline)
-    # Get all children of the node and iterate through them
-    childvars = get_childvars(node)
-    for name,value in childvars:
-      # Number the child by one more than current maximum (and update maximum)
-      nodecount[0] += 1
-      childnum = nodecount[0]
-      # Recursively print the child subtrees
-      treeprint_dot(value, childnum, nodecount)
-      # Output the named connection between parent and child
-      print(dotnodeid(nodenum)+"->"+dotnodeid(childnum)+ ' [label="'+name+'"]')
-
-def treeprint(rootnode, outtype="unicode"):
+    yield nodeline + ' [shape="ellipse", label="NONE"]\n'
+    return
+  # Normal nodes use the default shape
+  head, details = describe_node(node)
+  nodeline += ' [label="' + head
+  if details:
+    nodeline += "\n" + details
+  yield nodeline + '"]\n'
+  for name, value in iter_childvars(node):
+    # Number the child by one more than current maximum (and update maximum)
+    nodecount[0] += 1
+    childnum = nodecount[0]
+    # Print the child subtree
+    yield (value, childnum, nodecount)
+    # Output the named connection between parent and child
+    yield dotnodeid(nodenum)+"->"+dotnodeid(childnum)+' [label="'+name+'"]\n'
+
+def json_parts(node, encode):
+  '''Generate a subtree as compact JSON.
+
+  Each node is an object with its nodetype (and value, type and lineno if it
+  has them) and a key for each child attribute, without the prefix: an object
+  (or null) for a child and an array for a child list. Ints are numbers and
+  other values strings, converted with encode (json.encoder.encode_basestring).'''
+  if not node:
+    yield "null"
+    return
+  if not hasattr(node, nodetype_attr):
+    yield encode("??? '" + str(node) + "' ???")
+    return
+  text = '{"' + nodetype_attr + '":' + encode(getattr(node, nodetype_attr))
+  for attr in (value_attr, type_attr, lineno_attr):
+    if hasattr(node, attr):
+      value = getattr(node, attr)
+      if value is None:
+        value = "null"
+      elif type(value) is int:
+        value = str(value)
+      else:
+        value = encode(str(value))
+      text += ',"' + attr + '":' + value
+  # The text is yielded only before a child, so that a node with no
+  # children is one string
+  for name in child_names(node):
+    val = getattr(node, name)
+    if name.startswith(child_prefix_default):
+      yield text + ',"' + name[len(child_prefix_default):] + '":'
+      yield (val, encode)
+      text = ""
+    elif name.startswith(children_prefix_default):
+      text += ',"' + name[len(children_prefix_default):] + '":['
+      if val is not None and hasattr(val, "__iter__"):
+        separator = ""
+        for child in val:
+          yield text + separator
+          yield (child, encode)
+          text = ""
+          separator = ","
+      text += "]"
+  yield text + "}"
+
+def write_buffered(parts, file, bufsize=65536):
+  '''Write strings to a file, joined into chunks of about bufsize characters'''
+  buf = []
+  size = 0
+  for part in parts:
+    buf.append(part)
+    size += len(part)
+    if size >= bufsize:
+      file.write("".join(buf))
+      buf = []
+      size = 0
+  if buf:
+    file.write("".join(buf))
+
+tree_formats = ("unicode", "ascii", "dot", "json")
+
+def treeprint(rootnode, outtype="unicode", file=None):
   '''Prints out a tree, given its root.
   
      The second argument is the output type:
      "unicode" (default) prints a text-version of the tree using Unicode block characters.
      "ascii" prints an ASCII-only version, with |, -, +.
      "dot" prints a tree in dot format (can be converted to a graphical tree
-     using dot command in graphwiz).'''
+     using dot command in graphwiz).
+     "json" prints the tree as compact JSON on one line.
+     The tree is written to file (default sys.stdout) in chunks while it is
+     traversed, so its whole text is never kept in memory.'''
+  if file is None:
+    file = sys.stdout
   if outtype == "dot":
-    print(dot_preamble)
-    treeprint_dot(rootnode, 0, [0])
-    print(dot_postamble)
+    parts = itertools.chain([dot_preamble + "\n"], walk_tree(dot_lines, (rootnode, 0, [0])),
+                            [dot_postamble + "\n"])
+  elif outtype == "json":
+    from json.encoder import encode_basestring
+    parts = itertools.chain(walk_tree(json_parts, (rootnode, encode_basestring)), ["\n"])
+  elif outtype in ("unicode", "ascii"):
+    parts = walk_tree(indent_lines, (rootnode, outtype, "", "", ""))
   else:
-    treeprint_indent(rootnode, outtype)
\ No newline at end of file
+    raise ValueError("unknown tree type '" + str(outtype) + "', expected one of "
+                     + ", ".join(tree_formats))
+  write_buffered(parts, file)
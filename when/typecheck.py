@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+
+# Static type inference
+#
+# Every expression node gets attribute valtype, the type of its value: 'int',
+# 'date', or None if it can't be known (an int literal whose value was replaced
+# by a unary sign, see main.p_factor). Types come from the literals, the
+# declared types of formals and of FUNCTION/PROCEDURE results, and for
+# variables from their definitions: a VAR has the type of the expression it is
+# initialized with, which symdata.valtype keeps.
+#
+# Mismatches are reported as semantic errors before the program runs: an
+# operation the operand types don't have (e.g. date * int), a comparison of an
+# integer with a date, an attribute of an integer, an assignment, argument or
+# result of the wrong type, and IF expression branches of different types.
+#
+# Operation nodes also get attribute operate, the function of semantics_run
+# that computes the operation for its operand types (see
+# semantics_run.SPECIALIZED_OPERATIONS), so the engines don't test the types
+# of the operands at run time. It is None if a type is not known, and the
+# generic semantics_run.arithmetics is used.
+
+from ast_nodes import node_line
+from datevalue import DateValue
+from semantics_run import SPECIALIZED_OPERATIONS
+
+# (operation, left type, right type) -> type of the result
+OPERATION_TYPES = {
+    ('+', 'int', 'int'): 'int',
+    ('-', 'int', 'int'): 'int',
+    ('*', 'int', 'int'): 'int',
+    ('/', 'int', 'int'): 'int',
+    ('+', 'date', 'int'): 'date',
+    ('-', 'date', 'int'): 'date',
+    ('-', 'date', 'date'): 'int',
+}
+
+LITERAL_TYPES = {int: 'int', DateValue: 'date'}
+
+TYPE_NAMES = {'int': 'an integer', 'date': 'a date'}
+
+
+def type_error(node, message):
+    '''Return an error message, with the line of the node if report_error
+       won't add it (e.g. comparisons have no line number of their own)'''
+    message = "Error, " + message
+    if not hasattr(node, 'lineno'):
+        lineno = node_line(node)
+        if lineno:
+            message = "Line " + str(lineno) + ": " + message
+    return message
+
+
+def mismatch(expected, valtype):
+    '''Is a value of type valtype given where one of type expected is needed'''
+    return expected is not None and valtype is not None and expected != valtype
+
+
+# The inference is run as a semantic check (see symtbl_semantics_check.CHECKS)
+# after the children of a node are visited, so the types of its operands are
+# already known.
+
+def init_types(semdata):
+    semdata.type_procedure = None  # definition node of the PROCEDURE being visited
+
+
+def types_before(node, semdata):
+    if node.nodetype == 'procedure_def':
+        semdata.type_procedure = node
+
+
+def infer_types(node, semdata):
+    nodetype = node.nodetype
+    if nodetype in ('int_literal', 'date_literal'):
+        node.valtype = LITERAL_TYPES.get(type(node.value))
+
+    elif nodetype == 'var':
+        valtype = node.symdata.valtype
+        if hasattr(node, 'child_read_attr'):
+            if mismatch('date', valtype):
+                return type_error(node, "'" + node.child_read_attr.value
+                                  + "' can only be read from a 'date' object")
+            valtype = 'int'
+        node.valtype = valtype
+
+    elif nodetype == 'operation':
+        left = node.child_left_expr.valtype
+        right = node.child_right_expr.valtype
+        node.valtype = node.operate = None
+        if left is not None and right is not None:
+            key = (node.value, left, right)
+            if key not in OPERATION_TYPES:
+                return type_error(node, "operation '" + node.value + "' is undefined between "
+                                  + TYPE_NAMES[left] + " and " + TYPE_NAMES[right])
+            node.valtype = OPERATION_TYPES[key]
+            node.operate = SPECIALIZED_OPERATIONS[key]
+
+    elif nodetype == 'comparison':
+        left = node.child_left_expr.valtype
+        right = node.child_right_expr.valtype
+        if mismatch(left, right):
+            return type_error(node, "comparison '" + node.value + "' between "
+                              + TYPE_NAMES[left] + " and " + TYPE_NAMES[right])
+        node.valtype = 'int'
+
+    elif nodetype == 'if_expression':
+        if_type = node.child_if_body.valtype
+        else_type = node.child_else_body.valtype
+        if mismatch(if_type, else_type):
+            return type_error(node, "the branches of an IF expression are "
+                              + TYPE_NAMES[if_type] + " and " + TYPE_NAMES[else_type])
+        node.valtype = if_type or else_type
+
+    elif nodetype == 'func_call' or nodetype == 'proc_call':
+        if nodetype == 'func_call' and node.value == 'Today':
+            node.valtype = 'date'
+            return None
+        definition = node.symdata.defnode
+        for i, (formal, arg) in enumerate(zip(definition.children_formals, node.children_args)):
+            if mismatch(formal.type, arg.valtype):
+                return type_error(node, "argument " + str(i + 1) + " of '" + node.value + "' must be "
+                                  + TYPE_NAMES[formal.type] + ", not " + TYPE_NAMES[arg.valtype])
+        node.valtype = definition.type if definition.type in TYPE_NAMES else None
+
+    elif nodetype == 'formal_arg':
+        node.symdata.valtype = node.type
+
+    elif nodetype == 'variable_def':
+        node.symdata.valtype = node.child_expression.valtype
+
+    elif nodetype == 'assign':
+        lvalue = node.child_lvalue
+        valtype = node.child_rvalue.valtype
+        if hasattr(lvalue, 'child_write_attr'):
+            attr = lvalue.child_write_attr.value
+            if mismatch('date', lvalue.valtype):
+                return type_error(node, "'" + attr + "' can only be written to a 'date' object")
+            if mismatch('int', valtype):
+                return type_error(node, "the value of attribute '" + attr + "' must be an integer, not "
+                                  + TYPE_NAMES[valtype])
+        elif mismatch(lvalue.valtype, valtype):
+            return type_error(node, "assigning " + TYPE_NAMES[valtype] + " to variable '"
+                              + lvalue.value + "', which holds " + TYPE_NAMES[lvalue.valtype])
+
+    elif nodetype == 'return_statement':
+        procedure = semdata.type_procedure
+        if procedure is not None and procedure.type in TYPE_NAMES:
+            if mismatch(procedure.type, node.child_expr.valtype):
+                return type_error(node, "procedure '" + procedure.value + "' must return "
+                                  + TYPE_NAMES[procedure.type] + ", not "
+                                  + TYPE_NAMES[node.child_expr.valtype])
+
+    elif nodetype == 'function_def':
+        if mismatch(node.type, node.child_body.valtype):
+            return type_error(node, "function '" + node.value + "' must return "
+                              + TYPE_NAMES[node.type] + ", not " + TYPE_NAMES[node.child_body.valtype])
+
+    elif nodetype == 'procedure_def':
+        semdata.type_procedure = None
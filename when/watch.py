@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+#
+
+# Watch mode: incremental reparsing and rechecking
+#
+# The program is kept as a list of spans, one per top-level definition or
+# statement, each with the text it was parsed from (up to the start of the next
+# span) and its syntax tree. When the file changes, only the spans between the
+# common prefix and suffix of the old and new text are split and parsed again,
+# and spans whose text did not change are reused with their trees. The split
+# stops as soon as a span starts where an old span started in the unchanged
+# suffix, so the work depends on the size of the edit, not of the file.
+#
+# Semantic checks are run again for the new spans and for the spans that refer
+# to a name defined by an old or a new span. The other spans keep the symbol
+# data linked into their trees, which is put back into the new symbol table.
+# Anything unexpected (a syntax or semantic error, or a split the parser does
+# not agree with) falls back to parsing and checking the whole program, which
+# also reports the errors exactly like main.py does.
+#
+# Execution is not incremental: the program is compiled and run as a whole
+# after every change.
+
+import contextlib
+import io
+import os
+import sys
+import time
+from bisect import bisect_left
+from itertools import repeat
+from operator import add
+
+from ply import yacc
+
+import main
+import memo
+from ast_nodes import Program
+from scanner import Scanner
+from semantics_common import SemData, SymbolData, run_checks, visit_tree
+from symtbl_semantics_check import CHECKS, init_semdata, semantic_checks
+from semantics_run import DEFAULT_MAX_DEPTH, run_program
+
+DEFINITION_STARTS = ('VAR', 'FUNCTION', 'PROCEDURE')
+SUBROUTINE_TYPES = {'function_def': 'func', 'procedure_def': 'proc'}
+# Tokens after which an expression of a VAR definition needs an operand
+OPERATORS = ('PLUS', 'MINUS', 'MULT', 'DIV', 'EQ', 'LT', 'APOSTROPHE', 'COMMA', 'LPAREN')
+NESTING_STARTS = ('WHILE', 'IF')
+NESTING_ENDS = ('ENDWHILE', 'ENDIF')
+
+# Spans are split with a small chunk size, so that little text after the edit
+# is scanned
+SPLIT_CHUNK_SIZE = 1 << 10
+
+POLL_INTERVAL = 0.2
+
+
+def make_parser(start):
+    '''Return a parser for a single definition or statement'''
+    return yacc.yacc(module=main, start=start, debug=False, write_tables=False,
+                     errorlog=yacc.NullLogger())
+
+
+PARSERS = {'definition': make_parser('definitions'),
+           'statement': make_parser('statement_list')}
+
+
+class ChangeError(Exception):
+    '''The change can't be applied incrementally'''
+
+
+class Span:
+    '''A top-level definition or statement
+
+       kind is 'definition' or 'statement', name the name a definition
+       defines, and refs the global names the span refers to. For a FUNCTION,
+       callees and impure are what memo.purity_before found in it.'''
+    __slots__ = ('kind', 'node', 'name', 'refs', 'callees', 'impure')
+
+    def __init__(self, kind, node):
+        self.kind = kind
+        self.node = node
+        self.name = node.value if kind == 'definition' else None
+        self.refs = ()
+        self.callees = set()
+        self.impure = False
+
+
+def split_units(tokens):
+    '''Generate (position, line number, kind) of the top-level definitions and
+       statements in a stream of tokens
+
+       Only tokens are looked at, so the result is right for any program the
+       parser accepts, and anything else is found out when parsing the spans.'''
+    tok = next(tokens, None)
+    while tok is not None:
+        if tok.type in DEFINITION_STARTS:
+            yield tok.lexpos, tok.lineno, 'definition'
+            if tok.type == 'VAR':
+                tok = skip_variable_definition(tokens)
+            else:
+                tok = skip_subroutine(tok.type, tokens)
+        else:
+            yield tok.lexpos, tok.lineno, 'statement'
+            tok = skip_statement(tok, tokens)
+
+
+def skip_variable_definition(tokens):
+    '''Skip the rest of a VAR definition, return the token after it
+
+       The definition ends where its expression can't continue: at a token
+       that is not an operator or a closing parenthesis, when no operand is
+       expected and no parentheses are open.'''
+    for tok in (next(tokens, None), next(tokens, None)):  # name IS
+        if tok is None:
+            return None
+    expect_operand = True
+    depth = 0
+    for tok in tokens:
+        tok_type = tok.type
+        if tok_type in OPERATORS:
+            expect_operand = True
+            if tok_type == 'LPAREN':
+                depth += 1
+        elif tok_type == 'RPAREN':
+            expect_operand = False
+            depth -= 1
+        elif expect_operand or depth > 0:
+            expect_operand = False
+        else:
+            return tok
+    return None
+
+
+def skip_subroutine(kind, tokens):
+    '''Skip the rest of a FUNCTION or PROCEDURE, return the token after it'''
+    tok = next(tokens, None)
+    while tok is not None:
+        if tok.type == 'END':
+            tok = next(tokens, None)
+            if tok is not None and tok.type == kind:
+                return next(tokens, None)
+        else:
+            tok = next(tokens, None)
+    return None
+
+
+def skip_statement(tok, tokens):
+    '''Skip a statement starting with tok, return the token after it'''
+    depth = 0
+    while tok is not None:
+        tok_type = tok.type
+        if tok_type in NESTING_STARTS:
+            depth += 1
+        elif tok_type in NESTING_ENDS:
+            depth -= 1
+        elif tok_type == 'SEMICOLON' and depth == 0:
+            return next(tokens, None)
+        tok = next(tokens, None)
+    return None
+
+
+def split_source(text, pos=0, lineno=1):
+    '''Split text from position pos (on line lineno) into top-level units'''
+    scanner = Scanner(SPLIT_CHUNK_SIZE)
+    scanner.lineno = lineno
+    scanner.input(text, pos)
+    return split_units(iter(scanner))
+
+
+def common_prefix(a, b):
+    '''Length of the common prefix of two strings'''
+    low, high = 0, min(len(a), len(b))
+    # Compare slices, halving the rest each time
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix(a, b, limit):
+    '''Length of the common suffix of two strings, at most limit'''
+    low, high = 0, limit
+    size_a, size_b = len(a), len(b)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[size_a - middle:size_a - low] == b[size_b - middle:size_b - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def shift_lines(node, delta):
+    '''Add delta to the line numbers of a subtree'''
+    def shift(node, semdata):
+        if hasattr(node, 'lineno'):
+            node.lineno += delta
+    visit_tree(node, shift)
+
+
+def span_facts(span):
+    '''Record the global names a checked span refers to, and for a FUNCTION
+       what the memoization analysis needs'''
+    facts = SemData()
+    memo.init_purity(facts)
+    refs = set()
+
+    def before(node, facts):
+        nodetype = node.nodetype
+        if nodetype == 'func_call' or nodetype == 'proc_call':
+            refs.add(node.value)
+        elif nodetype == 'var' and node.symdata.scope == 'global':
+            refs.add(node.value)
+        memo.purity_before(node, facts)
+    visit_tree(span.node, before, memo.purity_after, facts)
+
+    span.refs = refs
+    span.callees = facts.callees.get(span.name, set())
+    span.impure = span.name in facts.impure_functions
+
+
+class IncrementalProgram:
+    '''The last successfully checked version of a program, split into spans
+
+       update(text) returns the checked tree and semantic data of a new
+       version of the text. stats tells how it was done.'''
+
+    def __init__(self):
+        self.reset()
+        self.stats = dict()
+
+    def reset(self):
+        self.text = None
+        self.spans = None
+        self.starts = None   # position of each span in text
+        self.linenos = None  # line of each span
+        self.definitions = 0  # the definitions are the first spans
+        self.users = dict()  # name -> spans referring to it
+        self.tree = None
+        self.semdata = None
+        self.modified = False  # set when a change starts to modify the spans
+
+    def update(self, text):
+        '''Return (tree, semdata) of a new version of the program
+
+           Errors are printed and raise SystemExit, like in main.py. The last
+           checked version is kept after a syntax error, so that the next
+           change is again compared to it.'''
+        if self.spans is not None:
+            if text == self.text:
+                self.stats = {'mode': 'unchanged', 'spans': len(self.spans)}
+                return self.tree, self.semdata
+            self.modified = False
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    return self.update_incrementally(text)
+            except (SystemExit, Exception):
+                if self.modified:
+                    # The spans may be half updated
+                    self.reset()
+        return self.update_fully(text)
+
+    def update_fully(self, text):
+        '''Parse and check the whole text'''
+        tree = main.parser.parse(text, lexer=Scanner())
+        self.reset()
+        semdata = SemData()
+        semantic_checks(tree, semdata)
+
+        nodes = tree.children_definitions + tree.children_statements
+        units = list(split_source(text))
+        self.stats = {'mode': 'full', 'spans': len(nodes)}
+        if len(units) != len(nodes) or any(
+                kind != ('definition' if i < len(tree.children_definitions) else 'statement')
+                for i, (pos, lineno, kind) in enumerate(units)):
+            # Can't be split, the next change is done in full too
+            return tree, semdata
+
+        self.spans = [Span(kind, node) for (pos, lineno, kind), node in zip(units, nodes)]
+        self.starts = [unit[0] for unit in units]
+        self.linenos = [unit[1] for unit in units]
+        self.definitions = len(tree.children_definitions)
+        for span in self.spans:
+            span_facts(span)
+            self.add_user(span)
+        self.text = text
+        self.tree = tree
+        self.semdata = semdata
+        return tree, semdata
+
+    def update_incrementally(self, text):
+        '''Reparse and recheck only the spans affected by the change
+
+           Nothing is modified until the changed spans are parsed.'''
+        old_text = self.text
+        starts = self.starts
+        prefix = common_prefix(old_text, text)
+        suffix = common_suffix(old_text, text, min(len(old_text), len(text)) - prefix)
+        delta = len(text) - len(old_text)
+        suffix_start = len(text) - suffix
+
+        # The first span changed is the last one starting before the change
+        first = bisect_left(starts, prefix) - 1
+        if first < 0:
+            first, units = 0, split_source(text)
+        else:
+            units = split_source(text, starts[first], self.linenos[first])
+
+        # Split until a span starts where an old one did in the unchanged suffix
+        new_units = []
+        last = len(starts)
+        line_delta = 0
+        for unit in units:
+            pos, lineno, kind = unit
+            if pos >= suffix_start:
+                i = bisect_left(starts, pos - delta)
+                if i < len(starts) and starts[i] == pos - delta:
+                    last = i
+                    line_delta = lineno - self.linenos[i]
+                    break
+            new_units.append(unit)
+
+        # Reuse the trees of spans whose text did not change
+        old_spans = self.spans[first:last]
+        ends = starts[first + 1:last] + [starts[last] if last < len(starts) else len(old_text)]
+        reusable = dict()
+        for span, start, end, lineno in zip(old_spans, starts[first:last], ends,
+                                            self.linenos[first:last]):
+            reusable.setdefault(old_text[start:end], []).append((span, lineno))
+        ends = [unit[0] for unit in new_units[1:]] + [starts[last] + delta if last < len(starts) else len(text)]
+        new_spans = []
+        moved = []
+        reparsed = 0
+        for (pos, lineno, kind), end in zip(new_units, ends):
+            source = text[pos:end]
+            if reusable.get(source):
+                span, old_lineno = reusable[source].pop()
+                if lineno != old_lineno:
+                    moved.append((span, lineno - old_lineno))
+            else:
+                span = Span(kind, self.parse(source, lineno, kind))
+                reparsed += 1
+            new_spans.append(span)
+
+        # Definitions must still come before statements
+        kinds = [span.kind for span in self.spans[first - 1:first] + new_spans + self.spans[last:last + 1]]
+        if kinds != sorted(kinds) or (last == len(starts) and kinds[-1:] != ['statement']):
+            raise ChangeError("definitions after statements")
+
+        self.modified = True
+        for span, lines in moved:
+            shift_lines(span.node, lines)
+
+        # Names defined by the old or the new spans may resolve differently now
+        for span in old_spans:
+            self.remove_user(span)
+        changed_names = {span.name for span in old_spans + new_spans if span.name is not None}
+        dirty = set(new_spans)
+        for name in changed_names:
+            dirty.update(self.users.get(name, ()))
+
+        if line_delta:
+            for span in self.spans[last:]:
+                shift_lines(span.node, line_delta)
+        self.definitions += (sum(1 for span in new_spans if span.kind == 'definition')
+                             - sum(1 for span in old_spans if span.kind == 'definition'))
+        self.spans[first:last] = new_spans
+        self.starts[first:] = ([unit[0] for unit in new_units]
+                               + list(map(add, starts[last:], repeat(delta))))
+        self.linenos[first:] = ([unit[1] for unit in new_units]
+                                + list(map(add, self.linenos[last:], repeat(line_delta))))
+        self.text = text
+
+        semdata = self.check(dirty)
+        tree = Program()
+        tree.lineno = 0
+        tree.children_definitions = [span.node for span in self.spans[:self.definitions]]
+        tree.children_statements = [span.node for span in self.spans[self.definitions:]]
+        self.tree = tree
+        self.semdata = semdata
+        self.stats = {'mode': 'incremental', 'spans': len(self.spans),
+                      'reparsed': reparsed, 'rechecked': len(dirty)}
+        return tree, semdata
+
+    def parse(self, source, lineno, kind):
+        '''Parse the text of one span'''
+        scanner = Scanner()
+        scanner.lineno = lineno
+        node = PARSERS[kind].parse(source, lexer=scanner)
+        if kind == 'statement':
+            if len(node) != 1:
+                raise ChangeError("not a single statement")
+            node = node[0]
+        return node
+
+    def check(self, dirty):
+        '''Check the dirty spans again and link the symbol data of the others'''
+        semdata = SemData()
+        init_semdata(semdata)
+        symtbl = semdata.symtbl
+        definitions = self.spans[:self.definitions]
+
+        # FUNCTIONs and PROCEDUREs can be called before their definition.
+        # Clean spans refer to the symbol data of their definition, so it is
+        # kept.
+        for span in definitions:
+            node = span.node
+            symtype = SUBROUTINE_TYPES.get(node.nodetype)
+            if symtype is not None:
+                if span.name in symtbl:
+                    raise ChangeError("redefined '" + span.name + "'")
+                symdata = getattr(node, 'symdata', None)
+                symtbl[span.name] = symdata or SymbolData(symtype, node)
+
+        for span in self.spans:
+            node = span.node
+            if span in dirty:
+                old_symdata = getattr(node, 'symdata', None)
+                self.remove_user(span)
+                run_checks(node, CHECKS, semdata, finish=False)
+                if node.nodetype == 'variable_def' and old_symdata is not None:
+                    symdata = symtbl[span.name]
+                    # Clean spans using the variable were checked with its type
+                    if symdata.valtype != old_symdata.valtype:
+                        raise ChangeError("type of variable '" + span.name + "' changed")
+                    old_symdata.slot = symdata.slot
+                    semdata.global_symbols[symdata.slot] = old_symdata
+                    node.symdata = symtbl[span.name] = old_symdata
+                span_facts(span)
+                self.add_user(span)
+            elif node.nodetype == 'variable_def':
+                if span.name in symtbl:
+                    raise ChangeError("redefined variable '" + span.name + "'")
+                # Slots are given in order, like semantic_checks does
+                symtbl[span.name] = semdata.add_global(node.symdata)
+
+        functions = [span for span in definitions if span.node.nodetype == 'function_def']
+        semdata.callees = {span.name: span.callees for span in functions}
+        semdata.impure_functions = {span.name for span in functions if span.impure}
+        for check in CHECKS:
+            if check.finish:
+                check.finish(semdata)
+        return semdata
+
+    def add_user(self, span):
+        for name in span.refs:
+            self.users.setdefault(name, set()).add(span)
+
+    def remove_user(self, span):
+        for name in span.refs:
+            self.users[name].discard(span)
+
+
+def watch(filename, engine='closure', memo_size=memo.DEFAULT_MEMO_SIZE,
+          max_depth=DEFAULT_MAX_DEPTH, interval=POLL_INTERVAL, budget=None):
+    '''Run a program again whenever its file changes, until interrupted
+
+       budget (budget.Budget) limits each run.'''
+    program = IncrementalProgram()
+    version = None
+    try:
+        while True:
+            try:
+                stat = os.stat(filename)
+                if (stat.st_mtime_ns, stat.st_size) != version:
+                    version = (stat.st_mtime_ns, stat.st_size)
+                    with open(filename, encoding='utf-8') as infile:
+                        text = infile.read()
+                    start = time.perf_counter()
+                    try:
+                        tree, semdata = program.update(text)
+                    except SystemExit:
+                        print_status("errors", start)
+                    except Exception as error:  # From the lexer
+                        print(error)
+                        print_status("errors", start)
+                    else:
+                        print_status(describe(program.stats), start)
+                        try:
+                            run_program(tree, semdata, engine, memo_size, max_depth, budget=budget)
+                        except SystemExit:
+                            pass
+                    sys.stdout.flush()
+            except FileNotFoundError:
+                pass  # Being replaced by an editor
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def describe(stats):
+    if stats['mode'] == 'incremental':
+        return "{} of {} spans reparsed, {} rechecked".format(
+            stats['reparsed'], stats['spans'], stats['rechecked'])
+    if stats['mode'] == 'full':
+        return "all {} spans parsed".format(stats['spans'])
+    return "unchanged"
+
+
+def print_status(message, start):
+    print("[watch] {} ({:.1f} ms)".format(message, (time.perf_counter() - start) * 1000),
+          file=sys.stderr)